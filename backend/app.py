@@ -1,14 +1,36 @@
 # backend/app.py
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, copy_current_request_context
 from flask_cors import CORS
+import click
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.engine import Engine
 from datetime import datetime, date, timedelta
+from types import SimpleNamespace
 from dateutil.relativedelta import relativedelta
 import os
+import io
+import gzip
+import shutil
+import re
+import csv
 import math
-import requests
+import tempfile
 import json
 import hashlib
+import sqlite3
+import base64
+import binascii
+import threading
+import time
+import fcntl
+from contextlib import contextmanager
+import copy
+import queue
+import functools
+from concurrent.futures import Future
 
 app = Flask(__name__)
 CORS(app)
@@ -17,11 +39,96 @@ db_path = os.environ.get('DATABASE_URL', 'sqlite:////app/data/budget.db')
 app.config['SQLALCHEMY_DATABASE_URI'] = db_path
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Профиль SQLite: PRAGMA выполняются для каждого нового соединения (_sqlite_connect).
+# WAL даёт читателям не ждать писателя, busy_timeout — ждать блокировку, а не падать
+# с database is locked; synchronous=NORMAL в WAL не теряет целостность при сбое.
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'wal'),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 15000)),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'normal'),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -64000)),
+    'temp_store': os.environ.get('SQLITE_TEMP_STORE', 'memory'),
+    'foreign_keys': os.environ.get('SQLITE_FOREIGN_KEYS', 'on'),
+}
+
+# Пул соединений на воркер gunicorn: по соединению на поток (--threads 4)
+# плюс запас для фоновых потоков импорта и долгих выгрузок
+DB_POOL_OPTIONS = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 4)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 4)),
+    'pool_timeout': 30
+}
+if db_path.startswith('sqlite') and ':memory:' not in db_path:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+        DB_POOL_OPTIONS, connect_args={'timeout': SQLITE_PRAGMAS['busy_timeout'] / 1000}
+    )
+elif db_path.startswith('postgresql'):
+    # Сервер может закрыть простаивающее соединение: проверяем перед выдачей из пула
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(DB_POOL_OPTIONS, pool_pre_ping=True, pool_recycle=1800)
+
+# Движок только для чтения для GET-маршрутов (BudgetSession.get_bind): для файла
+# SQLite — тот же файл с mode=ro и PRAGMA query_only, для других СУБД — реплика
+# из DATABASE_READ_URL. Пустой DATABASE_READ_URL отключает разделение.
+if db_path.startswith('sqlite:///') and ':memory:' not in db_path:
+    DATABASE_READ_URL = os.environ.get(
+        'DATABASE_READ_URL', 'sqlite:///file:' + db_path[len('sqlite:///'):] + '?mode=ro&uri=true'
+    )
+else:
+    DATABASE_READ_URL = os.environ.get('DATABASE_READ_URL', '')
+READ_ENGINE_OPTIONS = {
+    'pool_size': int(os.environ.get('DB_READ_POOL_SIZE', 8)),
+    'max_overflow': int(os.environ.get('DB_READ_MAX_OVERFLOW', 8)),
+    'pool_timeout': 30
+}
+
+# Очередь записи (DB_WRITE_QUEUE=1): мутирующие маршруты выполняются одним
+# потоком-писателем на процесс, накопившиеся запросы — одним коммитом
+WRITE_QUEUE_ENABLED = os.environ.get('DB_WRITE_QUEUE', '').lower() in ('1', 'true', 'on')
+WRITE_QUEUE_MAX_BATCH = int(os.environ.get('DB_WRITE_QUEUE_MAX_BATCH', 32))
+
+# Резервные копии: каталог, сколько хранить, шаг копирования в страницах
+BACKUP_DIR = os.environ.get('BACKUP_DIR', '/app/data/backups')
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', 14))
+BACKUP_PAGES_PER_STEP = int(os.environ.get('BACKUP_PAGES_PER_STEP', 256))
+BACKUP_STEP_PAUSE = float(os.environ.get('BACKUP_STEP_PAUSE', 0.005))
+
 # DeepSeek API настройки
 DEEPSEEK_API_KEY = os.environ.get('DEEPSEEK_API_KEY', '')
 DEEPSEEK_API_URL = 'https://api.deepseek.com/v1/chat/completions'
 
-db = SQLAlchemy(app)
+class BudgetSession(FlaskSession):
+    """
+    Сессия для очереди записи: пока поток-писатель выполняет обработчик, его
+    commit() и rollback() закрывают только SAVEPOINT этого обработчика, а настоящий
+    коммит делается один на всю пачку (run_write_batch).
+    
+    В сессиях с info['read_only'] (GET-запросы) запросы идут в движок только для
+    чтения; flush, если он всё же случится, по-прежнему пишет в основной.
+    """
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get('read_only') and not self._flushing:
+            return read_engine()
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+    
+    def commit(self):
+        savepoint = self.info.get('write_savepoint')
+        if savepoint is None:
+            return super().commit()
+        savepoint.commit()
+        # Как настоящий коммит (expire_on_commit): объекты перечитываются при обращении
+        # и видят массовые UPDATE (балансы, долги по картам), сделанные в обход ORM
+        self.expire_all()
+        self.info['write_savepoint'] = self.begin_nested()
+    
+    def rollback(self):
+        savepoint = self.info.get('write_savepoint')
+        if savepoint is None:
+            return super().rollback()
+        savepoint.rollback()
+        self.info['write_savepoint'] = self.begin_nested()
+
+db = SQLAlchemy(app, session_options={'class_': BudgetSession})
 
 # ============ МОДЕЛИ ============
 
@@ -67,12 +174,23 @@ class Transaction(db.Model):
     is_tax_transfer = db.Column(db.Boolean, default=False)
     is_business_expense = db.Column(db.Boolean, default=False)
     tags = db.Column(db.String(255), default='')
+    import_hash = db.Column(db.String(64), nullable=True)  # хэш содержимого строки выписки
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     account = db.relationship('Account', foreign_keys=[account_id])
     category = db.relationship('Category')
     to_account = db.relationship('Account', foreign_keys=[to_account_id])
     store = db.relationship('Store')
+    
+    __table_args__ = (
+        db.Index('ix_transaction_type_date_amount', 'type', 'date', 'amount'),
+        db.Index('ix_transaction_category_type_date', 'category_id', 'type', 'date'),
+        db.Index('ix_transaction_account_date_id', 'account_id', 'date', 'id'),
+        db.Index('ix_transaction_to_account_date_id', 'to_account_id', 'date', 'id'),
+        db.Index('ix_transaction_store_type_date', 'store_id', 'type', 'date'),
+        db.Index('ix_transaction_date_id', 'date', 'id'),
+        db.Index('ix_transaction_import_hash', 'import_hash'),
+    )
 
 class Goal(db.Model):
     """Финансовые цели"""
@@ -103,6 +221,10 @@ class CreditCard(db.Model):
     cashback_percent = db.Column(db.Float, default=0)
     
     account = db.relationship('Account')
+    
+    __table_args__ = (
+        db.Index('ix_credit_card_account_id', 'account_id'),
+    )
 
 class InvestmentTransaction(db.Model):
     """История операций с инвестициями"""
@@ -117,7 +239,11 @@ class InvestmentTransaction(db.Model):
     notes = db.Column(db.String(255), default='')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    investment = db.relationship('Investment', backref='transactions')    
+    investment = db.relationship('Investment', backref='transactions')
+    
+    __table_args__ = (
+        db.Index('ix_investment_transaction_investment_date', 'investment_id', 'date'),
+    )
 
 class Credit(db.Model):
     """Потребительские кредиты"""
@@ -155,6 +281,10 @@ class CreditPayment(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     credit = db.relationship('Credit', backref='payment_records')
+    
+    __table_args__ = (
+        db.Index('ix_credit_payment_credit_date', 'credit_id', 'date'),
+    )
 
 class Mortgage(db.Model):
     """Ипотека"""
@@ -223,6 +353,19 @@ class ProductPrice(db.Model):
     
     product = db.relationship('Product')
     store = db.relationship('Store')
+    
+    __table_args__ = (
+        db.Index('ix_product_price_product_store_date', 'product_id', 'store_id', 'date'),
+    )
+
+class ProductLatestPrice(db.Model):
+    """Последняя цена товара в каждом магазине (обновляется при добавлении цены)"""
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    store_id = db.Column(db.Integer, db.ForeignKey('store.id'), primary_key=True)
+    price_id = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    is_sale = db.Column(db.Boolean, default=False)
+    date = db.Column(db.Date, nullable=False)
 
 class Investment(db.Model):
     """Инвестиции"""
@@ -241,6 +384,10 @@ class Investment(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     account = db.relationship('Account')
+    
+    __table_args__ = (
+        db.Index('ix_investment_account_id', 'account_id'),
+    )
 
 class TaxPayment(db.Model):
     """Налоговые платежи"""
@@ -266,6 +413,10 @@ class TaxReserve(db.Model):
     date = db.Column(db.Date, default=date.today)
     is_transferred = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_tax_reserve_business_transferred', 'business_account_id', 'is_transferred'),
+    )
 
 class Budget(db.Model):
     """Месячный бюджет"""
@@ -287,6 +438,11 @@ class Achievement(db.Model):
     unlocked = db.Column(db.Boolean, default=False)
     unlocked_at = db.Column(db.DateTime, nullable=True)
 
+class AchievementState(db.Model):
+    """Счётчики, по которым движок достижений проверяет правила"""
+    key = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
 class BonusCard(db.Model):
     """Бонусные карты магазинов"""
     id = db.Column(db.Integer, primary_key=True)
@@ -309,6 +465,972 @@ class AIAnalysis(db.Model):
     result = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class MonthlyRollup(db.Model):
+    """Помесячные итоги транзакций (обновляются вместе с каждой транзакцией)"""
+    id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.String(7), nullable=False)
+    type = db.Column(db.String(20), nullable=False)
+    category_id = db.Column(db.Integer, nullable=False, default=0)
+    store_id = db.Column(db.Integer, nullable=False, default=0)
+    account_id = db.Column(db.Integer, nullable=False, default=0)
+    is_business_expense = db.Column(db.Boolean, nullable=False, default=False)
+    total = db.Column(db.Float, nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.UniqueConstraint('month', 'type', 'category_id', 'store_id', 'account_id', 'is_business_expense',
+                            name='uq_monthly_rollup_key'),
+    )
+
+class JournalLine(db.Model):
+    """
+    Строка журнала двойной записи. Строки одного источника (транзакции, платежа
+    по кредиту, операции с инвестицией, корректировки) в сумме дают ноль.
+    ledger — книга: account (баланс счёта ref_id), card_debt, income, expense, equity...
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    source = db.Column(db.String(30), nullable=False)
+    source_id = db.Column(db.Integer, nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    ledger = db.Column(db.String(30), nullable=False)
+    ref_id = db.Column(db.Integer, nullable=True)
+    amount = db.Column(db.Float, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_journal_line_source', 'source', 'source_id'),
+        db.Index('ix_journal_line_ledger_ref_date', 'ledger', 'ref_id', 'date', 'id'),
+    )
+
+class ImportProfile(db.Model):
+    """Профиль выписки банка: формат файла и соответствие колонок полям транзакции"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    file_format = db.Column(db.String(10), default='csv')  # csv, ofx
+    encoding = db.Column(db.String(20), default='utf-8-sig')
+    delimiter = db.Column(db.String(5), default=';')
+    date_column = db.Column(db.String(100))
+    date_format = db.Column(db.String(50), default='%d.%m.%Y')
+    amount_column = db.Column(db.String(100))
+    description_column = db.Column(db.String(100))
+    category_column = db.Column(db.String(100))
+    status_column = db.Column(db.String(100))
+    ok_statuses = db.Column(db.String(255), default='')  # через запятую; пусто — без фильтра
+
+class ImportJob(db.Model):
+    """Задача импорта выписки и её прогресс"""
+    id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
+    profile_id = db.Column(db.Integer, db.ForeignKey('import_profile.id'), nullable=False)
+    filename = db.Column(db.String(255))
+    status = db.Column(db.String(20), default='queued')  # queued, running, done, failed
+    rows_read = db.Column(db.Integer, default=0)
+    rows_imported = db.Column(db.Integer, default=0)
+    rows_duplicate = db.Column(db.Integer, default=0)
+    rows_skipped = db.Column(db.Integer, default=0)
+    rows_failed = db.Column(db.Integer, default=0)
+    errors = db.Column(db.Text, default='[]')  # JSON: первые ошибки разбора
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)  # последняя пачка, записанная потоком импорта
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+class SchemaVersion(db.Model):
+    """Применённые миграции схемы (см. MIGRATIONS)"""
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class BalanceCheckpoint(db.Model):
+    """Баланс счёта на конец дня по строкам журнала — отправная точка для пересчётов"""
+    account_id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    balance = db.Column(db.Float, nullable=False)
+
+class ArchivedYear(db.Model):
+    """Закрытый год, транзакции которого перенесены в архив (см. archive_year)"""
+    year = db.Column(db.Integer, primary_key=True)
+    rows = db.Column(db.Integer, nullable=False, default=0)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Архив транзакций закрытых лет: те же колонки, что у transaction, в схеме archive —
+# присоединённый файл <база>-archive.db на SQLite (ATTACH в _sqlite_connect) или
+# схема archive на PostgreSQL. Своя MetaData: create_all её не трогает, таблицу
+# создаёт миграция. Внешних ключей нет — SQLite не проверяет их между файлами.
+ARCHIVE_SCHEMA = 'archive'
+ARCHIVE_METADATA = db.MetaData()
+archived_transactions = db.Table(
+    'transaction', ARCHIVE_METADATA,
+    *[db.Column(column.name, column.type, primary_key=column.primary_key, autoincrement=False)
+      for column in Transaction.__table__.columns],
+    db.Index('ix_archived_transaction_type_date_amount', 'type', 'date', 'amount'),
+    db.Index('ix_archived_transaction_category_type_date', 'category_id', 'type', 'date'),
+    db.Index('ix_archived_transaction_store_type_date', 'store_id', 'type', 'date'),
+    db.Index('ix_archived_transaction_date_id', 'date', 'id'),
+    db.Index('ix_archived_transaction_account_date_id', 'account_id', 'date', 'id'),
+    db.Index('ix_archived_transaction_to_account_date_id', 'to_account_id', 'date', 'id'),
+    db.Index('ix_archived_transaction_import_hash', 'import_hash'),
+    schema=ARCHIVE_SCHEMA
+)
+
+# ============ ДИАЛЕКТЫ ============
+# Код работает на SQLite и PostgreSQL. Всё, в чём они расходятся (upsert,
+# ключ периода для группировки по дате, поиск без учёта регистра), идёт через
+# помощники ниже.
+
+# Ключ периода: формат strftime для SQLite и to_char для PostgreSQL
+DATE_BUCKET_FORMATS = {
+    'day': ('%Y-%m-%d', 'YYYY-MM-DD'),
+    'month': ('%Y-%m', 'YYYY-MM'),
+}
+
+def dialect_name():
+    return db.engine.dialect.name
+
+def upsert_insert(table):
+    """INSERT с поддержкой on_conflict_do_update для текущей СУБД"""
+    if dialect_name() == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+def date_bucket(column, interval='month'):
+    """Строковый ключ периода ('YYYY-MM' или 'YYYY-MM-DD') для группировки по дате"""
+    sqlite_format, postgresql_format = DATE_BUCKET_FORMATS[interval]
+    if dialect_name() == 'postgresql':
+        # Литералы, а не параметры: иначе PostgreSQL не сочтёт выражение в SELECT
+        # и в GROUP BY одним и тем же
+        return db.func.to_char(
+            db.func.date_trunc(db.literal_column(f"'{interval}'"), column),
+            db.literal_column(f"'{postgresql_format}'")
+        )
+    return db.func.strftime(sqlite_format, column)
+
+def text_contains(column, value):
+    """Поиск подстроки без учёта регистра, в том числе для кириллицы"""
+    if dialect_name() == 'sqlite':
+        # Встроенные lower() и LIKE в SQLite складывают регистр только у ASCII;
+        # unicode_lower регистрируется на каждом соединении в _sqlite_connect
+        return db.func.unicode_lower(column).like(f'%{value.lower()}%')
+    return column.ilike(f'%{value}%')
+
+# ============ АРХИВ ============
+# Транзакции закрытых лет переезжают из transaction в архив и больше не участвуют
+# в сканах и индексах горячей таблицы. Помесячные итоги и строки журнала остаются
+# в основной базе, поэтому тренды, годовые суммы и балансы их не теряют. Запросы
+# с явным периодом (лента, выгрузка, края периода в rollup_totals) читают архив,
+# только если период заходит в архивные годы.
+
+# Текущий и прошлый год не архивируются: их читают напрямую из transaction
+# дашборд (тренды за полгода), советы и AI-анализ
+ARCHIVE_MIN_YEARS_BACK = 2
+
+def archive_database_file(database_file):
+    """Файл архива рядом с базой SQLite: budget.db → budget-archive.db"""
+    return os.path.splitext(database_file)[0] + '-archive.db'
+
+def archive_available():
+    return dialect_name() == 'postgresql' or sqlite_database_file() is not None
+
+def ensure_archive_table():
+    """
+    Создаёт таблицу архива, если её нет: файл архива живёт отдельно от базы
+    и может отсутствовать (например, базу перенесли без него)
+    """
+    if dialect_name() == 'postgresql':
+        with db.engine.begin() as connection:
+            connection.execute(db.text(f'CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}'))
+    ARCHIVE_METADATA.create_all(db.engine)
+
+def archive_boundary():
+    """Первый день после последнего архивного года или None, если архив пуст"""
+    year = db.session.query(db.func.max(ArchivedYear.year)).scalar()
+    return date(year + 1, 1, 1) if year else None
+
+def transaction_sources(start_date=None):
+    """
+    Таблицы транзакций для периода с start_date (None — без нижней границы):
+    transaction и архив, если период заходит в архивные годы.
+    """
+    sources = [Transaction.__table__]
+    boundary = archive_boundary()
+    if boundary and (start_date is None or start_date < boundary):
+        sources.append(archived_transactions)
+    return sources
+
+def transactions_union(sources):
+    """Таблица или UNION ALL нескольких таблиц транзакций как один источник с колонками transaction"""
+    if len(sources) == 1:
+        return sources[0]
+    return db.union_all(*[db.select(source) for source in sources]).subquery('all_transactions')
+
+def archive_year(year):
+    """
+    Переносит в архив все транзакции по конец года year. Сначала замораживает
+    помесячные итоги этих месяцев — пересчитывает их по transaction и архиву, —
+    затем переносит строки; всё в одной транзакции. Журнал проводок и балансы
+    не меняются. Возвращает {год: перенесено строк}.
+    """
+    if not archive_available():
+        raise ValueError('Архив доступен только для файла SQLite и PostgreSQL')
+    last_year = date.today().year - ARCHIVE_MIN_YEARS_BACK
+    if year > last_year:
+        raise ValueError(f'Архивировать можно годы не позже {last_year}')
+    
+    ensure_archive_table()
+    lock_for_write()
+    boundary = date(year + 1, 1, 1)
+    table = Transaction.__table__
+    moving = table.c.date < boundary
+    
+    refresh_monthly_rollup(before=boundary)
+    
+    month = date_bucket(table.c.date)
+    moved = {}
+    for bucket, count in db.session.query(month, db.func.count()).filter(moving).group_by(month):
+        moved[int(bucket[:4])] = moved.get(int(bucket[:4]), 0) + count
+    
+    # Повторный перенос (после сбоя между файлами SQLite) не дублирует строки:
+    # при совпадении id верна строка из transaction
+    columns = [column.name for column in table.columns]
+    insert = upsert_insert(archived_transactions).from_select(
+        columns, db.select(*[table.c[name] for name in columns]).where(moving)
+    )
+    db.session.execute(insert.on_conflict_do_update(
+        index_elements=['id'],
+        set_={name: insert.excluded[name] for name in columns if name != 'id'}
+    ))
+    db.session.execute(table.delete().where(moving))
+    
+    moved.setdefault(year, 0)
+    for archived, rows in moved.items():
+        state = db.session.get(ArchivedYear, archived)
+        if state is None:
+            db.session.add(ArchivedYear(year=archived, rows=rows))
+        else:
+            state.rows += rows
+            state.archived_at = datetime.utcnow()
+    db.session.commit()
+    return moved
+
+def transaction_is_archived(id):
+    if archive_boundary() is None:
+        return False
+    return db.session.execute(
+        db.select(archived_transactions.c.id).where(archived_transactions.c.id == id)
+    ).first() is not None
+
+def reconcile_archive():
+    """Убирает из архива строки, которые снова есть в transaction (после восстановления снимка основной базы)"""
+    if archive_available():
+        ensure_archive_table()
+        db.session.execute(
+            archived_transactions.delete().where(archived_transactions.c.id.in_(db.select(Transaction.id)))
+        )
+        db.session.commit()
+
+# ============ ПОМЕСЯЧНЫЕ ИТОГИ ============
+# Ключ итогов: (месяц, тип, категория, магазин, счёт, бизнес-расход).
+# Отсутствующие категория/магазин/счёт хранятся как 0, чтобы ключ был уникальным.
+ROLLUP_KEY_FIELDS = ('month', 'type', 'category_id', 'store_id', 'account_id', 'is_business_expense')
+
+def _rollup_transaction_columns(source=None):
+    """Выражения над таблицей транзакций (по умолчанию transaction), соответствующие полям ключа итогов"""
+    source = Transaction.__table__ if source is None else source
+    return {
+        'month': date_bucket(source.c.date),
+        'type': source.c.type,
+        'category_id': db.func.coalesce(source.c.category_id, 0),
+        'store_id': db.func.coalesce(source.c.store_id, 0),
+        'account_id': db.func.coalesce(source.c.account_id, 0),
+        'is_business_expense': db.func.coalesce(source.c.is_business_expense, False),
+    }
+
+def _rollup_upsert():
+    table = MonthlyRollup.__table__
+    stmt = upsert_insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=list(ROLLUP_KEY_FIELDS),
+        set_={
+            'total': table.c.total + stmt.excluded.total,
+            'count': table.c.count + stmt.excluded.count
+        }
+    )
+
+def rollup_apply_many(rows):
+    """Прибавляет к итогам пачку строк {поля ключа, total, count} одним executemany"""
+    if rows:
+        db.session.execute(_rollup_upsert(), rows)
+        db.session.info['category_totals_changed'] = True
+
+def rollup_apply(key, amount, count):
+    """Атомарно прибавляет сумму и количество к строке итогов (создаёт её при отсутствии)"""
+    table = MonthlyRollup.__table__
+    db.session.execute(_rollup_upsert().values(total=amount, count=count, **key))
+    db.session.info['category_totals_changed'] = True
+    
+    if count < 0:
+        db.session.execute(table.delete().where(
+            *[table.c[field] == value for field, value in key.items()],
+            table.c.count <= 0
+        ))
+
+def rollup_key(transaction):
+    """Ключ строки итогов для транзакции"""
+    return {
+        'month': transaction.date.strftime('%Y-%m'),
+        'type': transaction.type,
+        'category_id': transaction.category_id or 0,
+        'store_id': transaction.store_id or 0,
+        'account_id': transaction.account_id or 0,
+        'is_business_expense': bool(transaction.is_business_expense),
+    }
+
+def rollup_add(transaction, sign=1):
+    """Учитывает транзакцию в итогах (sign=-1 — убирает её)"""
+    if transaction.date is None:
+        return
+    rollup_apply(rollup_key(transaction), sign * transaction.amount, sign)
+
+def rollup_apply_query(criterion, sign=1, source=None, **overrides):
+    """
+    Учитывает в итогах все транзакции под условием criterion (для массовых
+    удалений и обновлений). source — таблица транзакций, к которой относится
+    criterion (по умолчанию transaction). overrides заменяют поля ключа,
+    например category_id=None при удалении категории.
+    """
+    source = Transaction.__table__ if source is None else source
+    columns = _rollup_transaction_columns(source)
+    rows = db.session.query(
+        *[columns[field].label(field) for field in ROLLUP_KEY_FIELDS],
+        db.func.sum(source.c.amount).label('total'),
+        db.func.count(source.c.id).label('count')
+    ).filter(
+        criterion,
+        source.c.date.isnot(None)
+    ).group_by(*[columns[field] for field in ROLLUP_KEY_FIELDS]).all()
+    
+    for row in rows:
+        key = {field: getattr(row, field) for field in ROLLUP_KEY_FIELDS}
+        for field, value in overrides.items():
+            key[field] = value or 0
+        key['is_business_expense'] = bool(key['is_business_expense'])
+        rollup_apply(key, sign * row.total, sign * row.count)
+
+def refresh_monthly_rollup(before=None):
+    """
+    Пересчитывает помесячные итоги по transaction и архиву без коммита:
+    целиком или только месяцы до даты before (начала месяца).
+    """
+    transactions = transactions_union(transaction_sources())
+    columns = _rollup_transaction_columns(transactions)
+    table = MonthlyRollup.__table__
+    
+    source = db.select(
+        *[columns[field] for field in ROLLUP_KEY_FIELDS],
+        db.func.sum(transactions.c.amount),
+        db.func.count(transactions.c.id)
+    ).where(
+        transactions.c.date.isnot(None)
+    ).group_by(*[columns[field] for field in ROLLUP_KEY_FIELDS])
+    
+    if before:
+        source = source.where(transactions.c.date < before)
+        db.session.execute(table.delete().where(table.c.month < before.strftime('%Y-%m')))
+    else:
+        db.session.execute(table.delete())
+    db.session.execute(table.insert().from_select(list(ROLLUP_KEY_FIELDS) + ['total', 'count'], source))
+
+def rebuild_monthly_rollup():
+    """Пересчитывает помесячные итоги целиком по transaction и архиву"""
+    refresh_monthly_rollup()
+    db.session.commit()
+
+def rollup_totals(group_by, start_date=None, end_date=None, **filters):
+    """
+    Суммы и количество транзакций за период [start_date, end_date], сгруппированные
+    по полям ключа итогов (group_by — имя поля или кортеж имён).
+    Полные месяцы берутся из MonthlyRollup, неполные края периода — из Transaction.
+    Возвращает {значение группы: (сумма, количество)}.
+    """
+    fields = (group_by,) if isinstance(group_by, str) else tuple(group_by)
+    
+    # Полные месяцы: [full_from, full_to) по началам месяцев
+    full_from = None
+    if start_date:
+        full_from = start_date if start_date.day == 1 else start_date.replace(day=1) + relativedelta(months=1)
+    full_to = (end_date + timedelta(days=1)).replace(day=1) if end_date else None
+    
+    raw_ranges = []
+    if full_from and full_to and full_from >= full_to:
+        raw_ranges.append((start_date, end_date))
+        full_from = full_to = None
+        use_rollup = False
+    else:
+        use_rollup = True
+        if start_date and start_date < full_from:
+            raw_ranges.append((start_date, min(full_from - timedelta(days=1), end_date or full_from)))
+        if end_date and end_date >= full_to:
+            raw_ranges.append((max(full_to, start_date or full_to), end_date))
+    
+    totals = {}
+    
+    def collect(rows):
+        for row in rows:
+            group = tuple(row[:len(fields)])
+            total, count = totals.get(group, (0, 0))
+            totals[group] = (total + (row.total or 0), count + row.count)
+    
+    if use_rollup:
+        query = db.session.query(
+            *[getattr(MonthlyRollup, field) for field in fields],
+            db.func.sum(MonthlyRollup.total).label('total'),
+            db.func.sum(MonthlyRollup.count).label('count')
+        )
+        if full_from:
+            query = query.filter(MonthlyRollup.month >= full_from.strftime('%Y-%m'))
+        if full_to:
+            query = query.filter(MonthlyRollup.month < full_to.strftime('%Y-%m'))
+        for field, value in filters.items():
+            query = query.filter(getattr(MonthlyRollup, field) == value)
+        collect(query.group_by(*[getattr(MonthlyRollup, field) for field in fields]).all())
+    
+    for range_start, range_end in raw_ranges:
+        for source in transaction_sources(range_start):
+            columns = _rollup_transaction_columns(source)
+            query = db.session.query(
+                *[columns[field] for field in fields],
+                db.func.sum(source.c.amount).label('total'),
+                db.func.count(source.c.id).label('count')
+            )
+            if range_start:
+                query = query.filter(source.c.date >= range_start)
+            if range_end:
+                query = query.filter(source.c.date <= range_end)
+            for field, value in filters.items():
+                query = query.filter(columns[field] == value)
+            collect(query.group_by(*[columns[field] for field in fields]).all())
+    
+    if len(fields) == 1:
+        return {group[0]: value for group, value in totals.items()}
+    return totals
+
+# Кэш сумм по категориям с начала месяца: общий для категорий, дашборда,
+# советов и достижений. Сбрасывается при коммите изменений транзакций в этом
+# процессе; для остальных воркеров устаревание ограничено TTL.
+CATEGORY_TOTALS_CACHE_TTL = 10
+_category_totals_cache = {}
+_category_totals_lock = threading.Lock()
+
+def get_month_category_totals():
+    """Суммы транзакций с начала месяца одним запросом: {(category_id, type): сумма}"""
+    month = date.today().strftime('%Y-%m')
+    now = time.monotonic()
+    
+    cached = _category_totals_cache.get(month)
+    if cached and now - cached[0] < CATEGORY_TOTALS_CACHE_TTL:
+        return cached[1]
+    
+    first_day = date.today().replace(day=1)
+    totals = {
+        group: total for group, (total, _) in rollup_totals(('category_id', 'type'), first_day).items()
+    }
+    
+    with _category_totals_lock:
+        _category_totals_cache.clear()
+        _category_totals_cache[month] = (now, totals)
+    return totals
+
+def invalidate_category_totals():
+    with _category_totals_lock:
+        _category_totals_cache.clear()
+
+@db.event.listens_for(db.session, 'after_commit')
+def _invalidate_caches_after_commit(session):
+    if session.info.pop('category_totals_changed', False):
+        invalidate_category_totals()
+
+# Отложенные до коммита флаги сессии: сбрасываются при откате
+SESSION_WRITE_FLAGS = ('category_totals_changed', 'achievement_events', 'achievement_counters')
+
+@db.event.listens_for(db.session, 'after_rollback')
+def _discard_session_flags_after_rollback(session):
+    for key in SESSION_WRITE_FLAGS:
+        session.info.pop(key, None)
+
+# ============ ПРОВОДКИ ============
+# Балансы и долги меняются только атомарными UPDATE ... SET x = x + :delta, без
+# чтения в Python: параллельные запросы разных воркеров не затирают изменения друг друга.
+
+@db.event.listens_for(Engine, 'connect')
+def _sqlite_connect(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    # pysqlite сам открывает транзакцию только перед DML; отключаем это,
+    # чтобы BEGIN выдавался в событии begin ниже
+    dbapi_connection.isolation_level = None
+    dbapi_connection.create_function(
+        'unicode_lower', 1, lambda value: value.lower() if isinstance(value, str) else value, deterministic=True
+    )
+    cursor = dbapi_connection.cursor()
+    # Архив закрытых лет — файл рядом с базой; присоединяется до PRAGMA, чтобы
+    # профиль (WAL, кэш, mmap) применился и к нему. У базы в памяти архива нет.
+    database_file = cursor.execute('PRAGMA database_list').fetchone()[2]
+    if database_file:
+        cursor.execute(f'ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}', (archive_database_file(database_file),))
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    if database_file:
+        # Кэш, mmap и synchronous задаются для каждой схемы отдельно
+        for name in ('synchronous', 'mmap_size', 'cache_size'):
+            cursor.execute(f'PRAGMA {ARCHIVE_SCHEMA}.{name} = {SQLITE_PRAGMAS[name]}')
+    cursor.close()
+
+@db.event.listens_for(Engine, 'begin')
+def _sqlite_begin(conn):
+    if conn.dialect.name == 'sqlite':
+        immediate = conn.get_execution_options().get('sqlite_begin_immediate')
+        conn.exec_driver_sql('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+
+# Ключ транзакционной advisory-блокировки писателя на PostgreSQL
+WRITE_LOCK_KEY = 7_305_001
+
+def lock_for_write():
+    """
+    Начинает пишущую транзакцию, сразу захватывая блокировку записи
+    (BEGIN IMMEDIATE на SQLite). Вызывается в начале маршрута до первого запроса.
+    На PostgreSQL писатели так же выстраиваются в очередь через
+    pg_advisory_xact_lock: проверки вида «прочитать и дописать» (дедупликация
+    импорта, контрольные точки балансов) рассчитаны на одного писателя.
+    
+    Повторный вызов в той же транзакции (обработчик внутри пачки очереди записи)
+    ничего не делает. Если транзакция уже открыта без блокировки, поднять её до
+    пишущей нельзя, и вызов падает с RuntimeError вместо того, чтобы молча
+    продолжить без блокировки.
+    """
+    session = db.session()
+    if session.info.get('write_locked'):
+        return
+    if session.in_transaction():
+        raise RuntimeError('lock_for_write() вызван после первого запроса транзакции')
+    connection = session.connection(execution_options={'sqlite_begin_immediate': True})
+    if connection.dialect.name == 'postgresql':
+        connection.execute(db.select(db.func.pg_advisory_xact_lock(WRITE_LOCK_KEY)))
+    session.info['write_locked'] = True
+
+@db.event.listens_for(db.session, 'after_transaction_end')
+def _release_write_lock(session, transaction):
+    # Блокировка живёт до конца внешней транзакции, SAVEPOINT её не снимает
+    if transaction.parent is None:
+        session.info.pop('write_locked', None)
+
+# ============ ЧТЕНИЕ ============
+_read_engine = None
+_read_engine_lock = threading.Lock()
+
+def read_engine():
+    """Движок только для чтения (создаётся при первом GET в процессе) или None, если отключён"""
+    global _read_engine
+    if _read_engine is None and DATABASE_READ_URL:
+        with _read_engine_lock:
+            if _read_engine is None:
+                options = dict(READ_ENGINE_OPTIONS)
+                if DATABASE_READ_URL.startswith('sqlite'):
+                    options['connect_args'] = {'timeout': SQLITE_PRAGMAS['busy_timeout'] / 1000}
+                engine = create_engine(DATABASE_READ_URL, **options)
+                db.event.listen(engine, 'connect', _read_only_connect)
+                _read_engine = engine
+    return _read_engine
+
+def _read_only_connect(dbapi_connection, connection_record):
+    # Вторая защита поверх mode=ro: запрос на запись упадёт, а не пройдёт молча
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute('PRAGMA query_only = 1')
+
+@app.before_request
+def _route_reads_to_read_engine():
+    if request.method in ('GET', 'HEAD') and read_engine() is not None:
+        db.session.info['read_only'] = True
+
+# ============ ОЧЕРЕДЬ ЗАПИСИ ============
+# SQLite пропускает одного писателя за раз. С DB_WRITE_QUEUE=1 мутирующие маршруты
+# не конкурируют за блокировку, а ставятся в очередь потока-писателя процесса: он
+# забирает всё накопившееся (до WRITE_QUEUE_MAX_BATCH), выполняет каждый обработчик
+# в своём SAVEPOINT и фиксирует пачку одним коммитом. Вызвавший поток ждёт Future.
+
+_write_queue = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+
+def serialized_write(view):
+    """Декоратор мутирующего маршрута: при включённой очереди выполняет его в потоке-писателе"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not WRITE_QUEUE_ENABLED:
+            return view(*args, **kwargs)
+        
+        future = Future()
+        _write_queue.put((copy_current_request_context(view), args, kwargs, future))
+        start_writer_thread()
+        return future.result()
+    return wrapper
+
+def start_writer_thread():
+    """Запускает поток-писатель при первой записи (после fork воркера gunicorn)"""
+    global _writer_thread
+    if _writer_thread is not None and _writer_thread.is_alive():
+        return
+    with _writer_lock:
+        if _writer_thread is None or not _writer_thread.is_alive():
+            _writer_thread = threading.Thread(target=_writer_loop, name='db-writer', daemon=True)
+            _writer_thread.start()
+
+def _writer_loop():
+    while True:
+        batch = [_write_queue.get()]
+        while len(batch) < WRITE_QUEUE_MAX_BATCH:
+            try:
+                batch.append(_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        with app.app_context():
+            run_write_batch(batch)
+
+def run_write_batch(batch):
+    """
+    Выполняет пачку обработчиков в одной транзакции. Ошибка обработчика откатывает
+    только его SAVEPOINT и возвращается его вызывающему; ошибка общего коммита —
+    всем вызывающим пачки.
+    """
+    session = db.session()
+    outcomes = []
+    try:
+        lock_for_write()
+        for view, args, kwargs, future in batch:
+            flags = {key: copy.deepcopy(session.info.get(key)) for key in SESSION_WRITE_FLAGS}
+            session.info['write_savepoint'] = session.begin_nested()
+            try:
+                result = view(*args, **kwargs)
+                session.info['write_savepoint'].commit()
+                outcomes.append((future, result, None))
+            except Exception as e:
+                session.info['write_savepoint'].rollback()
+                for key, value in flags.items():
+                    session.info.pop(key, None)
+                    if value is not None:
+                        session.info[key] = value
+                outcomes.append((future, None, e))
+            finally:
+                session.info.pop('write_savepoint', None)
+        session.commit()
+    except Exception as e:
+        session.info.pop('write_savepoint', None)
+        session.rollback()
+        for _, _, _, future in batch:
+            future.set_exception(e)
+        return
+    
+    for future, result, error in outcomes:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+def post_balance(account_id, delta):
+    """Атомарно меняет баланс счёта на delta"""
+    if not account_id or not delta:
+        return
+    Account.query.filter_by(id=account_id).update(
+        {'balance': Account.balance + delta}, synchronize_session=False
+    )
+    note_achievement_events('balance')
+
+def post_card_debt(account_id, delta):
+    """Атомарно меняет долг кредитной карты счёта на delta; долг не уходит ниже нуля"""
+    if not account_id or not delta:
+        return
+    new_debt = CreditCard.current_debt + delta
+    CreditCard.query.filter_by(account_id=account_id).update(
+        {'current_debt': db.case((new_debt < 0, 0), else_=new_debt)}, synchronize_session=False
+    )
+    note_achievement_events('debt')
+
+# ============ ЖУРНАЛ ============
+# Источник истины для балансов — строки журнала; Account.balance — их кэшированная
+# проекция, которая меняется теми же проводками. Контрольные точки на концы месяцев
+# позволяют считать баланс на дату и пересобирать проекцию по строкам после точки.
+
+def transaction_lines(transaction, account_types):
+    """Строки журнала транзакции: [(книга, ref_id, сумма)]"""
+    amount = transaction.amount
+    if transaction.type == 'income':
+        return [('account', transaction.account_id, amount), ('income', transaction.category_id, -amount)]
+    if transaction.type == 'expense':
+        return [('account', transaction.account_id, -amount), ('expense', transaction.category_id, amount)]
+    if transaction.type == 'transfer' and transaction.to_account_id:
+        to_type = account_types.get(transaction.to_account_id)
+        if to_type == 'credit_card':
+            target = ('card_debt', transaction.to_account_id, amount)
+        elif to_type is not None:
+            target = ('account', transaction.to_account_id, amount)
+        else:
+            target = ('external', None, amount)
+        return [('account', transaction.account_id, -amount), target]
+    return []
+
+def credit_payment_lines(payment):
+    """Строки журнала платежа по кредиту: тело, проценты и прочее против внешних денег"""
+    principal = payment.principal or 0
+    interest = payment.interest or 0
+    return [
+        ('credit', payment.credit_id, principal),
+        ('interest', payment.credit_id, interest),
+        ('credit_other', payment.credit_id, payment.amount - principal - interest),
+        ('external', None, -payment.amount),
+    ]
+
+def investment_transaction_lines(trans):
+    """Строки журнала операции с инвестицией"""
+    total = trans.total_amount
+    commission = trans.commission or 0
+    if trans.transaction_type == 'buy':
+        return [('investment', trans.investment_id, total), ('commission', trans.investment_id, commission),
+                ('external', None, -total - commission)]
+    if trans.transaction_type == 'sell':
+        return [('investment', trans.investment_id, -total), ('commission', trans.investment_id, commission),
+                ('external', None, total - commission)]
+    if trans.transaction_type == 'dividend':
+        return [('dividend', trans.investment_id, -total), ('tax', trans.investment_id, commission),
+                ('external', None, total - commission)]
+    return []
+
+def _journal_rows(source, source_id, entry_date, lines):
+    if abs(sum(amount for _, _, amount in lines)) > 0.005:
+        raise ValueError(f'Несбалансированная проводка {source} #{source_id}')
+    return [
+        {'source': source, 'source_id': source_id, 'date': entry_date,
+         'ledger': ledger, 'ref_id': ref_id, 'amount': amount}
+        for ledger, ref_id, amount in lines if amount
+    ]
+
+def invalidate_checkpoints(account_id, since):
+    """Удаляет контрольные точки счёта, которые задевает изменение строк журнала от даты since"""
+    BalanceCheckpoint.query.filter(
+        BalanceCheckpoint.account_id == account_id,
+        BalanceCheckpoint.date >= since
+    ).delete(synchronize_session=False)
+
+def post_entry(source, source_id, entry_date, lines):
+    """Записывает проводку в журнал и проводит её строки по счетам в Account.balance"""
+    rows = _journal_rows(source, source_id, entry_date, lines)
+    if not rows:
+        return
+    db.session.execute(db.insert(JournalLine), rows)
+    for row in rows:
+        if row['ledger'] == 'account':
+            post_balance(row['ref_id'], row['amount'])
+            invalidate_checkpoints(row['ref_id'], entry_date)
+
+def unpost_entries(source, source_ids):
+    """
+    Удаляет проводки источников (список id или подзапрос) из журнала,
+    откатывая их влияние на балансы счетов.
+    """
+    criterion = (JournalLine.source == source) & JournalLine.source_id.in_(source_ids)
+    effects = db.session.query(
+        JournalLine.ref_id,
+        db.func.sum(JournalLine.amount),
+        db.func.min(JournalLine.date)
+    ).filter(criterion, JournalLine.ledger == 'account').group_by(JournalLine.ref_id).all()
+    
+    for account_id, total, first_date in effects:
+        post_balance(account_id, -total)
+        invalidate_checkpoints(account_id, first_date)
+    JournalLine.query.filter(criterion).delete(synchronize_session=False)
+
+def post_adjustment(account_id, delta, entry_date=None):
+    """Ручная корректировка баланса счёта против капитала (начальный баланс, правка)"""
+    post_entry('adjustment', account_id, entry_date or date.today(),
+               [('account', account_id, delta), ('equity', account_id, -delta)])
+
+def post_credit_payment(payment):
+    if payment.id is None:
+        db.session.flush()
+    post_entry('credit_payment', payment.id, payment.date, credit_payment_lines(payment))
+
+def post_investment_transaction(trans):
+    if trans.id is None:
+        db.session.flush()
+    post_entry('investment_transaction', trans.id, trans.date, investment_transaction_lines(trans))
+
+def post_transaction(transaction, sign=1):
+    """
+    Проводит транзакцию по журналу, балансам счетов и долгам кредитных карт;
+    sign=-1 отменяет ранее проведённую транзакцию.
+    """
+    account_types = dict(db.session.query(Account.id, Account.account_type).filter(
+        Account.id.in_([transaction.account_id, transaction.to_account_id])
+    ).all())
+    
+    if sign > 0:
+        if transaction.id is None:
+            db.session.flush()
+        post_entry('transaction', transaction.id, transaction.date, transaction_lines(transaction, account_types))
+    else:
+        unpost_entries('transaction', [transaction.id])
+    
+    for account_id, delta in card_debt_effects(transaction, account_types):
+        post_card_debt(account_id, sign * delta)
+
+def card_debt_effects(transaction, account_types):
+    """
+    Изменения долга кредитных карт от транзакции: [(account_id, delta)].
+    Долг — отдельная проекция с отсечкой на нуле, в журнал не входит.
+    """
+    effects = []
+    from_card = account_types.get(transaction.account_id) == 'credit_card'
+    if transaction.type == 'expense' and from_card:
+        effects.append((transaction.account_id, transaction.amount))
+    elif transaction.type == 'transfer' and transaction.to_account_id:
+        if from_card:
+            effects.append((transaction.account_id, transaction.amount))
+        if account_types.get(transaction.to_account_id) == 'credit_card':
+            effects.append((transaction.to_account_id, -transaction.amount))
+    return effects
+
+def drop_account_journal(account_id, transaction_ids):
+    """
+    Убирает из журнала удаляемый счёт вместе с его транзакциями. Строки этих транзакций
+    по другим счетам становятся корректировками: их балансы, как и раньше, не меняются.
+    """
+    criterion = (JournalLine.source == 'transaction') & JournalLine.source_id.in_(transaction_ids)
+    kept = (JournalLine.ledger == 'account') & (JournalLine.ref_id != account_id)
+    
+    db.session.execute(db.insert(JournalLine).from_select(
+        ['source', 'source_id', 'date', 'ledger', 'ref_id', 'amount'],
+        db.select(
+            db.literal('adjustment'), JournalLine.ref_id, JournalLine.date,
+            db.literal('equity'), JournalLine.ref_id, -JournalLine.amount
+        ).where(criterion, kept)
+    ))
+    JournalLine.query.filter(criterion, kept).update(
+        {'source': 'adjustment', 'source_id': JournalLine.ref_id}, synchronize_session=False
+    )
+    JournalLine.query.filter(criterion).delete(synchronize_session=False)
+    JournalLine.query.filter_by(source='adjustment', source_id=account_id).delete(synchronize_session=False)
+    BalanceCheckpoint.query.filter_by(account_id=account_id).delete(synchronize_session=False)
+
+def account_balance_at(account_id, day=None):
+    """Баланс счёта на конец дня day (None — с учётом всех строк): точка + строки после неё"""
+    checkpoint = BalanceCheckpoint.query.filter(BalanceCheckpoint.account_id == account_id)
+    if day:
+        checkpoint = checkpoint.filter(BalanceCheckpoint.date <= day)
+    checkpoint = checkpoint.order_by(BalanceCheckpoint.date.desc()).first()
+    
+    query = db.session.query(db.func.sum(JournalLine.amount)).filter(
+        JournalLine.ledger == 'account',
+        JournalLine.ref_id == account_id
+    )
+    if checkpoint:
+        query = query.filter(JournalLine.date > checkpoint.date)
+    if day:
+        query = query.filter(JournalLine.date <= day)
+    return (checkpoint.balance if checkpoint else 0) + (query.scalar() or 0)
+
+def checkpoint_balances(until=None):
+    """
+    Дописывает контрольные точки балансов на концы месяцев (по умолчанию — до конца
+    прошлого месяца) по строкам журнала после последней точки каждого счёта.
+    """
+    until = until or date.today().replace(day=1) - timedelta(days=1)
+    
+    month = date_bucket(JournalLine.date)
+    created = 0
+    for (account_id,) in db.session.query(Account.id).all():
+        previous = BalanceCheckpoint.query.filter_by(account_id=account_id).order_by(
+            BalanceCheckpoint.date.desc()
+        ).first()
+        balance = previous.balance if previous else 0
+        query = db.session.query(month, db.func.sum(JournalLine.amount)).filter(
+            JournalLine.ledger == 'account',
+            JournalLine.ref_id == account_id,
+            JournalLine.date <= until
+        )
+        if previous:
+            query = query.filter(JournalLine.date > previous.date)
+        
+        for month_key, total in query.group_by(month).order_by(month).all():
+            balance += total
+            month_end = datetime.strptime(month_key, '%Y-%m').date() + relativedelta(months=1, days=-1)
+            db.session.add(BalanceCheckpoint(account_id=account_id, date=month_end, balance=balance))
+            created += 1
+    return created
+
+JOURNAL_REBUILD_CHUNK_SIZE = 1000
+
+def iter_journal_source_rows(account_types):
+    """
+    Строки журнала по транзакциям (с архивом), платежам по кредитам и операциям
+    с инвестициями. Источники читаются через yield_per, в памяти — одна пачка.
+    """
+    for source in transaction_sources():
+        statement = db.select(source).execution_options(yield_per=JOURNAL_REBUILD_CHUNK_SIZE)
+        for t in db.session.execute(statement):
+            yield from _journal_rows('transaction', t.id, t.date, transaction_lines(t, account_types))
+    for p in CreditPayment.query.yield_per(JOURNAL_REBUILD_CHUNK_SIZE):
+        yield from _journal_rows('credit_payment', p.id, p.date, credit_payment_lines(p))
+    for trans in InvestmentTransaction.query.yield_per(JOURNAL_REBUILD_CHUNK_SIZE):
+        yield from _journal_rows('investment_transaction', trans.id, trans.date, investment_transaction_lines(trans))
+
+def rebuild_journal():
+    """
+    Заново строит журнал по транзакциям, платежам по кредитам и операциям с инвестициями.
+    Корректировки сохраняются; при первом построении расхождение с текущими балансами
+    фиксируется вступительными корректировками. Account.balance не меняется.
+    Строки пишутся пачками по JOURNAL_REBUILD_CHUNK_SIZE по мере чтения источников,
+    так что память не растёт с размером журнала.
+    """
+    first_build = JournalLine.query.first() is None
+    JournalLine.query.filter(JournalLine.source != 'adjustment').delete(synchronize_session=False)
+    BalanceCheckpoint.query.delete(synchronize_session=False)
+    
+    account_types = dict(db.session.query(Account.id, Account.account_type).all())
+    # Сумма и первая дата строк по каждому счёту — для вступительных корректировок
+    posted = {}
+    chunk = []
+    for row in iter_journal_source_rows(account_types):
+        if row['ledger'] == 'account':
+            total, first_date = posted.get(row['ref_id'], (0, row['date']))
+            posted[row['ref_id']] = (total + row['amount'], min(first_date, row['date']))
+        chunk.append(row)
+        if len(chunk) >= JOURNAL_REBUILD_CHUNK_SIZE:
+            db.session.execute(db.insert(JournalLine), chunk)
+            chunk = []
+    
+    if first_build:
+        # Вступительный баланс — на день раньше первой строки счёта
+        for account in Account.query.all():
+            total, first_date = posted.get(account.id, (0, date.today() + timedelta(days=1)))
+            opening = (account.balance or 0) - total
+            if abs(opening) > 1e-9:
+                chunk.extend(_journal_rows('adjustment', account.id, first_date - timedelta(days=1),
+                                           [('account', account.id, opening), ('equity', account.id, -opening)]))
+    
+    if chunk:
+        db.session.execute(db.insert(JournalLine), chunk)
+    checkpoint_balances()
+    db.session.commit()
+
+def rebuild_account_balances():
+    """Пересчитывает проекцию Account.balance по журналу; возвращает {id: (было, стало)}"""
+    drift = {}
+    for account in Account.query.all():
+        balance = account_balance_at(account.id)
+        if abs((account.balance or 0) - balance) > 0.005:
+            drift[account.id] = (account.balance, balance)
+        account.balance = balance
+    db.session.commit()
+    return drift
+
 # ============ API ROUTES ============
 
 # --- Счета ---
@@ -322,6 +1444,47 @@ def get_accounts():
     accounts = query.order_by(Account.account_type, Account.name).all()
     result = []
     
+    # Данные для обогащения счетов — по одному запросу на вид, а не на каждый счёт
+    credit_card_ids = [a.id for a in accounts if a.account_type == 'credit_card']
+    investment_ids = [a.id for a in accounts if a.is_investment]
+    business_ids = [a.id for a in accounts if a.is_business]
+    tax_reserve_ids = [a.id for a in accounts if a.is_tax_reserve]
+    
+    cards = {}
+    if credit_card_ids:
+        for card in CreditCard.query.filter(
+            CreditCard.account_id.in_(credit_card_ids)
+        ).order_by(CreditCard.id).all():
+            cards.setdefault(card.account_id, card)
+    
+    investment_totals = {}
+    if investment_ids:
+        investment_totals = {row.account_id: row for row in db.session.query(
+            Investment.account_id,
+            db.func.sum(Investment.quantity * Investment.avg_buy_price).label('invested'),
+            db.func.sum(Investment.quantity * Investment.current_price).label('current'),
+            db.func.count(Investment.id).label('count')
+        ).filter(
+            Investment.account_id.in_(investment_ids)
+        ).group_by(Investment.account_id).all()}
+    
+    pending_taxes = {}
+    if business_ids:
+        pending_taxes = dict(db.session.query(
+            TaxReserve.business_account_id,
+            db.func.sum(TaxReserve.tax_amount)
+        ).filter(
+            TaxReserve.business_account_id.in_(business_ids),
+            TaxReserve.is_transferred == False
+        ).group_by(TaxReserve.business_account_id).all())
+    
+    linked_accounts = {}
+    if tax_reserve_ids:
+        for la in Account.query.filter(
+            Account.linked_tax_account_id.in_(tax_reserve_ids)
+        ).order_by(Account.id).all():
+            linked_accounts.setdefault(la.linked_tax_account_id, []).append(la)
+    
     for a in accounts:
         data = {
             'id': a.id,
@@ -341,7 +1504,7 @@ def get_accounts():
         }
         
         if a.account_type == 'credit_card':
-            card = CreditCard.query.filter_by(account_id=a.id).first()
+            card = cards.get(a.id)
             if card:
                 data['credit_limit'] = card.credit_limit
                 data['current_debt'] = card.current_debt
@@ -357,33 +1520,30 @@ def get_accounts():
                 data['balance'] = -card.current_debt
         
         if a.is_investment:
-            investments = Investment.query.filter_by(account_id=a.id).all()
-            total_invested = sum(i.quantity * i.avg_buy_price for i in investments)
-            total_current = sum(i.quantity * i.current_price for i in investments)
+            totals = investment_totals.get(a.id)
+            total_invested = totals.invested if totals else 0
+            total_current = totals.current if totals else 0
             data['total_invested'] = total_invested
             data['total_current_value'] = total_current
             data['total_profit'] = total_current - total_invested
             data['total_profit_percent'] = round(((total_current - total_invested) / total_invested) * 100, 2) if total_invested > 0 else 0
-            data['investments_count'] = len(investments)
+            data['investments_count'] = totals.count if totals else 0
         
         if a.is_business:
-            reserves = TaxReserve.query.filter_by(
-                business_account_id=a.id,
-                is_transferred=False
-            ).all()
-            data['pending_tax'] = sum(r.tax_amount for r in reserves)
+            data['pending_tax'] = pending_taxes.get(a.id, 0)
         
         if a.is_tax_reserve:
-            linked_accounts = Account.query.filter_by(linked_tax_account_id=a.id).all()
-            data['linked_business_accounts'] = [{'id': la.id, 'name': la.name} for la in linked_accounts]
+            data['linked_business_accounts'] = [{'id': la.id, 'name': la.name} for la in linked_accounts.get(a.id, [])]
         
         result.append(data)
     
     return jsonify(result)
 
 @app.route('/api/accounts', methods=['POST'])
+@serialized_write
 def create_account():
     data = request.json
+    lock_for_write()
     
     account_type = data.get('account_type', 'debit')
     is_tax_reserve = account_type == 'tax_reserve'
@@ -393,7 +1553,7 @@ def create_account():
     account = Account(
         name=data['name'],
         account_type=account_type,
-        balance=data.get('balance', 0),
+        balance=0,
         credit_limit=data.get('credit_limit', 0),
         icon=data.get('icon', '💳'),
         color=data.get('color', '#667eea'),
@@ -406,7 +1566,9 @@ def create_account():
         is_tax_reserve=is_tax_reserve
     )
     db.session.add(account)
-    db.session.commit()
+    db.session.flush()
+    # Начальный баланс — корректировка в журнале
+    post_adjustment(account.id, data.get('balance', 0))
     
     if account_type == 'credit_card':
         card = CreditCard(
@@ -421,18 +1583,22 @@ def create_account():
             cashback_percent=data.get('cashback_percent', 0)
         )
         db.session.add(card)
-        db.session.commit()
     
+    db.session.commit()
     return jsonify({'id': account.id, 'message': 'Счёт создан'}), 201
 
 @app.route('/api/accounts/<int:id>', methods=['PUT'])
+@serialized_write
 def update_account(id):
+    lock_for_write()
     account = Account.query.get_or_404(id)
     data = request.json
     
+    if data.get('balance') is not None:
+        post_adjustment(id, data['balance'] - (account.balance or 0))
+    
     account.name = data.get('name', account.name)
     account.account_type = data.get('account_type', account.account_type)
-    account.balance = data.get('balance', account.balance)
     account.credit_limit = data.get('credit_limit', account.credit_limit)
     account.icon = data.get('icon', account.icon)
     account.color = data.get('color', account.color)
@@ -460,25 +1626,171 @@ def update_account(id):
     db.session.commit()
     return jsonify({'message': 'Счёт обновлён'})
 
-@app.route('/api/accounts/<int:id>', methods=['DELETE'])
-def delete_account(id):
-    account = Account.query.get_or_404(id)
-    
-    Transaction.query.filter(
-        (Transaction.account_id == id) | (Transaction.to_account_id == id)
+def delete_account_dependents(account_id):
+    """
+    Удаляет или отвязывает всё, что ссылается на счёт, чтобы его можно было удалить
+    при включённых внешних ключах. Вызывается под lock_for_write().
+    Возвращает False (ничего не удалив), если в счёт идёт импорт выписки.
+    """
+    if not delete_import_jobs(ImportJob.account_id == account_id):
+        return False
+    
+    for source in transaction_sources():
+        account_transactions = (source.c.account_id == account_id) | (source.c.to_account_id == account_id)
+        rollup_apply_query(account_transactions, -1, source)
+        drop_account_journal(account_id, db.select(source.c.id).where(account_transactions))
+        db.session.execute(source.delete().where(account_transactions))
+    
+    investment_ids = db.select(Investment.id).where(Investment.account_id == account_id)
+    unpost_entries('investment_transaction', db.select(InvestmentTransaction.id).where(
+        InvestmentTransaction.investment_id.in_(investment_ids)
+    ))
+    InvestmentTransaction.query.filter(
+        InvestmentTransaction.investment_id.in_(investment_ids)
     ).delete(synchronize_session=False)
-    CreditCard.query.filter_by(account_id=id).delete()
-    Investment.query.filter_by(account_id=id).delete()
+    Investment.query.filter_by(account_id=account_id).delete()
+    
+    CreditCard.query.filter_by(account_id=account_id).delete()
     TaxReserve.query.filter(
-        (TaxReserve.business_account_id == id) | (TaxReserve.tax_account_id == id)
+        (TaxReserve.business_account_id == account_id) | (TaxReserve.tax_account_id == account_id)
     ).delete(synchronize_session=False)
-    
-    Account.query.filter_by(linked_tax_account_id=id).update({'linked_tax_account_id': None})
+    Goal.query.filter_by(linked_account_id=account_id).update({'linked_account_id': None})
+    Account.query.filter_by(linked_tax_account_id=account_id).update({'linked_tax_account_id': None})
+    return True
+
+@app.route('/api/accounts/<int:id>', methods=['DELETE'])
+@serialized_write
+def delete_account(id):
+    lock_for_write()
+    account = Account.query.get_or_404(id)
+    if not delete_account_dependents(id):
+        return jsonify({'error': 'В счёт идёт импорт выписки, удалите его после завершения'}), 400
     
     db.session.delete(account)
     db.session.commit()
     return jsonify({'message': 'Счёт удалён'})
 
+@app.route('/api/accounts/<int:id>/balance', methods=['GET'])
+def get_account_balance(id):
+    account = Account.query.get_or_404(id)
+    day = request.args.get('date')
+    try:
+        day = datetime.strptime(day, '%Y-%m-%d').date() if day else date.today()
+    except ValueError:
+        return jsonify({'error': 'Некорректная дата'}), 400
+    
+    return jsonify({
+        'account_id': account.id,
+        'date': day.isoformat(),
+        'balance': round(account_balance_at(account.id, day), 2)
+    })
+
+STATEMENT_INTERVALS = ('day', 'month')
+
+@app.route('/api/accounts/<int:id>/statement', methods=['GET'])
+def get_account_statement(id):
+    """
+    Выписка по счёту: строки журнала по возрастанию (date, id) с остатком после
+    каждой, посчитанным в SQL через SUM() OVER. Страницы — по курсору ?after=,
+    ?interval=day|month добавляет прореженную кривую баланса за весь период.
+    """
+    account = Account.query.get_or_404(id)
+    per_page = min(max(1, request.args.get('per_page', 50, type=int)), 500)
+    interval = request.args.get('interval')
+    after = request.args.get('after')
+    
+    if interval and interval not in STATEMENT_INTERVALS:
+        return jsonify({'error': 'interval должен быть day или month'}), 400
+    try:
+        start_date = datetime.strptime(request.args['start_date'], '%Y-%m-%d').date() if request.args.get('start_date') else None
+        end_date = datetime.strptime(request.args['end_date'], '%Y-%m-%d').date() if request.args.get('end_date') else None
+    except ValueError:
+        return jsonify({'error': 'Некорректная дата'}), 400
+    
+    conditions = [JournalLine.ledger == 'account', JournalLine.ref_id == id]
+    if start_date:
+        conditions.append(JournalLine.date >= start_date)
+    if end_date:
+        conditions.append(JournalLine.date <= end_date)
+    
+    opening_balance = account_balance_at(id, start_date - timedelta(days=1)) if start_date else 0
+    closing_balance = account_balance_at(id, end_date)
+    
+    # Остаток перед страницей: баланс на конец предыдущего дня по контрольной
+    # точке + строки дня курсора до него включительно
+    page_conditions = list(conditions)
+    base_balance = opening_balance
+    if after:
+        try:
+            cursor_date, cursor_id = decode_transactions_cursor(after)
+        except ValueError:
+            return jsonify({'error': 'Некорректный курсор'}), 400
+        
+        same_day = db.session.query(db.func.sum(JournalLine.amount)).filter(
+            *conditions, JournalLine.date == cursor_date, JournalLine.id <= cursor_id
+        ).scalar() or 0
+        base_balance = account_balance_at(id, cursor_date - timedelta(days=1)) + same_day
+        page_conditions.append(JournalLine.date >= cursor_date)
+        page_conditions.append(db.or_(
+            JournalLine.date > cursor_date,
+            db.and_(JournalLine.date == cursor_date, JournalLine.id > cursor_id)
+        ))
+    
+    order = (JournalLine.date, JournalLine.id)
+    rows = db.session.execute(
+        db.select(
+            JournalLine.id,
+            JournalLine.date,
+            JournalLine.amount,
+            JournalLine.source,
+            JournalLine.source_id,
+            db.func.sum(JournalLine.amount).over(order_by=order).label('running')
+        ).where(*page_conditions).order_by(*order).limit(per_page + 1)
+    ).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    
+    transaction_ids = [row.source_id for row in rows if row.source == 'transaction']
+    transactions = {}
+    if transaction_ids:
+        for source in transaction_sources(start_date):
+            transactions.update({t.id: serialize_transaction(t) for t in db.session.execute(
+                transactions_list_select([source.c.id.in_(transaction_ids)], source)
+            ).all()})
+    
+    result = {
+        'account_id': account.id,
+        'start_date': start_date.isoformat() if start_date else None,
+        'end_date': end_date.isoformat() if end_date else None,
+        'opening_balance': round(opening_balance, 2),
+        'closing_balance': round(closing_balance, 2),
+        'entries': [{
+            'id': row.id,
+            'date': row.date.isoformat(),
+            'amount': row.amount,
+            'balance': round(base_balance + row.running, 2),
+            'source': row.source,
+            'transaction': transactions.get(row.source_id) if row.source == 'transaction' else None
+        } for row in rows],
+        'next_cursor': encode_transactions_cursor(rows[-1]) if has_more else None,
+        'has_more': has_more
+    }
+    
+    if interval:
+        # Баланс на конец каждого дня/месяца с движением — для графика
+        bucket = date_bucket(JournalLine.date, interval)
+        curve = db.session.execute(
+            db.select(
+                bucket.label('bucket'),
+                db.func.sum(db.func.sum(JournalLine.amount)).over(order_by=bucket).label('running')
+            ).where(*conditions).group_by(bucket).order_by(bucket)
+        ).all()
+        result['curve'] = [
+            {'date': row.bucket, 'balance': round(opening_balance + row.running, 2)} for row in curve
+        ]
+    
+    return jsonify(result)
+
 # --- Кредитные карты ---
 @app.route('/api/credit-cards', methods=['GET'])
 def get_credit_cards():
@@ -551,15 +1863,14 @@ def update_credit_card(id):
     return jsonify({'message': 'Кредитная карта обновлена'})
 
 @app.route('/api/credit-cards/<int:id>', methods=['DELETE'])
+@serialized_write
 def delete_credit_card(id):
+    lock_for_write()
     card = CreditCard.query.get_or_404(id)
     account_id = card.account_id
+    if not delete_account_dependents(account_id):
+        return jsonify({'error': 'В счёт идёт импорт выписки, удалите его после завершения'}), 400
     
-    Transaction.query.filter(
-        (Transaction.account_id == account_id) | (Transaction.to_account_id == account_id)
-    ).delete(synchronize_session=False)
-    
-    db.session.delete(card)
     account = Account.query.get(account_id)
     if account:
         db.session.delete(account)
@@ -568,16 +1879,15 @@ def delete_credit_card(id):
     return jsonify({'message': 'Кредитная карта удалена'})
 
 @app.route('/api/credit-cards/<int:id>/pay', methods=['POST'])
+@serialized_write
 def pay_credit_card(id):
+    lock_for_write()
     card = CreditCard.query.get_or_404(id)
     data = request.json
     amount = data['amount']
     from_account_id = data['from_account_id']
     
-    from_account = Account.query.get_or_404(from_account_id)
-    from_account.balance -= amount
-    
-    card.current_debt = max(0, card.current_debt - amount)
+    Account.query.get_or_404(from_account_id)
     
     transaction = Transaction(
         amount=amount,
@@ -588,6 +1898,8 @@ def pay_credit_card(id):
         date=date.today()
     )
     db.session.add(transaction)
+    post_transaction(transaction)
+    rollup_add(transaction)
     db.session.commit()
     
     return jsonify({
@@ -609,6 +1921,7 @@ def update_credit_limit(id):
     })
 
 @app.route('/api/credit-cards/<int:id>/update-debt', methods=['PUT'])
+@serialized_write
 def update_credit_debt(id):
     card = CreditCard.query.get_or_404(id)
     data = request.json
@@ -629,22 +1942,12 @@ def get_categories():
         query = query.filter_by(type=type_filter)
     categories = query.order_by(Category.name).all()
     
-    today = date.today()
-    first_day = today.replace(day=1)
+    month_totals = get_month_category_totals()
     
     result = []
     for c in categories:
-        spent = db.session.query(db.func.sum(Transaction.amount)).filter(
-            Transaction.category_id == c.id,
-            Transaction.date >= first_day,
-            Transaction.type == 'expense'
-        ).scalar() or 0
-        
-        earned = db.session.query(db.func.sum(Transaction.amount)).filter(
-            Transaction.category_id == c.id,
-            Transaction.date >= first_day,
-            Transaction.type == 'income'
-        ).scalar() or 0
+        spent = month_totals.get((c.id, 'expense')) or 0
+        earned = month_totals.get((c.id, 'income')) or 0
         
         result.append({
             'id': c.id,
@@ -689,19 +1992,43 @@ def update_category(id):
     return jsonify({'message': 'Категория обновлена'})
 
 @app.route('/api/categories/<int:id>', methods=['DELETE'])
+@serialized_write
 def delete_category(id):
-    Transaction.query.filter_by(category_id=id).update({'category_id': None})
+    lock_for_write()
+    for source in transaction_sources():
+        rollup_apply_query(source.c.category_id == id, -1, source)
+        rollup_apply_query(source.c.category_id == id, source=source, category_id=None)
+        db.session.execute(source.update().where(source.c.category_id == id).values(category_id=None))
     
     category = Category.query.get_or_404(id)
+    Category.query.filter_by(parent_id=id).update({'parent_id': None})
+    Budget.query.filter_by(category_id=id).delete()
     db.session.delete(category)
     db.session.commit()
     return jsonify({'message': 'Категория удалена'})
 
 # --- Транзакции ---
+def encode_transactions_cursor(transaction):
+    """Непрозрачный курсор на позицию (date, id) в ленте транзакций"""
+    raw = f'{transaction.date.isoformat()}:{transaction.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_transactions_cursor(cursor):
+    """Разбирает курсор в (date, id); ValueError при некорректном значении"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        cursor_date, cursor_id = raw.split(':')
+        return datetime.strptime(cursor_date, '%Y-%m-%d').date(), int(cursor_id)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise ValueError(cursor)
+
 @app.route('/api/transactions', methods=['GET'])
 def get_transactions():
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 50, type=int)
+    # Режим курсора: ?after= для первой страницы, далее ?after=<next_cursor>
+    after = request.args.get('after')
+    include_total = request.args.get('include_total', 'false') == 'true'
     type_filter = request.args.get('type')
     account_filter = request.args.get('account_id', type=int)
     category_filter = request.args.get('category_id', type=int)
@@ -710,60 +2037,233 @@ def get_transactions():
     end_date = request.args.get('end_date')
     search = request.args.get('search', '')
     
-    query = Transaction.query
+    filters = dict(
+        type_filter=type_filter, account_filter=account_filter, category_filter=category_filter,
+        store_filter=store_filter, start_date=start_date, end_date=end_date, search=search
+    )
+    
+    if after is not None:
+        return get_transactions_page_after(filters, after, per_page, include_total)
+    
+    # Те же правила, что у paginate(error_out=False)
+    current_page = max(page, 1)
+    if per_page < 1:
+        per_page = 20
+    
+    total = count_transactions(filters)
+    rows = fetch_feed_page(filters, per_page, (current_page - 1) * per_page)
+    
+    return jsonify({
+        'transactions': [serialize_transaction(t) for t in rows],
+        'total': total,
+        'pages': math.ceil(total / per_page) if total else 0,
+        'current_page': page
+    })
+
+def transaction_filter_conditions(type_filter=None, account_filter=None, category_filter=None,
+                                  store_filter=None, start_date=None, end_date=None, search='', source=None):
+    """
+    Условия WHERE для фильтров ленты транзакций (общие для списка и экспорта).
+    source — таблица транзакций: transaction (по умолчанию) или архив.
+    """
+    source = Transaction.__table__ if source is None else source
+    conditions = []
     
     if type_filter:
-        query = query.filter_by(type=type_filter)
+        conditions.append(source.c.type == type_filter)
     if account_filter:
-        query = query.filter(
-            (Transaction.account_id == account_filter) | 
-            (Transaction.to_account_id == account_filter)
+        conditions.append(
+            (source.c.account_id == account_filter) | 
+            (source.c.to_account_id == account_filter)
         )
     if category_filter:
-        query = query.filter_by(category_id=category_filter)
+        conditions.append(source.c.category_id == category_filter)
     if store_filter:
-        query = query.filter_by(store_id=store_filter)
+        conditions.append(source.c.store_id == store_filter)
     if start_date:
-        query = query.filter(Transaction.date >= datetime.strptime(start_date, '%Y-%m-%d').date())
+        conditions.append(source.c.date >= datetime.strptime(start_date, '%Y-%m-%d').date())
     if end_date:
-        query = query.filter(Transaction.date <= datetime.strptime(end_date, '%Y-%m-%d').date())
+        conditions.append(source.c.date <= datetime.strptime(end_date, '%Y-%m-%d').date())
     if search:
-        query = query.filter(Transaction.description.ilike(f'%{search}%'))
+        conditions.append(text_contains(source.c.description, search))
+    return conditions
+
+def transactions_list_select(conditions, source=None, descending=None):
+    """
+    Один SELECT с LEFT JOIN на счета, категорию и магазин: только колонки,
+    нужные ленте, без загрузки ORM-объектов и ленивых связей.
     
-    transactions = query.order_by(Transaction.date.desc(), Transaction.id.desc()).paginate(
-        page=page, per_page=per_page, error_out=False
+    descending=True/False упорядочивает по (date, id): у транзакций одного дня
+    id — явный последний ключ, без него порядок внутри дня не определён, и
+    страницы OFFSET и курсор ?after= могут пропускать или повторять строки.
+    Ключ совпадает с индексом (date, id), поэтому сортировка идёт по индексу.
+    """
+    source = Transaction.__table__ if source is None else source
+    account = db.aliased(Account)
+    to_account = db.aliased(Account)
+    
+    statement = db.select(
+        source.c.id.label('id'),
+        source.c.amount,
+        source.c.type,
+        source.c.description,
+        source.c.date.label('date'),
+        source.c.account_id,
+        account.name.label('account_name'),
+        account.icon.label('account_icon'),
+        source.c.category_id,
+        Category.name.label('category_name'),
+        Category.icon.label('category_icon'),
+        Category.color.label('category_color'),
+        source.c.to_account_id,
+        to_account.name.label('to_account_name'),
+        source.c.store_id,
+        Store.name.label('store_name'),
+        source.c.is_tax_transfer,
+        source.c.is_business_expense,
+        source.c.tags
+    ).select_from(source).outerjoin(
+        account, source.c.account_id == account.id
+    ).outerjoin(
+        Category, source.c.category_id == Category.id
+    ).outerjoin(
+        to_account, source.c.to_account_id == to_account.id
+    ).outerjoin(
+        Store, source.c.store_id == Store.id
+    ).where(*conditions)
+    if descending is None:
+        return statement
+    return statement.order_by(*feed_order((source.c.date, source.c.id), descending))
+
+def feed_order(columns, descending):
+    return [column.desc() for column in columns] if descending else list(columns)
+
+def feed_sources(filters):
+    """Таблицы транзакций для фильтров ленты: архив — только если start_date заходит в него"""
+    start_date = filters.get('start_date')
+    return transaction_sources(datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else None)
+
+def transactions_feed_select(filters, descending=True, extra_conditions=None, sources=None):
+    """
+    SELECT ленты по фильтрам transaction_filter_conditions, упорядоченный по (date, id).
+    Если период заходит в архивные годы, строки архива добавляются через UNION ALL.
+    extra_conditions(source) — дополнительные условия для каждой таблицы.
+    """
+    sources = feed_sources(filters) if sources is None else sources
+    
+    def source_conditions(source):
+        conditions = transaction_filter_conditions(**filters, source=source)
+        if extra_conditions:
+            conditions += extra_conditions(source)
+        return conditions
+    
+    if len(sources) == 1:
+        return transactions_list_select(source_conditions(sources[0]), sources[0], descending)
+    selects = [transactions_list_select(source_conditions(source), source) for source in sources]
+    # ORDER BY составного SELECT ссылается на имена колонок результата
+    statement = db.union_all(*selects)
+    return statement.order_by(
+        *feed_order((statement.selected_columns.date, statement.selected_columns.id), descending)
     )
+
+def fetch_feed_page(filters, limit, offset=0, extra_conditions=None):
+    """
+    Строки страницы ленты (date DESC, id DESC). Все строки новее границы архива
+    лежат в transaction и идут в ленте раньше архивных, поэтому сначала читаются
+    только они: страница, целиком попавшая в них, архив не трогает.
+    """
+    boundary = archive_boundary()
+    if boundary and len(feed_sources(filters)) > 1:
+        def recent_conditions(source):
+            return [source.c.date >= boundary] + (extra_conditions(source) if extra_conditions else [])
+        rows = db.session.execute(
+            transactions_feed_select(filters, extra_conditions=recent_conditions, sources=[Transaction.__table__])
+            .limit(limit).offset(offset)
+        ).all()
+        if len(rows) == limit:
+            return rows
     
-    return jsonify({
-        'transactions': [{
-            'id': t.id,
-            'amount': t.amount,
-            'type': t.type,
-            'description': t.description,
-            'date': t.date.isoformat(),
-            'account_id': t.account_id,
-            'account_name': t.account.name if t.account else None,
-            'account_icon': t.account.icon if t.account else None,
-            'category_id': t.category_id,
-            'category_name': t.category.name if t.category else None,
-            'category_icon': t.category.icon if t.category else None,
-            'category_color': t.category.color if t.category else None,
-            'to_account_id': t.to_account_id,
-            'to_account_name': t.to_account.name if t.to_account else None,
-            'store_id': t.store_id,
-            'store_name': t.store.name if t.store else None,
-            'is_tax_transfer': t.is_tax_transfer,
-            'is_business_expense': t.is_business_expense,
-            'tags': t.tags.split(',') if t.tags else []
-        } for t in transactions.items],
-        'total': transactions.total,
-        'pages': transactions.pages,
-        'current_page': page
-    })
+    return db.session.execute(
+        transactions_feed_select(filters, extra_conditions=extra_conditions).limit(limit).offset(offset)
+    ).all()
+
+def count_transactions(filters):
+    return sum(
+        db.session.execute(
+            db.select(db.func.count()).select_from(source)
+            .where(*transaction_filter_conditions(**filters, source=source))
+        ).scalar()
+        for source in feed_sources(filters)
+    )
+
+def get_transactions_page_after(filters, after, per_page, include_total=False):
+    """
+    Страница ленты по ключу (date, id) вместо OFFSET: время не зависит от глубины.
+    Общее количество считается только по запросу (include_total).
+    """
+    total = count_transactions(filters) if include_total else None
+    extra_conditions = None
+    
+    if after:
+        try:
+            cursor_date, cursor_id = decode_transactions_cursor(after)
+        except ValueError:
+            return jsonify({'error': 'Некорректный курсор'}), 400
+        
+        # Предикат совпадает с ORDER BY date DESC, id DESC; date <= cursor_date
+        # даёт планировщику границу диапазона по индексу (date, id)
+        def cursor_conditions(source):
+            return [
+                source.c.date <= cursor_date,
+                db.or_(
+                    source.c.date < cursor_date,
+                    db.and_(source.c.date == cursor_date, source.c.id < cursor_id)
+                )
+            ]
+        extra_conditions = cursor_conditions
+    
+    per_page = max(1, per_page)
+    rows = fetch_feed_page(filters, per_page + 1, extra_conditions=extra_conditions)
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    
+    result = {
+        'transactions': [serialize_transaction(t) for t in rows],
+        'next_cursor': encode_transactions_cursor(rows[-1]) if has_more else None,
+        'has_more': has_more
+    }
+    if include_total:
+        result['total'] = total
+    return jsonify(result)
+
+def serialize_transaction(t):
+    return {
+        'id': t.id,
+        'amount': t.amount,
+        'type': t.type,
+        'description': t.description,
+        'date': t.date.isoformat(),
+        'account_id': t.account_id,
+        'account_name': t.account_name,
+        'account_icon': t.account_icon,
+        'category_id': t.category_id,
+        'category_name': t.category_name,
+        'category_icon': t.category_icon,
+        'category_color': t.category_color,
+        'to_account_id': t.to_account_id,
+        'to_account_name': t.to_account_name,
+        'store_id': t.store_id,
+        'store_name': t.store_name,
+        'is_tax_transfer': t.is_tax_transfer,
+        'is_business_expense': t.is_business_expense,
+        'tags': t.tags.split(',') if t.tags else []
+    }
 
 @app.route('/api/transactions', methods=['POST'])
+@serialized_write
 def create_transaction():
     data = request.json
+    lock_for_write()
     
     transaction = Transaction(
         amount=data['amount'],
@@ -780,10 +2280,10 @@ def create_transaction():
     )
     
     account = Account.query.get(data['account_id'])
+    db.session.add(transaction)
+    post_transaction(transaction)
     
     if data['type'] == 'income':
-        account.balance += data['amount']
-        
         if account.is_business and account.tax_rate > 0 and account.linked_tax_account_id:
             tax_amount = data['amount'] * account.tax_rate / 100
             
@@ -800,9 +2300,6 @@ def create_transaction():
             
             tax_account = Account.query.get(account.linked_tax_account_id)
             if tax_account:
-                account.balance -= tax_amount
-                tax_account.balance += tax_amount
-                
                 tax_transfer = Transaction(
                     amount=tax_amount,
                     type='transfer',
@@ -813,31 +2310,10 @@ def create_transaction():
                     date=transaction.date
                 )
                 db.session.add(tax_transfer)
+                post_transaction(tax_transfer)
+                rollup_add(tax_transfer)
             
-    elif data['type'] == 'expense':
-        account.balance -= data['amount']
-        
-        if account.account_type == 'credit_card':
-            card = CreditCard.query.filter_by(account_id=account.id).first()
-            if card:
-                card.current_debt += data['amount']
-                
     elif data['type'] == 'transfer' and data.get('to_account_id'):
-        account.balance -= data['amount']
-        to_account = Account.query.get(data['to_account_id'])
-        
-        if account.account_type == 'credit_card':
-            card = CreditCard.query.filter_by(account_id=account.id).first()
-            if card:
-                card.current_debt += data['amount']
-        
-        if to_account.account_type == 'credit_card':
-            to_card = CreditCard.query.filter_by(account_id=to_account.id).first()
-            if to_card:
-                to_card.current_debt = max(0, to_card.current_debt - data['amount'])
-        else:
-            to_account.balance += data['amount']
-        
         if data.get('is_tax_transfer'):
             TaxReserve.query.filter_by(
                 business_account_id=data['account_id'],
@@ -845,43 +2321,536 @@ def create_transaction():
                 is_transferred=False
             ).update({'is_transferred': True})
     
-    db.session.add(transaction)
+    rollup_add(transaction)
     db.session.commit()
     
     return jsonify({'id': transaction.id, 'message': 'Транзакция создана'}), 201
 
+BATCH_MAX_TRANSACTIONS = 20000
+TRANSACTION_TYPES = ('income', 'expense', 'transfer')
+
+def parse_batch_transaction(item, account_ids, category_ids, store_ids):
+    """Проверяет строку пакета и возвращает поля Transaction; ValueError с текстом ошибки"""
+    if not isinstance(item, dict):
+        raise ValueError('Ожидается объект транзакции')
+    if item.get('type') not in TRANSACTION_TYPES:
+        raise ValueError('Неизвестный тип транзакции')
+    amount = item.get('amount')
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)):
+        raise ValueError('Некорректная сумма')
+    if item.get('account_id') not in account_ids:
+        raise ValueError('Счёт не найден')
+    if item.get('to_account_id') is not None and item['to_account_id'] not in account_ids:
+        raise ValueError('Счёт получателя не найден')
+    if item.get('category_id') is not None and item['category_id'] not in category_ids:
+        raise ValueError('Категория не найдена')
+    if item.get('store_id') is not None and item['store_id'] not in store_ids:
+        raise ValueError('Магазин не найден')
+    try:
+        transaction_date = date.fromisoformat(item['date']) if item.get('date') else date.today()
+    except (TypeError, ValueError):
+        raise ValueError('Некорректная дата')
+    tags = item.get('tags') or []
+    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+        raise ValueError('Теги — список строк')
+    
+    return {
+        'amount': amount,
+        'type': item['type'],
+        'description': item.get('description', ''),
+        'date': transaction_date,
+        'account_id': item['account_id'],
+        'category_id': item.get('category_id'),
+        'to_account_id': item.get('to_account_id'),
+        'store_id': item.get('store_id'),
+        'is_tax_transfer': bool(item.get('is_tax_transfer', False)),
+        'is_business_expense': bool(item.get('is_business_expense', False)),
+        'tags': ','.join(tags),
+        'import_hash': None
+    }
+
+def ingest_accounts():
+    """Счета с полями, нужными ingest_transactions: {id: строка}"""
+    return {a.id: a for a in db.session.query(
+        Account.id, Account.account_type, Account.is_business, Account.tax_rate, Account.linked_tax_account_id
+    ).all()}
+
+def ingest_transactions(rows, accounts):
+    """
+    Записывает проверенные строки транзакций массово, с теми же побочными эффектами,
+    что и create_transaction: балансы, долги по картам, налоговые резервы, итоги, журнал.
+    Эффекты агрегируются по счетам. Не коммитит; вызывается под lock_for_write().
+    rows — словари полей Transaction, accounts — {id: строка со счётом}.
+    Возвращает (id транзакций по порядку rows, {индекс строки: id перевода налога}).
+    """
+    # Автоматические резервы налога для доходов ИП, как в create_transaction
+    reserves = []
+    tax_transfers = []
+    tax_transfer_pairs = set()
+    for index, row in enumerate(rows):
+        account = accounts[row['account_id']]
+        if row['type'] == 'income' and account.is_business and account.tax_rate > 0 and account.linked_tax_account_id:
+            tax_amount = row['amount'] * account.tax_rate / 100
+            reserves.append({
+                'business_account_id': account.id,
+                'tax_account_id': account.linked_tax_account_id,
+                'income_amount': row['amount'],
+                'tax_amount': tax_amount,
+                'tax_rate': account.tax_rate,
+                'date': row['date'],
+                'is_transferred': True
+            })
+            if account.linked_tax_account_id in accounts:
+                tax_transfers.append((index, {
+                    'amount': tax_amount,
+                    'type': 'transfer',
+                    'description': f'Автоматический резерв налога {account.tax_rate}%',
+                    'date': row['date'],
+                    'account_id': account.id,
+                    'category_id': None,
+                    'to_account_id': account.linked_tax_account_id,
+                    'store_id': None,
+                    'is_tax_transfer': True,
+                    'is_business_expense': False,
+                    'tags': '',
+                    'import_hash': None
+                }))
+        elif row['type'] == 'transfer' and row['to_account_id'] and row['is_tax_transfer']:
+            tax_transfer_pairs.add((row['account_id'], row['to_account_id']))
+    
+    all_rows = rows + [row for _, row in tax_transfers]
+    # id возвращаются в порядке строк пакета (sort_by_parameter_order), а не в
+    # порядке, в котором их отдала СУБД
+    table = Transaction.__table__
+    ids = db.session.scalars(
+        table.insert().returning(table.c.id, sort_by_parameter_order=True), all_rows
+    ).all()
+    
+    account_types = {id_: a.account_type for id_, a in accounts.items()}
+    journal_rows = []
+    card_debt = {}
+    rollup = {}
+    for transaction_id, row in zip(ids, all_rows):
+        transaction = SimpleNamespace(id=transaction_id, **row)
+        journal_rows.extend(_journal_rows('transaction', transaction_id, row['date'],
+                                          transaction_lines(transaction, account_types)))
+        for account_id, delta in card_debt_effects(transaction, account_types):
+            card_debt.setdefault(account_id, []).append(delta)
+        key = tuple(rollup_key(transaction).items())
+        total, count = rollup.get(key, (0, 0))
+        rollup[key] = (total + row['amount'], count + 1)
+    
+    if journal_rows:
+        db.session.execute(JournalLine.__table__.insert(), journal_rows)
+    balances = {}
+    for line in journal_rows:
+        if line['ledger'] == 'account':
+            delta, first_date = balances.get(line['ref_id'], (0, line['date']))
+            balances[line['ref_id']] = (delta + line['amount'], min(first_date, line['date']))
+    for account_id, (delta, first_date) in balances.items():
+        post_balance(account_id, delta)
+        invalidate_checkpoints(account_id, first_date)
+    # Отсечка долга на нуле — после каждой строки по порядку, как при создании
+    # транзакций по одной: иначе итог зависел бы от того, как строки разбиты на пакеты.
+    # Изменения сворачиваются от текущего долга, на карту пишется один UPDATE.
+    if card_debt:
+        debts = dict(db.session.query(CreditCard.account_id, CreditCard.current_debt).filter(
+            CreditCard.account_id.in_(card_debt)
+        ).all())
+        for account_id, deltas in card_debt.items():
+            if account_id not in debts:
+                continue
+            debt = debts[account_id] or 0
+            for delta in deltas:
+                debt = max(debt + delta, 0)
+            CreditCard.query.filter_by(account_id=account_id).update(
+                {'current_debt': debt}, synchronize_session=False
+            )
+        note_achievement_events('debt')
+    rollup_apply_many([dict(key, total=total, count=count) for key, (total, count) in rollup.items()])
+    
+    if reserves:
+        db.session.execute(TaxReserve.__table__.insert(), reserves)
+    for business_account_id, tax_account_id in tax_transfer_pairs:
+        TaxReserve.query.filter_by(
+            business_account_id=business_account_id,
+            tax_account_id=tax_account_id,
+            is_transferred=False
+        ).update({'is_transferred': True})
+    
+    note_achievement_events('transaction', transactions_created=len(all_rows))
+    
+    tax_transfer_ids = {index: transaction_id for (index, _), transaction_id in zip(tax_transfers, ids[len(rows):])}
+    return ids[:len(rows)], tax_transfer_ids
+
+@app.route('/api/transactions/batch', methods=['POST'])
+@serialized_write
+def create_transactions_batch():
+    """
+    Массовая загрузка транзакций в одной транзакции БД. Пакет проверяется целиком:
+    при ошибке в любой строке ничего не пишется. Балансы, долги по картам, налоговые
+    резервы, итоги и журнал агрегируются по счетам и пишутся массовыми запросами.
+    """
+    data = request.json
+    items = data.get('transactions') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Ожидается непустой список транзакций'}), 400
+    if len(items) > BATCH_MAX_TRANSACTIONS:
+        return jsonify({'error': f'Не больше {BATCH_MAX_TRANSACTIONS} транзакций за раз'}), 400
+    
+    lock_for_write()
+    accounts = ingest_accounts()
+    category_ids = {id_ for (id_,) in db.session.query(Category.id).all()}
+    store_ids = {id_ for (id_,) in db.session.query(Store.id).all()}
+    
+    rows = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            rows.append(parse_batch_transaction(item, accounts, category_ids, store_ids))
+        except ValueError as e:
+            errors.append({'index': index, 'error': str(e)})
+    if errors:
+        db.session.rollback()
+        return jsonify({'error': 'Пакет не загружен', 'results': errors}), 400
+    
+    ids, tax_transfer_ids = ingest_transactions(rows, accounts)
+    db.session.commit()
+    
+    results = []
+    for index, transaction_id in enumerate(ids):
+        result = {'index': index, 'id': transaction_id}
+        if index in tax_transfer_ids:
+            result['tax_transfer_id'] = tax_transfer_ids[index]
+        results.append(result)
+    
+    return jsonify({'created': len(ids) + len(tax_transfer_ids), 'results': results}), 201
+
+# --- Импорт выписок ---
+IMPORT_CHUNK_SIZE = 500
+IMPORT_MAX_ERRORS = 20
+# В задачу с таким статусом ещё пишет фоновый поток импорта
+IMPORT_ACTIVE_STATUSES = ('queued', 'running')
+# Активная задача без новых пачек дольше этого срока считается брошенной
+IMPORT_STALE_AFTER = timedelta(minutes=int(os.environ.get('IMPORT_STALE_MINUTES', 30)))
+OFX_TAG = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<\r\n]*)')
+
+DEFAULT_IMPORT_PROFILES = [
+    {'name': 'Тинькофф (CSV)', 'file_format': 'csv', 'encoding': 'cp1251', 'delimiter': ';',
+     'date_column': 'Дата операции', 'date_format': '%d.%m.%Y %H:%M:%S', 'amount_column': 'Сумма операции',
+     'description_column': 'Описание', 'category_column': 'Категория',
+     'status_column': 'Статус', 'ok_statuses': 'OK'},
+    {'name': 'Сбербанк (CSV)', 'file_format': 'csv', 'encoding': 'utf-8-sig', 'delimiter': ';',
+     'date_column': 'Дата операции', 'date_format': '%d.%m.%Y', 'amount_column': 'Сумма',
+     'description_column': 'Описание', 'category_column': 'Категория',
+     'status_column': None, 'ok_statuses': ''},
+    {'name': 'OFX', 'file_format': 'ofx', 'encoding': 'utf-8-sig'},
+]
+IMPORT_PROFILE_FIELDS = ('name', 'file_format', 'encoding', 'delimiter', 'date_column', 'date_format',
+                         'amount_column', 'description_column', 'category_column', 'status_column', 'ok_statuses')
+
+def parse_statement_amount(value):
+    """Сумма из выписки: '−1 234,56' → -1234.56"""
+    cleaned = value.replace('\xa0', '').replace(' ', '').replace('−', '-').replace(',', '.')
+    return float(cleaned)
+
+def iter_csv_statement(stream, profile):
+    """
+    Операции CSV-выписки по одной: (номер строки, операция или None, ошибка или None).
+    Операция None без ошибки — строка отфильтрована по статусу.
+    """
+    text = io.TextIOWrapper(stream, encoding=profile.encoding or 'utf-8-sig', errors='replace', newline='')
+    reader = csv.DictReader(text, delimiter=profile.delimiter or ';')
+    ok_statuses = {status.strip() for status in (profile.ok_statuses or '').split(',') if status.strip()}
+    
+    for line_no, record in enumerate(reader, start=2):
+        try:
+            if profile.status_column and ok_statuses and record[profile.status_column] not in ok_statuses:
+                yield line_no, None, None
+                continue
+            yield line_no, {
+                'date': datetime.strptime(record[profile.date_column].strip(), profile.date_format).date(),
+                'amount': parse_statement_amount(record[profile.amount_column]),
+                'description': (record.get(profile.description_column) or '').strip() if profile.description_column else '',
+                'category': (record.get(profile.category_column) or '').strip() if profile.category_column else ''
+            }, None
+        except KeyError as e:
+            yield line_no, None, f'нет колонки {e}'
+        except (TypeError, ValueError, AttributeError) as e:
+            yield line_no, None, str(e)
+
+def iter_ofx_statement(stream, profile):
+    """Операции OFX (SGML или XML) по одной, без загрузки файла целиком"""
+    text = io.TextIOWrapper(stream, encoding=profile.encoding or 'utf-8-sig', errors='replace')
+    current = None
+    
+    for line_no, line in enumerate(text, start=1):
+        for closing, tag, value in OFX_TAG.findall(line):
+            tag = tag.upper()
+            if tag != 'STMTTRN':
+                if current is not None and not closing:
+                    current[tag] = value.strip()
+                continue
+            if not closing:
+                current = {}
+                continue
+            
+            record, current = current or {}, None
+            try:
+                description = ' — '.join(dict.fromkeys(filter(None, [record.get('NAME'), record.get('MEMO')])))
+                yield line_no, {
+                    'date': datetime.strptime(record['DTPOSTED'][:8], '%Y%m%d').date(),
+                    'amount': parse_statement_amount(record['TRNAMT']),
+                    'description': description,
+                    'category': ''
+                }, None
+            except KeyError as e:
+                yield line_no, None, f'нет поля {e}'
+            except ValueError as e:
+                yield line_no, None, str(e)
+
+def statement_hash(account_id, operation, occurrence):
+    """
+    Хэш содержимого операции (счёт, дата, сумма, описание) для дедупликации.
+    occurrence — номер повтора одинаковой операции внутри файла, чтобы две честные
+    одинаковые покупки за день не склеились, а повторный импорт файла — отсеялся.
+    """
+    raw = f"{account_id}|{operation['date'].isoformat()}|{operation['amount']:.2f}|{operation['description']}|{occurrence}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def import_statement_chunk(job_id, rows, progress):
+    """Пишет пачку операций, отсеивая уже импортированные, и сохраняет прогресс задачи"""
+    lock_for_write()
+    hashes = [row['import_hash'] for row in rows]
+    existing = set()
+    for source in transaction_sources():
+        existing.update(h for (h,) in db.session.execute(
+            db.select(source.c.import_hash).where(source.c.import_hash.in_(hashes))
+        ))
+    new_rows = [row for row in rows if row['import_hash'] not in existing]
+    
+    if new_rows:
+        ingest_transactions(new_rows, ingest_accounts())
+    progress['rows_imported'] += len(new_rows)
+    progress['rows_duplicate'] += len(rows) - len(new_rows)
+    ImportJob.query.filter_by(id=job_id).update(dict(progress, heartbeat_at=datetime.utcnow()))
+    db.session.commit()
+
+def run_import_job(job_id, path):
+    """
+    Фоновый импорт выписки: потоковое чтение файла и запись пачками по IMPORT_CHUNK_SIZE.
+    Что бы ни случилось, задача завершается со статусом done или failed, а файл удаляется.
+    """
+    with app.app_context():
+        progress = {'rows_read': 0, 'rows_imported': 0, 'rows_duplicate': 0, 'rows_skipped': 0, 'rows_failed': 0}
+        errors = []
+        status = 'failed'
+        try:
+            job = db.session.get(ImportJob, job_id)
+            stored_profile = db.session.get(ImportProfile, job.profile_id)
+            if stored_profile is None:
+                raise ValueError('Профиль импорта удалён')
+            # Поля профиля копируются: ORM-объект после коммита пачки перечитывался бы
+            # из базы, открывая транзакцию до lock_for_write() следующей пачки
+            profile = SimpleNamespace(**{field: getattr(stored_profile, field) for field in IMPORT_PROFILE_FIELDS})
+            account_id = job.account_id
+            categories = {(c.name.lower(), c.type): c.id for c in Category.query.all()}
+            job.status = 'running'
+            job.heartbeat_at = datetime.utcnow()
+            db.session.commit()
+            
+            parser = iter_ofx_statement if profile.file_format == 'ofx' else iter_csv_statement
+            occurrences = {}
+            with open(path, 'rb') as stream:
+                chunk = []
+                for line_no, operation, error in parser(stream, profile):
+                    progress['rows_read'] += 1
+                    if error:
+                        progress['rows_failed'] += 1
+                        if len(errors) < IMPORT_MAX_ERRORS:
+                            errors.append(f'Строка {line_no}: {error}')
+                        continue
+                    if operation is None or not operation['amount']:
+                        progress['rows_skipped'] += 1
+                        continue
+                    
+                    type_ = 'expense' if operation['amount'] < 0 else 'income'
+                    content = (operation['date'], round(operation['amount'], 2), operation['description'])
+                    occurrence = occurrences.get(content, 0)
+                    occurrences[content] = occurrence + 1
+                    chunk.append({
+                        'amount': abs(operation['amount']),
+                        'type': type_,
+                        'description': operation['description'][:255],
+                        'date': operation['date'],
+                        'account_id': account_id,
+                        'category_id': categories.get((operation['category'].lower(), type_)),
+                        'to_account_id': None,
+                        'store_id': None,
+                        'is_tax_transfer': False,
+                        'is_business_expense': False,
+                        'tags': '',
+                        'import_hash': statement_hash(account_id, operation, occurrence)
+                    })
+                    if len(chunk) >= IMPORT_CHUNK_SIZE:
+                        import_statement_chunk(job_id, chunk, progress)
+                        chunk = []
+                if chunk:
+                    import_statement_chunk(job_id, chunk, progress)
+            status = 'done'
+        except Exception as e:
+            db.session.rollback()
+            errors.append(str(e))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+            ImportJob.query.filter_by(id=job_id).update(dict(
+                progress, status=status, errors=json.dumps(errors, ensure_ascii=False), finished_at=datetime.utcnow()
+            ))
+            db.session.commit()
+
+def fail_stale_import_jobs():
+    """
+    Помечает failed активные задачи, в которые поток импорта давно ничего не писал.
+    Поток живёт в процессе воркера и пропадает вместе с ним (перезапуск, падение),
+    а брошенная задача навсегда запрещала бы удалить свой счёт и профиль.
+    Возвращает число таких задач; не коммитит.
+    """
+    now = datetime.utcnow()
+    return ImportJob.query.filter(
+        ImportJob.status.in_(IMPORT_ACTIVE_STATUSES),
+        db.func.coalesce(ImportJob.heartbeat_at, ImportJob.created_at) < now - IMPORT_STALE_AFTER
+    ).update({
+        'status': 'failed',
+        'errors': json.dumps(['Импорт прерван: фоновый поток остановился'], ensure_ascii=False),
+        'finished_at': now
+    }, synchronize_session=False)
+
+def serialize_import_profile(p):
+    return {field: getattr(p, field) for field in ('id',) + IMPORT_PROFILE_FIELDS}
+
+def serialize_import_job(j):
+    return {
+        'id': j.id,
+        'account_id': j.account_id,
+        'profile_id': j.profile_id,
+        'filename': j.filename,
+        'status': j.status,
+        'rows_read': j.rows_read,
+        'rows_imported': j.rows_imported,
+        'rows_duplicate': j.rows_duplicate,
+        'rows_skipped': j.rows_skipped,
+        'rows_failed': j.rows_failed,
+        'errors': json.loads(j.errors or '[]'),
+        'created_at': j.created_at.isoformat(),
+        'finished_at': j.finished_at.isoformat() if j.finished_at else None
+    }
+
+@app.route('/api/import/profiles', methods=['GET'])
+def get_import_profiles():
+    return jsonify([serialize_import_profile(p) for p in ImportProfile.query.order_by(ImportProfile.name).all()])
+
+@app.route('/api/import/profiles', methods=['POST'])
+def create_import_profile():
+    data = request.json
+    if data.get('file_format', 'csv') not in ('csv', 'ofx'):
+        return jsonify({'error': 'Формат должен быть csv или ofx'}), 400
+    profile = ImportProfile(**{field: data[field] for field in IMPORT_PROFILE_FIELDS if field in data})
+    db.session.add(profile)
+    db.session.commit()
+    return jsonify({'id': profile.id, 'message': 'Профиль создан'}), 201
+
+@app.route('/api/import/profiles/<int:id>', methods=['PUT'])
+def update_import_profile(id):
+    profile = ImportProfile.query.get_or_404(id)
+    data = request.json
+    if data.get('file_format', profile.file_format) not in ('csv', 'ofx'):
+        return jsonify({'error': 'Формат должен быть csv или ofx'}), 400
+    for field in IMPORT_PROFILE_FIELDS:
+        setattr(profile, field, data.get(field, getattr(profile, field)))
+    db.session.commit()
+    return jsonify({'message': 'Профиль обновлён'})
+
+@app.route('/api/import/profiles/<int:id>', methods=['DELETE'])
+@serialized_write
+def delete_import_profile(id):
+    lock_for_write()
+    profile = ImportProfile.query.get_or_404(id)
+    if not delete_import_jobs(ImportJob.profile_id == id):
+        return jsonify({'error': 'По профилю идёт импорт, удалите его после завершения'}), 400
+    db.session.delete(profile)
+    db.session.commit()
+    return jsonify({'message': 'Профиль удалён'})
+
+def delete_import_jobs(condition):
+    """
+    Удаляет задачи импорта по условию, чтобы удалить их счёт или профиль.
+    Если среди них есть незавершённая, ничего не удаляет и возвращает False.
+    """
+    fail_stale_import_jobs()
+    if ImportJob.query.filter(condition, ImportJob.status.in_(IMPORT_ACTIVE_STATUSES)).first() is not None:
+        return False
+    ImportJob.query.filter(condition).delete(synchronize_session=False)
+    return True
+
+@app.route('/api/import', methods=['POST'])
+def start_import():
+    """
+    Загружает выписку (multipart: file, account_id, profile_id) и запускает импорт в фоне.
+    Прогресс — GET /api/import/jobs/<id>.
+    """
+    upload = request.files.get('file')
+    account_id = request.form.get('account_id', type=int)
+    profile_id = request.form.get('profile_id', type=int)
+    if not upload:
+        return jsonify({'error': 'Файл не передан'}), 400
+    
+    # Файл пишется на диск по частям и читается оттуда потоково. Копирование идёт
+    # до блокировки записи, чтобы большая выписка не задерживала других писателей
+    fd, path = tempfile.mkstemp(suffix='.statement')
+    os.close(fd)
+    started = False
+    try:
+        upload.save(path)
+        # Под блокировкой записи: счёт и профиль не удалят между проверкой и созданием задачи
+        lock_for_write()
+        if not account_id or db.session.get(Account, account_id) is None:
+            return jsonify({'error': 'Счёт не найден'}), 400
+        if not profile_id or db.session.get(ImportProfile, profile_id) is None:
+            return jsonify({'error': 'Профиль импорта не найден'}), 400
+        
+        job = ImportJob(account_id=account_id, profile_id=profile_id, filename=upload.filename)
+        db.session.add(job)
+        db.session.commit()
+        
+        threading.Thread(target=run_import_job, args=(job.id, path), daemon=True).start()
+        started = True
+    finally:
+        # Файл запущенной задачи удаляет поток импорта
+        if not started:
+            os.remove(path)
+    return jsonify({'job_id': job.id, 'status': job.status}), 202
+
+@app.route('/api/import/jobs', methods=['GET'])
+def get_import_jobs():
+    jobs = ImportJob.query.order_by(ImportJob.id.desc()).limit(20).all()
+    return jsonify([serialize_import_job(j) for j in jobs])
+
+@app.route('/api/import/jobs/<int:id>', methods=['GET'])
+def get_import_job(id):
+    return jsonify(serialize_import_job(ImportJob.query.get_or_404(id)))
+
 @app.route('/api/transactions/<int:id>', methods=['PUT'])
+@serialized_write
 def update_transaction(id):
+    lock_for_write()
+    if db.session.get(Transaction, id) is None and transaction_is_archived(id):
+        return jsonify({'error': 'Транзакция закрытого года перенесена в архив и не изменяется'}), 400
     transaction = Transaction.query.get_or_404(id)
     data = request.json
     
-    old_account = Account.query.get(transaction.account_id)
-    
-    if transaction.type == 'income':
-        old_account.balance -= transaction.amount
-        
-    elif transaction.type == 'expense':
-        old_account.balance += transaction.amount
-        if old_account.account_type == 'credit_card':
-            card = CreditCard.query.filter_by(account_id=old_account.id).first()
-            if card:
-                card.current_debt = max(0, card.current_debt - transaction.amount)
-                
-    elif transaction.type == 'transfer' and transaction.to_account_id:
-        old_account.balance += transaction.amount
-        if old_account.account_type == 'credit_card':
-            card = CreditCard.query.filter_by(account_id=old_account.id).first()
-            if card:
-                card.current_debt = max(0, card.current_debt - transaction.amount)
-        
-        old_to_account = Account.query.get(transaction.to_account_id)
-        if old_to_account:
-            if old_to_account.account_type == 'credit_card':
-                to_card = CreditCard.query.filter_by(account_id=old_to_account.id).first()
-                if to_card:
-                    to_card.current_debt += transaction.amount
-            else:
-                old_to_account.balance -= transaction.amount
+    rollup_add(transaction, -1)
+    post_transaction(transaction, -1)
     
     transaction.amount = data.get('amount', transaction.amount)
     transaction.type = data.get('type', transaction.type)
@@ -893,74 +2862,447 @@ def update_transaction(id):
     transaction.to_account_id = data.get('to_account_id', transaction.to_account_id)
     transaction.store_id = data.get('store_id', transaction.store_id)
     
-    new_account = Account.query.get(transaction.account_id)
-    
-    if transaction.type == 'income':
-        new_account.balance += transaction.amount
-        
-    elif transaction.type == 'expense':
-        new_account.balance -= transaction.amount
-        if new_account.account_type == 'credit_card':
-            card = CreditCard.query.filter_by(account_id=new_account.id).first()
-            if card:
-                card.current_debt += transaction.amount
-                
-    elif transaction.type == 'transfer' and transaction.to_account_id:
-        new_account.balance -= transaction.amount
-        if new_account.account_type == 'credit_card':
-            card = CreditCard.query.filter_by(account_id=new_account.id).first()
-            if card:
-                card.current_debt += transaction.amount
-        
-        new_to_account = Account.query.get(transaction.to_account_id)
-        if new_to_account:
-            if new_to_account.account_type == 'credit_card':
-                to_card = CreditCard.query.filter_by(account_id=new_to_account.id).first()
-                if to_card:
-                    to_card.current_debt = max(0, to_card.current_debt - transaction.amount)
-            else:
-                new_to_account.balance += transaction.amount
-    
+    post_transaction(transaction)
+    rollup_add(transaction)
     db.session.commit()
     return jsonify({'message': 'Транзакция обновлена'})
 
 @app.route('/api/transactions/<int:id>', methods=['DELETE'])
+@serialized_write
 def delete_transaction(id):
+    lock_for_write()
+    if db.session.get(Transaction, id) is None and transaction_is_archived(id):
+        return jsonify({'error': 'Транзакция закрытого года перенесена в архив и не изменяется'}), 400
     transaction = Transaction.query.get_or_404(id)
     
-    account = Account.query.get(transaction.account_id)
-    
-    if transaction.type == 'income':
-        account.balance -= transaction.amount
-        
-    elif transaction.type == 'expense':
-        account.balance += transaction.amount
-        if account.account_type == 'credit_card':
-            card = CreditCard.query.filter_by(account_id=account.id).first()
-            if card:
-                card.current_debt = max(0, card.current_debt - transaction.amount)
-                
-    elif transaction.type == 'transfer' and transaction.to_account_id:
-        account.balance += transaction.amount
-        
-        if account.account_type == 'credit_card':
-            card = CreditCard.query.filter_by(account_id=account.id).first()
-            if card:
-                card.current_debt = max(0, card.current_debt - transaction.amount)
-        
-        to_account = Account.query.get(transaction.to_account_id)
-        if to_account:
-            if to_account.account_type == 'credit_card':
-                to_card = CreditCard.query.filter_by(account_id=to_account.id).first()
-                if to_card:
-                    to_card.current_debt += transaction.amount
-            else:
-                to_account.balance -= transaction.amount
-    
+    post_transaction(transaction, -1)
+    rollup_add(transaction, -1)
     db.session.delete(transaction)
     db.session.commit()
     return jsonify({'message': 'Транзакция удалена'})
 
+# --- Экспорт ---
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8'
+}
+
+def export_csv_value(value):
+    if isinstance(value, list):
+        return ','.join(value)
+    return '' if value is None else value
+
+def iter_export(statement, serialize, columns, export_format):
+    """
+    Строки выгрузки пачками по EXPORT_CHUNK_SIZE: курсор читается через yield_per,
+    так что память не растёт с количеством строк. Заголовок CSV (columns) идёт
+    первым и без строк: пустая выгрузка — файл из одного заголовка.
+    """
+    result = db.session.execute(statement.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+    
+    if export_format == 'csv':
+        buffer = io.StringIO()
+        # BOM, чтобы Excel открыл кириллицу без мастера импорта
+        buffer.write('\ufeff')
+        csv.writer(buffer, delimiter=';').writerow(columns)
+        yield buffer.getvalue()
+    
+    for partition in result.partitions():
+        buffer = io.StringIO()
+        if export_format == 'ndjson':
+            for row in partition:
+                buffer.write(json.dumps(serialize(row), ensure_ascii=False))
+                buffer.write('\n')
+        else:
+            writer = csv.writer(buffer, delimiter=';')
+            for row in partition:
+                record = serialize(row)
+                writer.writerow([export_csv_value(record[column]) for column in columns])
+        yield buffer.getvalue()
+
+def export_response(name, statement, serialize, columns):
+    """Потоковый ответ с выгрузкой в формате ?format=csv|ndjson; columns — колонки CSV"""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': 'Формат должен быть csv или ndjson'}), 400
+    
+    return Response(
+        stream_with_context(iter_export(statement, serialize, columns, export_format)),
+        content_type=EXPORT_FORMATS[export_format],
+        headers={
+            'Content-Disposition': f'attachment; filename={name}.{export_format}',
+            # nginx не должен копить ответ целиком в буфере
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+TRANSACTION_EXPORT_COLUMNS = [
+    'id', 'amount', 'type', 'description', 'date', 'account_id', 'account_name', 'account_icon',
+    'category_id', 'category_name', 'category_icon', 'category_color', 'to_account_id', 'to_account_name',
+    'store_id', 'store_name', 'is_tax_transfer', 'is_business_expense', 'tags'
+]
+CREDIT_PAYMENT_EXPORT_COLUMNS = [
+    'credit_id', 'id', 'date', 'amount', 'principal', 'interest', 'is_regular', 'is_extra',
+    'payment_number', 'remaining_after', 'months_reduced', 'notes', 'is_manual'
+]
+INVESTMENT_TRANSACTION_EXPORT_COLUMNS = [
+    'investment_id', 'ticker', 'id', 'type', 'quantity', 'price', 'total_amount', 'commission', 'date', 'notes'
+]
+PRICE_EXPORT_COLUMNS = ['id', 'product_id', 'product_name', 'store_id', 'store_name', 'price', 'is_sale', 'date']
+
+@app.route('/api/export/transactions', methods=['GET'])
+def export_transactions():
+    """Все транзакции по тем же фильтрам, что и GET /api/transactions, от старых к новым"""
+    filters = dict(
+        type_filter=request.args.get('type'),
+        account_filter=request.args.get('account_id', type=int),
+        category_filter=request.args.get('category_id', type=int),
+        store_filter=request.args.get('store_id', type=int),
+        start_date=request.args.get('start_date'),
+        end_date=request.args.get('end_date'),
+        search=request.args.get('search', '')
+    )
+    statement = transactions_feed_select(filters, descending=False)
+    return export_response('transactions', statement, serialize_transaction, TRANSACTION_EXPORT_COLUMNS)
+
+@app.route('/api/export/credit-payments', methods=['GET'])
+def export_credit_payments():
+    credit_id = request.args.get('credit_id', type=int)
+    statement = db.select(CreditPayment.__table__).order_by(CreditPayment.credit_id, CreditPayment.date, CreditPayment.id)
+    if credit_id:
+        statement = statement.where(CreditPayment.credit_id == credit_id)
+    return export_response(
+        'credit_payments', statement, lambda p: {'credit_id': p.credit_id, **serialize_credit_payment(p)},
+        CREDIT_PAYMENT_EXPORT_COLUMNS
+    )
+
+@app.route('/api/export/investment-transactions', methods=['GET'])
+def export_investment_transactions():
+    investment_id = request.args.get('investment_id', type=int)
+    statement = db.select(InvestmentTransaction.__table__, Investment.ticker).outerjoin(
+        Investment, InvestmentTransaction.investment_id == Investment.id
+    ).order_by(InvestmentTransaction.date, InvestmentTransaction.id)
+    if investment_id:
+        statement = statement.where(InvestmentTransaction.investment_id == investment_id)
+    return export_response(
+        'investment_transactions', statement,
+        lambda t: {'investment_id': t.investment_id, 'ticker': t.ticker, **serialize_investment_transaction(t)},
+        INVESTMENT_TRANSACTION_EXPORT_COLUMNS
+    )
+
+@app.route('/api/export/prices', methods=['GET'])
+def export_prices():
+    product_id = request.args.get('product_id', type=int)
+    store_id = request.args.get('store_id', type=int)
+    statement = db.select(
+        ProductPrice.id,
+        ProductPrice.product_id,
+        Product.name.label('product_name'),
+        ProductPrice.store_id,
+        Store.name.label('store_name'),
+        ProductPrice.price,
+        ProductPrice.is_sale,
+        ProductPrice.date
+    ).outerjoin(Product, ProductPrice.product_id == Product.id).outerjoin(
+        Store, ProductPrice.store_id == Store.id
+    ).order_by(ProductPrice.date, ProductPrice.id)
+    if product_id:
+        statement = statement.where(ProductPrice.product_id == product_id)
+    if store_id:
+        statement = statement.where(ProductPrice.store_id == store_id)
+    return export_response('prices', statement, lambda p: {
+        'id': p.id,
+        'product_id': p.product_id,
+        'product_name': p.product_name,
+        'store_id': p.store_id,
+        'store_name': p.store_name,
+        'price': p.price,
+        'is_sale': p.is_sale,
+        'date': p.date.isoformat() if p.date else None
+    }, PRICE_EXPORT_COLUMNS)
+
+# --- Резервные копии ---
+BACKUP_NAME = re.compile(r'^budget-\d{8}-\d{6}\.db\.gz$')
+
+def sqlite_database_file():
+    """Путь к файлу базы SQLite или None для других СУБД и базы в памяти"""
+    url = db.engine.url
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        return None
+    return url.database
+
+def sqlite_integrity_error(path, required_tables=('account', 'transaction')):
+    """Проверяет файл базы: None, если он цел, иначе текст ошибки"""
+    connection = sqlite3.connect(path)
+    try:
+        result = [row[0] for row in connection.execute('PRAGMA integrity_check')]
+        if result != ['ok']:
+            return '; '.join(result[:5])
+        tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if not set(required_tables) <= tables:
+            return 'В файле нет таблиц бюджета'
+        return None
+    except sqlite3.DatabaseError as e:
+        return str(e)
+    finally:
+        connection.close()
+
+def sqlite_snapshot(database_file, targets):
+    """
+    Согласованный снимок схем базы {схема: файл} (main и архив) через backup API по
+    BACKUP_PAGES_PER_STEP страниц. Все копии делаются из одной читающей транзакции:
+    они видят одно и то же состояние, так что перенос года в архив не попадёт
+    в снимок наполовину, а запись других соединений не заставляет начинать копию
+    заново. В WAL пишущие запросы проходят между шагами; в режиме журнала отката
+    они ждут конца копии.
+    """
+    source = sqlite3.connect(database_file, isolation_level=None)
+    try:
+        if ARCHIVE_SCHEMA in targets:
+            source.execute(f'ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}', (archive_database_file(database_file),))
+        source.execute('BEGIN')
+        for schema in targets:
+            # Чтение фиксирует состояние схемы до конца транзакции
+            source.execute(f'SELECT count(*) FROM {schema}.sqlite_master').fetchone()
+        for schema, target_path in targets.items():
+            target = sqlite3.connect(target_path)
+            try:
+                source.backup(target, pages=BACKUP_PAGES_PER_STEP, name=schema,
+                              progress=lambda status, remaining, total: time.sleep(BACKUP_STEP_PAUSE))
+            finally:
+                target.close()
+        source.execute('COMMIT')
+    finally:
+        source.close()
+
+def backup_archive_name(name):
+    """Файл архива, снятый вместе со снимком: budget-….db.gz → budget-…-archive.db.gz"""
+    return name[:-len('.db.gz')] + '-archive.db.gz'
+
+def list_backups():
+    """Снимки в BACKUP_DIR, от новых к старым; size — вместе с файлом архива"""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    result = []
+    for name in sorted(os.listdir(BACKUP_DIR), reverse=True):
+        if BACKUP_NAME.match(name):
+            stat = os.stat(os.path.join(BACKUP_DIR, name))
+            archive_path = os.path.join(BACKUP_DIR, backup_archive_name(name))
+            has_archive = os.path.exists(archive_path)
+            result.append({
+                'name': name,
+                'size': stat.st_size + (os.path.getsize(archive_path) if has_archive else 0),
+                'has_archive': has_archive,
+                'created_at': datetime.utcfromtimestamp(stat.st_mtime).isoformat()
+            })
+    return result
+
+def prune_backups(keep=None):
+    """Удаляет снимки (вместе с архивом) сверх последних keep (BACKUP_KEEP); возвращает имена удалённых"""
+    keep = BACKUP_KEEP if keep is None else keep
+    removed = [backup['name'] for backup in list_backups()[max(keep, 0):]]
+    for name in removed:
+        os.remove(os.path.join(BACKUP_DIR, name))
+        archive_path = os.path.join(BACKUP_DIR, backup_archive_name(name))
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+    return removed
+
+def gzip_file(source_path, target_path):
+    """Сжимает файл во временное имя и переименовывает: недописанный файл не виден под target_path"""
+    partial_path = target_path + '.part'
+    with open(source_path, 'rb') as source, gzip.open(partial_path, 'wb', compresslevel=6) as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+    os.replace(partial_path, target_path)
+
+def gunzip_file(source_path, target_path):
+    with gzip.open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+
+def sqlite_restore_file(source_path, target_path):
+    """Записывает базу поверх рабочей через backup API"""
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path, timeout=30)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+def create_backup():
+    """
+    Снимок базы без остановки приложения: постраничная копия во временный файл,
+    проверка целостности, сжатие gzip и удаление старых снимков. Файл архива
+    закрытых лет снимается в той же читающей транзакции и сохраняется рядом
+    (budget-…-archive.db.gz): без него перенесённые в архив годы не восстановить.
+    """
+    database_file = sqlite_database_file()
+    if database_file is None:
+        raise ValueError('Резервное копирование поддерживается только для файла SQLite')
+    
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    name = f"budget-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.db.gz"
+    raw_paths = {}
+    schemas = ['main']
+    if os.path.exists(archive_database_file(database_file)):
+        schemas.append(ARCHIVE_SCHEMA)
+    try:
+        for schema in schemas:
+            fd, raw_paths[schema] = tempfile.mkstemp(suffix='.db', dir=BACKUP_DIR)
+            os.close(fd)
+        sqlite_snapshot(database_file, raw_paths)
+        error = sqlite_integrity_error(raw_paths['main'])
+        if error is None and ARCHIVE_SCHEMA in raw_paths:
+            error = sqlite_integrity_error(raw_paths[ARCHIVE_SCHEMA], required_tables=())
+        if error:
+            raise ValueError(f'Снимок повреждён: {error}')
+        
+        # Архив пишется первым: снимок в списке всегда с уже готовым архивом
+        if ARCHIVE_SCHEMA in raw_paths:
+            gzip_file(raw_paths[ARCHIVE_SCHEMA], os.path.join(BACKUP_DIR, backup_archive_name(name)))
+        gzip_file(raw_paths['main'], os.path.join(BACKUP_DIR, name))
+    finally:
+        for raw_path in raw_paths.values():
+            os.remove(raw_path)
+    
+    prune_backups()
+    return next(backup for backup in list_backups() if backup['name'] == name)
+
+def restore_backup(name):
+    """
+    Восстанавливает базу и архив закрытых лет из снимка. Файлы распаковываются
+    и проверяются до того, как тронуть рабочую базу; текущее состояние сначала
+    сохраняется отдельным снимком. Запись идёт через backup API, поэтому открытые
+    соединения других воркеров увидят новые данные, а не полузаписанный файл.
+    У снимков без файла архива (сделанных до архивации) текущий архив остаётся,
+    из него лишь убираются строки, которые снова есть в transaction.
+    """
+    database_file = sqlite_database_file()
+    if database_file is None:
+        raise ValueError('Восстановление поддерживается только для файла SQLite')
+    if not BACKUP_NAME.match(name) or not os.path.exists(os.path.join(BACKUP_DIR, name)):
+        raise ValueError('Снимок не найден')
+    
+    sources = {'main': os.path.join(BACKUP_DIR, name)}
+    archive_backup = os.path.join(BACKUP_DIR, backup_archive_name(name))
+    if os.path.exists(archive_backup):
+        sources[ARCHIVE_SCHEMA] = archive_backup
+    
+    raw_paths = {}
+    try:
+        for schema, backup_path in sources.items():
+            fd, raw_paths[schema] = tempfile.mkstemp(suffix='.db', dir=BACKUP_DIR)
+            os.close(fd)
+            gunzip_file(backup_path, raw_paths[schema])
+        error = sqlite_integrity_error(raw_paths['main'])
+        if error is None and ARCHIVE_SCHEMA in raw_paths:
+            error = sqlite_integrity_error(raw_paths[ARCHIVE_SCHEMA], required_tables=())
+        if error:
+            raise ValueError(f'Снимок повреждён: {error}')
+        
+        safety = create_backup()
+        db.session.remove()
+        db.engine.dispose()
+        if read_engine() is not None:
+            read_engine().dispose()
+        sqlite_restore_file(raw_paths['main'], database_file)
+        if ARCHIVE_SCHEMA in raw_paths:
+            sqlite_restore_file(raw_paths[ARCHIVE_SCHEMA], archive_database_file(database_file))
+    except (OSError, EOFError, gzip.BadGzipFile) as e:
+        raise ValueError(f'Не удалось прочитать снимок: {e}')
+    finally:
+        for raw_path in raw_paths.values():
+            os.remove(raw_path)
+    
+    invalidate_category_totals()
+    reset_schema_columns()
+    reconcile_archive()
+    return safety
+
+def sqlite_active_pragmas(connection):
+    """Фактические значения PRAGMA профиля на соединении"""
+    return {
+        name: connection.exec_driver_sql(f'PRAGMA {name}').scalar()
+        for name in SQLITE_PRAGMAS
+    }
+
+def pool_status(engine):
+    return {
+        name: getattr(engine.pool, name)()
+        for name in ('size', 'checkedin', 'checkedout', 'overflow')
+        if hasattr(engine.pool, name)
+    }
+
+@app.route('/api/health', methods=['GET'])
+def health():
+    """Проверка живости: соединения с базой, активные PRAGMA и состояние пулов"""
+    result = {
+        'status': 'ok',
+        'database': db.engine.dialect.name,
+        'pool': pool_status(db.engine)
+    }
+    with db.engine.connect() as connection:
+        if connection.dialect.name == 'sqlite':
+            result['pragmas'] = sqlite_active_pragmas(connection)
+    
+    engine = read_engine()
+    if engine is not None:
+        result['read_pool'] = pool_status(engine)
+        with engine.connect() as connection:
+            if connection.dialect.name == 'sqlite':
+                result['read_pragmas'] = dict(
+                    sqlite_active_pragmas(connection),
+                    query_only=connection.exec_driver_sql('PRAGMA query_only').scalar()
+                )
+    return jsonify(result)
+
+@app.route('/api/backups', methods=['GET'])
+def get_backups():
+    return jsonify(list_backups())
+
+@app.route('/api/backups', methods=['POST'])
+def create_backup_route():
+    try:
+        backup = create_backup()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(backup), 201
+
+@app.route('/api/backups/<name>/restore', methods=['POST'])
+def restore_backup_route(name):
+    try:
+        safety = restore_backup(name)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'message': 'База восстановлена', 'restored': name, 'safety_backup': safety['name']})
+
+# --- Архив ---
+@app.route('/api/archive', methods=['GET'])
+def get_archive():
+    return jsonify({
+        'available': archive_available(),
+        'boundary': archive_boundary().isoformat() if archive_boundary() else None,
+        'max_year': date.today().year - ARCHIVE_MIN_YEARS_BACK,
+        'years': [{
+            'year': state.year,
+            'rows': state.rows,
+            'archived_at': state.archived_at.isoformat() if state.archived_at else None
+        } for state in ArchivedYear.query.order_by(ArchivedYear.year).all()]
+    })
+
+@app.route('/api/archive', methods=['POST'])
+def archive_year_route():
+    year = (request.json or {}).get('year')
+    if not isinstance(year, int):
+        return jsonify({'error': 'Укажите год числом'}), 400
+    try:
+        moved = archive_year(year)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'message': f'Транзакции по {year} год перенесены в архив', 'moved': sum(moved.values()),
+                    'years': {str(archived): rows for archived, rows in sorted(moved.items())}})
+
 # --- Цели ---
 @app.route('/api/goals', methods=['GET'])
 def get_goals():
@@ -1049,6 +3391,7 @@ def update_goal(id):
     return jsonify({'message': 'Цель обновлена'})
 
 @app.route('/api/goals/<int:id>/add', methods=['POST'])
+@serialized_write
 def add_to_goal(id):
     goal = Goal.query.get_or_404(id)
     data = request.json
@@ -1075,35 +3418,83 @@ def delete_goal(id):
     return jsonify({'message': 'Цель удалена'})
 
 # --- Кредиты ---
+def parse_include():
+    """Набор вложенных коллекций, запрошенных через ?include=a,b"""
+    return {part.strip() for part in request.args.get('include', '').split(',') if part.strip()}
+
+def load_history(model, parent_column, parent_ids, limit=None):
+    """
+    История операций для набора родителей одним IN-запросом, от новых к старым:
+    {parent_id: [строки]}. limit ограничивает число строк на каждого родителя.
+    """
+    history = {parent_id: [] for parent_id in parent_ids}
+    if not parent_ids:
+        return history
+    
+    order = (model.date.desc(), model.id.desc())
+    if limit is None:
+        rows = model.query.filter(parent_column.in_(parent_ids)).order_by(parent_column, *order).all()
+    else:
+        ranked = db.select(
+            model.id,
+            db.func.row_number().over(partition_by=parent_column, order_by=order).label('rn')
+        ).where(parent_column.in_(parent_ids)).subquery()
+        rows = model.query.join(ranked, model.id == ranked.c.id).filter(
+            ranked.c.rn <= max(0, limit)
+        ).order_by(parent_column, *order).all()
+    
+    for row in rows:
+        history[getattr(row, parent_column.key)].append(row)
+    return history
+
+def serialize_credit_payment(p):
+    return {
+        'id': p.id,
+        'date': p.date.isoformat(),
+        'amount': p.amount,
+        'principal': p.principal,
+        'interest': p.interest,
+        'is_regular': p.is_regular,
+        'is_extra': p.is_extra,
+        'payment_number': p.payment_number,
+        'remaining_after': p.remaining_after,
+        'months_reduced': getattr(p, 'months_reduced', 0),
+        'notes': p.notes,
+        'is_manual': getattr(p, 'is_manual', False)
+    }
+
 @app.route('/api/credits', methods=['GET'])
 def get_credits():
+    # По умолчанию только сводка; история платежей — через ?include=payments
+    include_payments = 'payments' in parse_include()
+    payments_limit = request.args.get('payments_limit', type=int)
+    
     credits = Credit.query.order_by(Credit.next_payment_date).all()
     today = date.today()
+    credit_ids = [c.id for c in credits]
+    
+    payment_totals = {}
+    if credit_ids:
+        payment_totals = {row.credit_id: row for row in db.session.query(
+            CreditPayment.credit_id,
+            db.func.count(CreditPayment.id).label('count'),
+            db.func.sum(CreditPayment.amount).label('amount'),
+            db.func.sum(CreditPayment.interest).label('interest')
+        ).filter(
+            CreditPayment.credit_id.in_(credit_ids)
+        ).group_by(CreditPayment.credit_id).all()}
+    
+    payments = load_history(CreditPayment, CreditPayment.credit_id, credit_ids, payments_limit) if include_payments else {}
     
     result = []
     for c in credits:
-        payments = CreditPayment.query.filter_by(credit_id=c.id).order_by(CreditPayment.date.desc()).all()
-        
         days_until_payment = (c.next_payment_date - today).days if c.next_payment_date else None
         
         progress = round((c.original_amount - c.remaining_amount) / c.original_amount * 100, 1) if c.original_amount > 0 else 0
         
-        payments_history = [{
-            'id': p.id,
-            'date': p.date.isoformat(),
-            'amount': p.amount,
-            'principal': p.principal,
-            'interest': p.interest,
-            'is_regular': p.is_regular,
-            'is_extra': p.is_extra,
-            'payment_number': p.payment_number,
-            'remaining_after': p.remaining_after,
-            'months_reduced': getattr(p, 'months_reduced', 0),
-            'notes': p.notes,
-            'is_manual': getattr(p, 'is_manual', False)
-        } for p in payments]
+        totals = payment_totals.get(c.id)
         
-        result.append({
+        data = {
             'id': c.id,
             'name': c.name,
             'credit_type': c.credit_type,
@@ -1120,9 +3511,15 @@ def get_credits():
             'days_until_payment': days_until_payment,
             'progress': progress,
             'extra_payments_total': c.extra_payments_total,
-            'payments_history': payments_history,
+            'payments_count': totals.count if totals else 0,
+            'total_paid': round(totals.amount or 0, 2) if totals else 0,
+            'total_interest_paid': round(totals.interest or 0, 2) if totals else 0,
             'is_payment_soon': days_until_payment is not None and days_until_payment <= 5
-        })
+        }
+        if include_payments:
+            data['payments_history'] = [serialize_credit_payment(p) for p in payments[c.id]]
+        
+        result.append(data)
     
     return jsonify(result)
 
@@ -1286,6 +3683,7 @@ def update_credit(id):
     return jsonify({'message': 'Кредит обновлён'})
 
 @app.route('/api/credits/<int:id>/pay', methods=['POST'])
+@serialized_write
 def pay_credit(id):
     credit = Credit.query.get_or_404(id)
     data = request.json
@@ -1351,6 +3749,7 @@ def pay_credit(id):
         notes=data.get('notes', f'{"Досрочное погашение" if is_extra else "Ежемесячный платёж"}')
     )
     db.session.add(payment)
+    post_credit_payment(payment)
     
     if credit.remaining_amount > 0 and not is_extra:
         credit.next_payment_date = credit.next_payment_date + relativedelta(months=1)
@@ -1370,6 +3769,7 @@ def pay_credit(id):
 
 @app.route('/api/credits/<int:id>', methods=['DELETE'])
 def delete_credit(id):
+    unpost_entries('credit_payment', db.select(CreditPayment.id).where(CreditPayment.credit_id == id))
     CreditPayment.query.filter_by(credit_id=id).delete()
     credit = Credit.query.get_or_404(id)
     db.session.delete(credit)
@@ -1378,6 +3778,7 @@ def delete_credit(id):
 
 
 @app.route('/api/credits/<int:id>/payments', methods=['POST'])
+@serialized_write
 def add_credit_payment(id):
     credit = Credit.query.get_or_404(id)
     data = request.json
@@ -1396,6 +3797,7 @@ def add_credit_payment(id):
         is_manual=data.get('is_manual', True)
     )
     db.session.add(payment)
+    post_credit_payment(payment)
     db.session.commit()
     
     return jsonify({
@@ -1408,25 +3810,14 @@ def add_credit_payment(id):
 def get_credit_payments(id):
     payments = CreditPayment.query.filter_by(credit_id=id).order_by(CreditPayment.date.desc()).all()
     
-    return jsonify([{
-        'id': p.id,
-        'date': p.date.isoformat(),
-        'amount': p.amount,
-        'principal': p.principal,
-        'interest': p.interest,
-        'is_regular': p.is_regular,
-        'is_extra': p.is_extra,
-        'payment_number': p.payment_number,
-        'remaining_after': p.remaining_after,
-        'months_reduced': getattr(p, 'months_reduced', 0),
-        'notes': p.notes,
-        'is_manual': getattr(p, 'is_manual', False)
-    } for p in payments])
+    return jsonify([serialize_credit_payment(p) for p in payments])
 
 
 @app.route('/api/credits/<int:id>/payments/<int:payment_id>', methods=['DELETE'])
+@serialized_write
 def delete_credit_payment(id, payment_id):
     payment = CreditPayment.query.get_or_404(payment_id)
+    unpost_entries('credit_payment', [payment.id])
     db.session.delete(payment)
     db.session.commit()
     return jsonify({'message': 'Платёж удалён'})
@@ -1558,6 +3949,7 @@ def update_mortgage(id):
     return jsonify({'message': 'Ипотека обновлена'})
 
 @app.route('/api/mortgages/<int:id>/pay', methods=['POST'])
+@serialized_write
 def pay_mortgage(id):
     mortgage = Mortgage.query.get_or_404(id)
     data = request.json
@@ -1899,23 +4291,32 @@ def calculate_mortgage():
 # --- Магазины и цены ---
 @app.route('/api/stores', methods=['GET'])
 def get_stores():
-    stores = Store.query.all()
-    result = []
+    # Текущие цены и минимальная текущая цена товара среди всех магазинов
+    current = db.select(
+        ProductLatestPrice.store_id,
+        ProductLatestPrice.price,
+        db.func.min(ProductLatestPrice.price).over(
+            partition_by=ProductLatestPrice.product_id
+        ).label('min_price')
+    ).subquery()
+    
+    ratings = db.select(
+        current.c.store_id,
+        db.func.count().label('products_count'),
+        db.func.avg(db.case(
+            (current.c.min_price > 0, current.c.price / current.c.min_price)
+        )).label('avg_price_ratio')
+    ).group_by(current.c.store_id).subquery()
+    
+    stores = db.session.query(
+        Store,
+        ratings.c.products_count,
+        ratings.c.avg_price_ratio
+    ).outerjoin(ratings, Store.id == ratings.c.store_id).order_by(Store.id).all()
     
-    for s in stores:
-        prices = ProductPrice.query.filter_by(store_id=s.id).all()
-        avg_price_ratio = 0
-        
-        if prices:
-            ratios = []
-            for p in prices:
-                min_price = db.session.query(db.func.min(ProductPrice.price)).filter(
-                    ProductPrice.product_id == p.product_id
-                ).scalar()
-                if min_price and min_price > 0:
-                    ratios.append(p.price / min_price)
-            if ratios:
-                avg_price_ratio = sum(ratios) / len(ratios)
+    result = []
+    for s, products_count, avg_price_ratio in stores:
+        avg_price_ratio = avg_price_ratio or 0
         
         result.append({
             'id': s.id,
@@ -1924,7 +4325,7 @@ def get_stores():
             'address': s.address,
             'icon': s.icon,
             'color': s.color,
-            'products_count': len(prices),
+            'products_count': products_count or 0,
             'price_rating': round(5 - (avg_price_ratio - 1) * 2, 1) if avg_price_ratio > 0 else 0
         })
     
@@ -1959,39 +4360,116 @@ def update_store(id):
     return jsonify({'message': 'Магазин обновлён'})
 
 @app.route('/api/stores/<int:id>', methods=['DELETE'])
+@serialized_write
 def delete_store(id):
+    lock_for_write()
     ProductPrice.query.filter_by(store_id=id).delete()
-    Transaction.query.filter_by(store_id=id).update({'store_id': None})
+    ProductLatestPrice.query.filter_by(store_id=id).delete()
+    for source in transaction_sources():
+        rollup_apply_query(source.c.store_id == id, -1, source)
+        rollup_apply_query(source.c.store_id == id, source=source, store_id=None)
+        db.session.execute(source.update().where(source.c.store_id == id).values(store_id=None))
     store = Store.query.get_or_404(id)
     db.session.delete(store)
     db.session.commit()
-    return jsonify({'message': 'Магазин удалён'})
+    return jsonify({'message': 'Магазин удалён'})
+
+def upsert_latest_price(price):
+    """Обновляет последнюю цену товара в магазине, если price новее сохранённой"""
+    table = ProductLatestPrice.__table__
+    stmt = upsert_insert(table).values(
+        product_id=price.product_id,
+        store_id=price.store_id,
+        price_id=price.id,
+        price=price.price,
+        is_sale=bool(price.is_sale),
+        date=price.date
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['product_id', 'store_id'],
+        set_={
+            'price_id': stmt.excluded.price_id,
+            'price': stmt.excluded.price,
+            'is_sale': stmt.excluded.is_sale,
+            'date': stmt.excluded.date
+        },
+        where=db.or_(
+            stmt.excluded.date > table.c.date,
+            db.and_(stmt.excluded.date == table.c.date, stmt.excluded.price_id > table.c.price_id)
+        )
+    )
+    db.session.execute(stmt)
+
+def rebuild_product_latest_prices():
+    """Пересчитывает таблицу последних цен по всей истории ProductPrice"""
+    latest = db.select(
+        ProductPrice.product_id,
+        ProductPrice.store_id,
+        ProductPrice.id,
+        ProductPrice.price,
+        db.func.coalesce(ProductPrice.is_sale, False),
+        ProductPrice.date,
+        db.func.row_number().over(
+            partition_by=(ProductPrice.product_id, ProductPrice.store_id),
+            order_by=(ProductPrice.date.desc(), ProductPrice.id.desc())
+        ).label('rn')
+    ).where(
+        ProductPrice.product_id.isnot(None),
+        ProductPrice.store_id.isnot(None),
+        ProductPrice.date.isnot(None)
+    ).subquery()
+    
+    table = ProductLatestPrice.__table__
+    db.session.execute(table.delete())
+    db.session.execute(table.insert().from_select(
+        ['product_id', 'store_id', 'price_id', 'price', 'is_sale', 'date'],
+        db.select(*list(latest.c)[:6]).where(latest.c.rn == 1)
+    ))
+    db.session.commit()
 
 @app.route('/api/products', methods=['GET'])
 def get_products():
-    products = Product.query.order_by(Product.name).all()
-    result = []
+    rows = db.session.query(
+        Product,
+        ProductLatestPrice,
+        Store.name,
+        Store.icon
+    ).outerjoin(
+        ProductLatestPrice, ProductLatestPrice.product_id == Product.id
+    ).outerjoin(
+        Store, Store.id == ProductLatestPrice.store_id
+    ).order_by(
+        Product.name,
+        Product.id,
+        ProductLatestPrice.date.desc(),
+        ProductLatestPrice.price_id.desc()
+    ).all()
+    
+    products = []
+    store_prices_by_product = {}
+    for p, price, store_name, store_icon in rows:
+        if p.id not in store_prices_by_product:
+            products.append(p)
+            store_prices_by_product[p.id] = []
+        if price is not None and store_name is not None:
+            store_prices_by_product[p.id].append({
+                'store_id': price.store_id,
+                'store_name': store_name,
+                'store_icon': store_icon,
+                'price': price.price,
+                'is_sale': price.is_sale,
+                'date': price.date.isoformat()
+            })
     
+    result = []
     for p in products:
-        prices = ProductPrice.query.filter_by(product_id=p.id).order_by(ProductPrice.date.desc()).all()
-        
-        store_prices = {}
-        for price in prices:
-            if price.store_id not in store_prices:
-                store_prices[price.store_id] = {
-                    'store_id': price.store_id,
-                    'store_name': price.store.name,
-                    'store_icon': price.store.icon,
-                    'price': price.price,
-                    'is_sale': price.is_sale,
-                    'date': price.date.isoformat()
-                }
+        store_prices = store_prices_by_product[p.id]
         
-        min_price = min([sp['price'] for sp in store_prices.values()]) if store_prices else 0
-        max_price = max([sp['price'] for sp in store_prices.values()]) if store_prices else 0
+        min_price = min([sp['price'] for sp in store_prices]) if store_prices else 0
+        max_price = max([sp['price'] for sp in store_prices]) if store_prices else 0
         
         best_store = None
-        for sp in store_prices.values():
+        for sp in store_prices:
             if sp['price'] == min_price:
                 best_store = sp
                 break
@@ -2002,7 +4480,7 @@ def get_products():
             'category': p.category,
             'unit': p.unit,
             'icon': p.icon,
-            'prices': list(store_prices.values()),
+            'prices': store_prices,
             'min_price': min_price,
             'max_price': max_price,
             'price_diff': round(max_price - min_price, 2),
@@ -2039,6 +4517,7 @@ def update_product(id):
     return jsonify({'message': 'Товар обновлён'})
 
 @app.route('/api/products/<int:id>/prices', methods=['POST'])
+@serialized_write
 def add_product_price(id):
     data = request.json
     price = ProductPrice(
@@ -2049,54 +4528,77 @@ def add_product_price(id):
         date=datetime.strptime(data['date'], '%Y-%m-%d').date() if data.get('date') else date.today()
     )
     db.session.add(price)
+    db.session.flush()
+    upsert_latest_price(price)
     db.session.commit()
     return jsonify({'id': price.id, 'message': 'Цена добавлена'}), 201
 
 @app.route('/api/products/<int:id>', methods=['DELETE'])
 def delete_product(id):
     ProductPrice.query.filter_by(product_id=id).delete()
+    ProductLatestPrice.query.filter_by(product_id=id).delete()
     product = Product.query.get_or_404(id)
     db.session.delete(product)
     db.session.commit()
     return jsonify({'message': 'Товар удалён'})
 
 # --- Инвестиции ---
+def serialize_investment_transaction(t):
+    return {
+        'id': t.id,
+        'type': t.transaction_type,
+        'quantity': t.quantity,
+        'price': t.price,
+        'total_amount': t.total_amount,
+        'commission': t.commission,
+        'date': t.date.isoformat(),
+        'notes': t.notes
+    }
+
 @app.route('/api/investments', methods=['GET'])
 def get_investments():
     account_id = request.args.get('account_id', type=int)
+    # По умолчанию только сводка; история операций — через ?include=transactions
+    include_transactions = 'transactions' in parse_include()
+    transactions_limit = request.args.get('transactions_limit', type=int)
+    
     query = Investment.query
     if account_id:
         query = query.filter_by(account_id=account_id)
     
     investments = query.order_by(Investment.asset_type, Investment.ticker).all()
-    result = []
+    investment_ids = [i.id for i in investments]
+    
+    is_buy = InvestmentTransaction.transaction_type == 'buy'
+    transaction_totals = {}
+    if investment_ids:
+        transaction_totals = {row.investment_id: row for row in db.session.query(
+            InvestmentTransaction.investment_id,
+            db.func.count(InvestmentTransaction.id).label('count'),
+            db.func.sum(db.case((is_buy, InvestmentTransaction.quantity))).label('bought'),
+            db.func.sum(db.case(
+                (is_buy, InvestmentTransaction.total_amount + InvestmentTransaction.commission)
+            )).label('spent')
+        ).filter(
+            InvestmentTransaction.investment_id.in_(investment_ids)
+        ).group_by(InvestmentTransaction.investment_id).all()}
+    
+    transactions = load_history(
+        InvestmentTransaction, InvestmentTransaction.investment_id, investment_ids, transactions_limit
+    ) if include_transactions else {}
     
+    result = []
     for i in investments:
         invested = i.quantity * i.avg_buy_price
         current_value = i.quantity * i.current_price
         profit = current_value - invested
         profit_percent = (profit / invested * 100) if invested > 0 else 0
         
-        transactions = InvestmentTransaction.query.filter_by(
-            investment_id=i.id
-        ).order_by(InvestmentTransaction.date.desc()).all()
-        
-        transactions_data = [{
-            'id': t.id,
-            'type': t.transaction_type,
-            'quantity': t.quantity,
-            'price': t.price,
-            'total_amount': t.total_amount,
-            'commission': t.commission,
-            'date': t.date.isoformat(),
-            'notes': t.notes
-        } for t in transactions]
-        
-        buy_transactions = [t for t in transactions if t.transaction_type == 'buy']
-        total_bought = sum(t.quantity for t in buy_transactions)
-        total_spent = sum(t.total_amount + t.commission for t in buy_transactions)
+        totals = transaction_totals.get(i.id)
+        total_bought = (totals.bought or 0) if totals else 0
+        total_spent = (totals.spent or 0) if totals else 0
         
-        result.append({
+        data = {
             'id': i.id,
             'account_id': i.account_id,
             'ticker': i.ticker,
@@ -2114,11 +4616,14 @@ def get_investments():
             'dividends_received': i.dividends_received,
             'total_return': round(profit + i.dividends_received, 2),
             'last_updated': i.last_updated.isoformat(),
-            'transactions': transactions_data,
-            'transactions_count': len(transactions),
+            'transactions_count': totals.count if totals else 0,
             'total_bought_quantity': total_bought,
             'total_spent': round(total_spent, 2)
-        })
+        }
+        if include_transactions:
+            data['transactions'] = [serialize_investment_transaction(t) for t in transactions[i.id]]
+        
+        result.append(data)
     
     return jsonify(result)
 
@@ -2150,6 +4655,7 @@ def create_investment():
             notes=data.get('notes', '')
         )
         db.session.add(trans)
+        post_investment_transaction(trans)
         db.session.commit()
         
         return jsonify({'id': existing.id, 'message': 'Позиция пополнена'}), 200
@@ -2179,6 +4685,7 @@ def create_investment():
         notes=data.get('notes', 'Первая покупка')
     )
     db.session.add(trans)
+    post_investment_transaction(trans)
     db.session.commit()
     
     return jsonify({'id': investment.id, 'message': 'Инвестиция добавлена'}), 201
@@ -2202,6 +4709,7 @@ def update_investment(id):
     return jsonify({'message': 'Инвестиция обновлена'})
 
 @app.route('/api/investments/<int:id>/buy', methods=['POST'])
+@serialized_write
 def buy_investment(id):
     investment = Investment.query.get_or_404(id)
     data = request.json
@@ -2227,6 +4735,7 @@ def buy_investment(id):
         notes=data.get('notes', '')
     )
     db.session.add(trans)
+    post_investment_transaction(trans)
     db.session.commit()
     
     return jsonify({
@@ -2237,6 +4746,7 @@ def buy_investment(id):
 
 
 @app.route('/api/investments/<int:id>/sell', methods=['POST'])
+@serialized_write
 def sell_investment(id):
     investment = Investment.query.get_or_404(id)
     data = request.json
@@ -2264,6 +4774,7 @@ def sell_investment(id):
         notes=data.get('notes', f'Прибыль: {profit:.2f}')
     )
     db.session.add(trans)
+    post_investment_transaction(trans)
     
     if investment.quantity == 0:
         db.session.delete(investment)
@@ -2276,6 +4787,7 @@ def sell_investment(id):
     })
 
 @app.route('/api/investments/<int:id>/dividend', methods=['POST'])
+@serialized_write
 def add_dividend(id):
     investment = Investment.query.get_or_404(id)
     data = request.json
@@ -2295,6 +4807,7 @@ def add_dividend(id):
         notes=data.get('notes', 'Дивиденды')
     )
     db.session.add(trans)
+    post_investment_transaction(trans)
     db.session.commit()
     
     return jsonify({
@@ -2307,21 +4820,13 @@ def add_dividend(id):
 def get_investment_transactions(id):
     transactions = InvestmentTransaction.query.filter_by(
         investment_id=id
-    ).order_by(InvestmentTransaction.date.desc()).all()
+    ).order_by(InvestmentTransaction.date.desc(), InvestmentTransaction.id.desc()).all()
     
-    return jsonify([{
-        'id': t.id,
-        'type': t.transaction_type,
-        'quantity': t.quantity,
-        'price': t.price,
-        'total_amount': t.total_amount,
-        'commission': t.commission,
-        'date': t.date.isoformat(),
-        'notes': t.notes
-    } for t in transactions])
+    return jsonify([serialize_investment_transaction(t) for t in transactions])
 
 
 @app.route('/api/investments/transactions/<int:id>', methods=['DELETE'])
+@serialized_write
 def delete_investment_transaction(id):
     trans = InvestmentTransaction.query.get_or_404(id)
     investment = trans.investment
@@ -2343,6 +4848,7 @@ def delete_investment_transaction(id):
     elif trans.transaction_type == 'dividend':
         investment.dividends_received -= trans.total_amount
     
+    unpost_entries('investment_transaction', [trans.id])
     db.session.delete(trans)
     
     if investment.quantity <= 0:
@@ -2353,6 +4859,9 @@ def delete_investment_transaction(id):
 
 @app.route('/api/investments/<int:id>', methods=['DELETE'])
 def delete_investment(id):
+    unpost_entries('investment_transaction', db.select(InvestmentTransaction.id).where(
+        InvestmentTransaction.investment_id == id
+    ))
     InvestmentTransaction.query.filter_by(investment_id=id).delete()
     investment = Investment.query.get_or_404(id)
     db.session.delete(investment)
@@ -2416,8 +4925,11 @@ def get_investments_summary():
 def get_taxes():
     year = request.args.get('year', date.today().year, type=int)
     
+    year_start, next_year_start = date(year, 1, 1), date(year + 1, 1, 1)
+    
     payments = TaxPayment.query.filter(
-        db.extract('year', TaxPayment.period_start) == year
+        TaxPayment.period_start >= year_start,
+        TaxPayment.period_start < next_year_start
     ).order_by(TaxPayment.due_date).all()
     
     reserves = db.session.query(
@@ -2427,7 +4939,8 @@ def get_taxes():
         db.func.sum(TaxReserve.tax_amount).label('total_tax'),
         db.func.sum(db.case((TaxReserve.is_transferred == False, TaxReserve.tax_amount), else_=0)).label('pending_tax')
     ).join(Account, TaxReserve.business_account_id == Account.id).filter(
-        db.extract('year', TaxReserve.date) == year
+        TaxReserve.date >= year_start,
+        TaxReserve.date < next_year_start
     ).group_by(TaxReserve.business_account_id, Account.name).all()
     
     tax_reserve_accounts = Account.query.filter_by(is_tax_reserve=True).all()
@@ -2509,6 +5022,7 @@ def delete_tax_payment(id):
     return jsonify({'message': 'Налог удалён'})
 
 @app.route('/api/taxes/<int:id>/pay', methods=['POST'])
+@serialized_write
 def pay_tax(id):
     payment = TaxPayment.query.get_or_404(id)
     payment.is_paid = True
@@ -2517,10 +5031,12 @@ def pay_tax(id):
     return jsonify({'message': 'Налог оплачен'})
 
 @app.route('/api/taxes/transfer', methods=['POST'])
+@serialized_write
 def transfer_tax_reserve():
     data = request.json
     business_account_id = data['business_account_id']
     tax_account_id = data['tax_account_id']
+    lock_for_write()
     
     pending = db.session.query(db.func.sum(TaxReserve.tax_amount)).filter(
         TaxReserve.business_account_id == business_account_id,
@@ -2530,12 +5046,6 @@ def transfer_tax_reserve():
     if pending <= 0:
         return jsonify({'error': 'Нет средств для перевода'}), 400
     
-    business_account = Account.query.get(business_account_id)
-    tax_account = Account.query.get(tax_account_id)
-    
-    business_account.balance -= pending
-    tax_account.balance += pending
-    
     TaxReserve.query.filter_by(
         business_account_id=business_account_id,
         is_transferred=False
@@ -2551,6 +5061,8 @@ def transfer_tax_reserve():
         date=date.today()
     )
     db.session.add(transaction)
+    post_transaction(transaction)
+    rollup_add(transaction)
     db.session.commit()
     
     return jsonify({
@@ -2634,6 +5146,9 @@ def ai_analyze():
 
 Отвечай на русском, структурированно, с эмодзи. Будь конкретным и полезным."""
 
+    # requests нужен только этому маршруту: импорт при первом вызове не замедляет старт воркера
+    import requests
+    
     try:
         response = requests.post(
             DEEPSEEK_API_URL,
@@ -2691,16 +5206,13 @@ def ai_analyze():
 def ai_tips():
     tips = []
     today = date.today()
-    first_day = today.replace(day=1)
+    
+    month_totals = get_month_category_totals()
     
     over_budget = []
     categories = Category.query.filter(Category.budget_limit > 0, Category.type == 'expense').all()
     for cat in categories:
-        spent = db.session.query(db.func.sum(Transaction.amount)).filter(
-            Transaction.category_id == cat.id,
-            Transaction.date >= first_day,
-            Transaction.type == 'expense'
-        ).scalar() or 0
+        spent = month_totals.get((cat.id, 'expense')) or 0
         if spent > cat.budget_limit:
             over_budget.append({
                 'category': cat.name,
@@ -2718,15 +5230,8 @@ def ai_tips():
             'message': f"Превышен бюджет в {len(over_budget)} категориях. Самое большое превышение: {over_budget[0]['icon']} {over_budget[0]['category']} (+{over_budget[0]['over']:,.0f} ₽)"
         })
     
-    income = db.session.query(db.func.sum(Transaction.amount)).filter(
-        Transaction.type == 'income',
-        Transaction.date >= first_day
-    ).scalar() or 0
-    
-    expense = db.session.query(db.func.sum(Transaction.amount)).filter(
-        Transaction.type == 'expense',
-        Transaction.date >= first_day
-    ).scalar() or 0
+    income = sum(total for (_, type_), total in month_totals.items() if type_ == 'income') or 0
+    expense = sum(total for (_, type_), total in month_totals.items() if type_ == 'expense') or 0
     
     if income > 0:
         savings_rate = (income - expense) / income * 100
@@ -2773,94 +5278,129 @@ def ai_tips():
 
 # --- Статистика и дашборд ---
 
+def aggregate_transactions_by_month(start_date, credit_card_ids, non_credit_card_ids, has_business_column=True):
+    """
+    Считает суммы транзакций по месяцам начиная с start_date (первое число месяца).
+    Возвращает {'YYYY-MM': {корзина: сумма}}, корзины — доходы, расходы
+    (в т.ч. личные/бизнес) и погашения кредиток, кредитов и ипотеки.
+    Доходы и расходы берутся из помесячных итогов, погашения — одним GROUP BY по переводам.
+    """
+    result = {}
+    
+    for (month, type_, is_business), (total, _) in rollup_totals(
+        ('month', 'type', 'is_business_expense'), start_date
+    ).items():
+        if type_ not in ('income', 'expense'):
+            continue
+        values = result.setdefault(month, {})
+        values[type_] = values.get(type_, 0) + total
+        if type_ == 'expense' and has_business_column:
+            bucket = 'expense_business' if is_business else 'expense_personal'
+            values[bucket] = values.get(bucket, 0) + total
+    
+    buckets = {
+        # Погашение кредитов (переводы с описанием про кредит, но НЕ на кредитные карты)
+        'credit_payments': db.and_(
+            ~Transaction.to_account_id.in_(credit_card_ids) if credit_card_ids else db.true(),
+            db.or_(
+                text_contains(Transaction.description, 'кредит'),
+                text_contains(Transaction.description, 'погашение кредит')
+            )
+        ),
+        # Погашение ипотеки (переводы с описанием про ипотеку)
+        'mortgage_payments': text_contains(Transaction.description, 'ипотек'),
+    }
+    
+    # Погашение кредитных карт (переводы С обычного счёта НА кредитку)
+    if credit_card_ids and non_credit_card_ids:
+        buckets['credit_card_payments'] = db.and_(
+            Transaction.account_id.in_(non_credit_card_ids),
+            Transaction.to_account_id.in_(credit_card_ids)
+        )
+    
+    month = date_bucket(Transaction.date).label('month')
+    rows = db.session.query(
+        month,
+        *[db.func.sum(db.case((condition, Transaction.amount))).label(name)
+          for name, condition in buckets.items()]
+    ).filter(
+        Transaction.type == 'transfer',
+        Transaction.is_tax_transfer == False,
+        Transaction.date >= start_date
+    ).group_by(month).all()
+    
+    for row in rows:
+        values = result.setdefault(row.month, {})
+        for name in buckets:
+            values[name] = getattr(row, name) or 0
+    
+    for values in result.values():
+        for name, total in values.items():
+            values[name] = total or 0
+    return result
+
+def sum_month_buckets(monthly, name, start_month, end_month=None):
+    """Сумма корзины за диапазон месяцев 'YYYY-MM' (end_month=None — без верхней границы)"""
+    return sum(
+        values.get(name, 0) for month, values in monthly.items()
+        if month >= start_month and (end_month is None or month <= end_month)
+    ) or 0
+
 @app.route('/api/dashboard', methods=['GET'])
 def get_dashboard():
     today = date.today()
     first_day_month = today.replace(day=1)
     first_day_year = today.replace(month=1, day=1)
     last_month_start = (first_day_month - timedelta(days=1)).replace(day=1)
-    last_month_end = first_day_month - timedelta(days=1)
+    trends_start = (today - relativedelta(months=5)).replace(day=1)
+    
+    current_month = first_day_month.strftime('%Y-%m')
+    last_month = last_month_start.strftime('%Y-%m')
+    current_year = first_day_year.strftime('%Y-%m')
     
     accounts = Account.query.all()
     total_balance = sum(a.balance for a in accounts if a.account_type not in ['credit_card'])
     
-    total_credit_debt = 0
-    for a in accounts:
-        if a.account_type == 'credit_card':
-            card = CreditCard.query.filter_by(account_id=a.id).first()
-            if card:
-                total_credit_debt += card.current_debt
-    
     # Получаем ID кредитных и не-кредитных карт
     credit_card_ids = [a.id for a in accounts if a.account_type == 'credit_card']
     non_credit_card_ids = [a.id for a in accounts if a.account_type != 'credit_card']
     
-    # Доходы за месяц
-    monthly_income = db.session.query(db.func.sum(Transaction.amount)).filter(
-        Transaction.type == 'income',
-        Transaction.date >= first_day_month
-    ).scalar() or 0
+    cards_by_account = {}
+    if credit_card_ids:
+        for card in CreditCard.query.filter(
+            CreditCard.account_id.in_(credit_card_ids)
+        ).order_by(CreditCard.id).all():
+            cards_by_account.setdefault(card.account_id, card)
+    total_credit_debt = 0
+    for account_id in credit_card_ids:
+        if account_id in cards_by_account:
+            total_credit_debt += cards_by_account[account_id].current_debt
+    
+    # Проверяем наличие колонки is_business_expense (по кэшу схемы процесса)
+    has_business_column = schema_has_column('transaction', 'is_business_expense')
+    
+    # Все месячные суммы (текущий/прошлый месяц, год, тренды) — одним запросом
+    monthly = aggregate_transactions_by_month(
+        min(first_day_year, last_month_start, trends_start),
+        credit_card_ids,
+        non_credit_card_ids,
+        has_business_column
+    )
     
-    # Проверяем наличие колонки is_business_expense
-    has_business_column = True
-    try:
-        from sqlalchemy import inspect
-        inspector = inspect(db.engine)
-        columns = [c['name'] for c in inspector.get_columns('transaction')]
-        has_business_column = 'is_business_expense' in columns
-    except:
-        has_business_column = False
+    # Доходы за месяц
+    monthly_income = sum_month_buckets(monthly, 'income', current_month)
     
     # Прямые расходы (тип expense)
     if has_business_column:
-        monthly_expense_personal = db.session.query(db.func.sum(Transaction.amount)).filter(
-            Transaction.type == 'expense',
-            Transaction.date >= first_day_month,
-            Transaction.is_business_expense == False
-        ).scalar() or 0
-        
-        monthly_expense_business = db.session.query(db.func.sum(Transaction.amount)).filter(
-            Transaction.type == 'expense',
-            Transaction.date >= first_day_month,
-            Transaction.is_business_expense == True
-        ).scalar() or 0
+        monthly_expense_personal = sum_month_buckets(monthly, 'expense_personal', current_month)
+        monthly_expense_business = sum_month_buckets(monthly, 'expense_business', current_month)
     else:
-        monthly_expense_personal = db.session.query(db.func.sum(Transaction.amount)).filter(
-            Transaction.type == 'expense',
-            Transaction.date >= first_day_month
-        ).scalar() or 0
+        monthly_expense_personal = sum_month_buckets(monthly, 'expense', current_month)
         monthly_expense_business = 0
     
-    # Погашение кредитных карт (переводы С обычного счёта НА кредитку)
-    credit_card_payments = 0
-    if credit_card_ids and non_credit_card_ids:
-        credit_card_payments = db.session.query(db.func.sum(Transaction.amount)).filter(
-            Transaction.type == 'transfer',
-            Transaction.date >= first_day_month,
-            Transaction.account_id.in_(non_credit_card_ids),
-            Transaction.to_account_id.in_(credit_card_ids),
-            Transaction.is_tax_transfer == False
-        ).scalar() or 0
-    
-    # Погашение кредитов (переводы с описанием про кредит, но НЕ на кредитные карты)
-    credit_payments_month = db.session.query(db.func.sum(Transaction.amount)).filter(
-        Transaction.type == 'transfer',
-        Transaction.date >= first_day_month,
-        Transaction.is_tax_transfer == False,
-        ~Transaction.to_account_id.in_(credit_card_ids) if credit_card_ids else True,
-        db.or_(
-            Transaction.description.ilike('%кредит%'),
-            Transaction.description.ilike('%погашение кредит%')
-        )
-    ).scalar() or 0
-    
-    # Погашение ипотеки (переводы с описанием про ипотеку)
-    mortgage_payments_month = db.session.query(db.func.sum(Transaction.amount)).filter(
-        Transaction.type == 'transfer',
-        Transaction.date >= first_day_month,
-        Transaction.is_tax_transfer == False,
-        Transaction.description.ilike('%ипотек%')
-    ).scalar() or 0
+    credit_card_payments = sum_month_buckets(monthly, 'credit_card_payments', current_month)
+    credit_payments_month = sum_month_buckets(monthly, 'credit_payments', current_month)
+    mortgage_payments_month = sum_month_buckets(monthly, 'mortgage_payments', current_month)
     
     # Общая сумма погашения долгов
     total_debt_payments = credit_card_payments + credit_payments_month + mortgage_payments_month
@@ -2869,67 +5409,19 @@ def get_dashboard():
     monthly_expense = monthly_expense_personal + monthly_expense_business + total_debt_payments
     
     # Данные за прошлый месяц для сравнения
-    last_month_income = db.session.query(db.func.sum(Transaction.amount)).filter(
-        Transaction.type == 'income',
-        Transaction.date >= last_month_start,
-        Transaction.date <= last_month_end
-    ).scalar() or 0
-    
-    # Прошлый месяц - прямые расходы
-    last_month_expense_direct = db.session.query(db.func.sum(Transaction.amount)).filter(
-        Transaction.type == 'expense',
-        Transaction.date >= last_month_start,
-        Transaction.date <= last_month_end
-    ).scalar() or 0
-    
-    # Прошлый месяц - погашение кредиток
-    last_month_cc_payments = 0
-    if credit_card_ids and non_credit_card_ids:
-        last_month_cc_payments = db.session.query(db.func.sum(Transaction.amount)).filter(
-            Transaction.type == 'transfer',
-            Transaction.date >= last_month_start,
-            Transaction.date <= last_month_end,
-            Transaction.account_id.in_(non_credit_card_ids),
-            Transaction.to_account_id.in_(credit_card_ids),
-            Transaction.is_tax_transfer == False
-        ).scalar() or 0
-    
-    # Прошлый месяц - погашение кредитов
-    last_month_credit_payments = db.session.query(db.func.sum(Transaction.amount)).filter(
-        Transaction.type == 'transfer',
-        Transaction.date >= last_month_start,
-        Transaction.date <= last_month_end,
-        Transaction.is_tax_transfer == False,
-        ~Transaction.to_account_id.in_(credit_card_ids) if credit_card_ids else True,
-        db.or_(
-            Transaction.description.ilike('%кредит%'),
-            Transaction.description.ilike('%погашение кредит%')
-        )
-    ).scalar() or 0
-    
-    # Прошлый месяц - погашение ипотеки
-    last_month_mortgage_payments = db.session.query(db.func.sum(Transaction.amount)).filter(
-        Transaction.type == 'transfer',
-        Transaction.date >= last_month_start,
-        Transaction.date <= last_month_end,
-        Transaction.is_tax_transfer == False,
-        Transaction.description.ilike('%ипотек%')
-    ).scalar() or 0
+    last_month_income = sum_month_buckets(monthly, 'income', last_month, last_month)
+    last_month_expense_direct = sum_month_buckets(monthly, 'expense', last_month, last_month)
+    last_month_cc_payments = sum_month_buckets(monthly, 'credit_card_payments', last_month, last_month)
+    last_month_credit_payments = sum_month_buckets(monthly, 'credit_payments', last_month, last_month)
+    last_month_mortgage_payments = sum_month_buckets(monthly, 'mortgage_payments', last_month, last_month)
     
     # Общие расходы прошлого месяца
     last_month_expense = (last_month_expense_direct + last_month_cc_payments + 
                           last_month_credit_payments + last_month_mortgage_payments)
     
     # Годовые показатели
-    yearly_income = db.session.query(db.func.sum(Transaction.amount)).filter(
-        Transaction.type == 'income',
-        Transaction.date >= first_day_year
-    ).scalar() or 0
-    
-    yearly_expense = db.session.query(db.func.sum(Transaction.amount)).filter(
-        Transaction.type == 'expense',
-        Transaction.date >= first_day_year
-    ).scalar() or 0
+    yearly_income = sum_month_buckets(monthly, 'income', current_year)
+    yearly_expense = sum_month_buckets(monthly, 'expense', current_year)
     
     # Цели
     goals = Goal.query.filter_by(is_completed=False).all()
@@ -3011,12 +5503,9 @@ def get_dashboard():
     # Превышение бюджета
     over_budget_categories = []
     categories = Category.query.filter(Category.budget_limit > 0, Category.type == 'expense').all()
+    month_totals = get_month_category_totals()
     for cat in categories:
-        spent = db.session.query(db.func.sum(Transaction.amount)).filter(
-            Transaction.category_id == cat.id,
-            Transaction.date >= first_day_month,
-            Transaction.type == 'expense'
-        ).scalar() or 0
+        spent = month_totals.get((cat.id, 'expense')) or 0
         if spent > cat.budget_limit:
             over_budget_categories.append({
                 'id': cat.id,
@@ -3031,55 +5520,14 @@ def get_dashboard():
     trends = []
     for i in range(5, -1, -1):
         month_start = (today - relativedelta(months=i)).replace(day=1)
-        month_end = (month_start + relativedelta(months=1)) - timedelta(days=1)
-        
-        # Доходы
-        income = db.session.query(db.func.sum(Transaction.amount)).filter(
-            Transaction.type == 'income',
-            Transaction.date >= month_start,
-            Transaction.date <= month_end
-        ).scalar() or 0
-        
-        # Прямые расходы (тип expense)
-        expense_direct = db.session.query(db.func.sum(Transaction.amount)).filter(
-            Transaction.type == 'expense',
-            Transaction.date >= month_start,
-            Transaction.date <= month_end
-        ).scalar() or 0
-        
-        # Погашение кредиток
-        cc_payments = 0
-        if credit_card_ids and non_credit_card_ids:
-            cc_payments = db.session.query(db.func.sum(Transaction.amount)).filter(
-                Transaction.type == 'transfer',
-                Transaction.date >= month_start,
-                Transaction.date <= month_end,
-                Transaction.account_id.in_(non_credit_card_ids),
-                Transaction.to_account_id.in_(credit_card_ids),
-                Transaction.is_tax_transfer == False
-            ).scalar() or 0
-        
-        # Погашение кредитов
-        credit_pay = db.session.query(db.func.sum(Transaction.amount)).filter(
-            Transaction.type == 'transfer',
-            Transaction.date >= month_start,
-            Transaction.date <= month_end,
-            Transaction.is_tax_transfer == False,
-            ~Transaction.to_account_id.in_(credit_card_ids) if credit_card_ids else True,
-            db.or_(
-                Transaction.description.ilike('%кредит%'),
-                Transaction.description.ilike('%погашение кредит%')
-            )
-        ).scalar() or 0
+        month = month_start.strftime('%Y-%m')
+        values = monthly.get(month, {})
         
-        # Погашение ипотеки
-        mortgage_pay = db.session.query(db.func.sum(Transaction.amount)).filter(
-            Transaction.type == 'transfer',
-            Transaction.date >= month_start,
-            Transaction.date <= month_end,
-            Transaction.is_tax_transfer == False,
-            Transaction.description.ilike('%ипотек%')
-        ).scalar() or 0
+        income = values.get('income', 0)
+        expense_direct = values.get('expense', 0)
+        cc_payments = values.get('credit_card_payments', 0)
+        credit_pay = values.get('credit_payments', 0)
+        mortgage_pay = values.get('mortgage_payments', 0)
         
         # Общие расходы = прямые расходы + погашение долгов
         total_expense = expense_direct + cc_payments + credit_pay + mortgage_pay
@@ -3089,16 +5537,11 @@ def get_dashboard():
         expense_business = 0
         
         if has_business_column:
-            expense_business = db.session.query(db.func.sum(Transaction.amount)).filter(
-                Transaction.type == 'expense',
-                Transaction.date >= month_start,
-                Transaction.date <= month_end,
-                Transaction.is_business_expense == True
-            ).scalar() or 0
+            expense_business = values.get('expense_business', 0)
             expense_personal = expense_direct - expense_business
         
         trends.append({
-            'month': month_start.strftime('%Y-%m'),
+            'month': month,
             'month_name': month_start.strftime('%B'),
             'income': income,
             'expense': total_expense,
@@ -3178,84 +5621,68 @@ def get_stats_by_category():
     end_date = request.args.get('end_date')
     type_filter = request.args.get('type', 'expense')
     
-    query = db.session.query(
-        Category.id,
-        Category.name,
-        Category.color,
-        Category.icon,
-        db.func.sum(Transaction.amount).label('total')
-    ).join(Transaction).filter(Transaction.type == type_filter)
-    
-    if start_date:
-        query = query.filter(Transaction.date >= datetime.strptime(start_date, '%Y-%m-%d').date())
-    if end_date:
-        query = query.filter(Transaction.date <= datetime.strptime(end_date, '%Y-%m-%d').date())
+    totals = rollup_totals(
+        'category_id',
+        datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else None,
+        datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else None,
+        type=type_filter
+    )
     
-    results = query.group_by(Category.id).order_by(db.desc('total')).all()
+    categories = Category.query.filter(Category.id.in_(list(totals))).all()
+    results = sorted(categories, key=lambda c: totals[c.id][0], reverse=True)
     
-    total = sum(r.total for r in results)
+    total = sum(totals[c.id][0] for c in results)
     
     return jsonify([{
-        'id': r.id,
-        'name': r.name,
-        'color': r.color,
-        'icon': r.icon,
-        'total': r.total,
-        'percent': round(r.total / total * 100, 1) if total > 0 else 0
-    } for r in results])
+        'id': c.id,
+        'name': c.name,
+        'color': c.color,
+        'icon': c.icon,
+        'total': totals[c.id][0],
+        'percent': round(totals[c.id][0] / total * 100, 1) if total > 0 else 0
+    } for c in results])
 
 @app.route('/api/stats/by-store', methods=['GET'])
 def get_stats_by_store():
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
     
-    query = db.session.query(
-        Store.id,
-        Store.name,
-        Store.icon,
-        Store.color,
-        db.func.sum(Transaction.amount).label('total'),
-        db.func.count(Transaction.id).label('count')
-    ).join(Transaction).filter(Transaction.type == 'expense')
-    
-    if start_date:
-        query = query.filter(Transaction.date >= datetime.strptime(start_date, '%Y-%m-%d').date())
-    if end_date:
-        query = query.filter(Transaction.date <= datetime.strptime(end_date, '%Y-%m-%d').date())
+    totals = rollup_totals(
+        'store_id',
+        datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else None,
+        datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else None,
+        type='expense'
+    )
     
-    results = query.group_by(Store.id).order_by(db.desc('total')).all()
+    stores = Store.query.filter(Store.id.in_(list(totals))).all()
+    results = sorted(stores, key=lambda s: totals[s.id][0], reverse=True)
     
     return jsonify([{
-        'id': r.id,
-        'name': r.name,
-        'icon': r.icon,
-        'color': r.color,
-        'total': r.total,
-        'count': r.count,
-        'avg_check': round(r.total / r.count, 2) if r.count > 0 else 0
-    } for r in results])
+        'id': s.id,
+        'name': s.name,
+        'icon': s.icon,
+        'color': s.color,
+        'total': totals[s.id][0],
+        'count': totals[s.id][1],
+        'avg_check': round(totals[s.id][0] / totals[s.id][1], 2) if totals[s.id][1] > 0 else 0
+    } for s in results])
 
 @app.route('/api/stats/trends', methods=['GET'])
 def get_trends():
     months = request.args.get('months', 12, type=int)
     today = date.today()
     
+    first_month = (today - relativedelta(months=months - 1)).replace(day=1)
+    last_month_end = (today.replace(day=1) + relativedelta(months=1)) - timedelta(days=1)
+    totals = rollup_totals(('month', 'type'), first_month, last_month_end)
+    
     trends = []
     for i in range(months - 1, -1, -1):
         month_start = (today - relativedelta(months=i)).replace(day=1)
-        month_end = (month_start + relativedelta(months=1)) - timedelta(days=1)
-        
-        income = db.session.query(db.func.sum(Transaction.amount)).filter(
-            Transaction.type == 'income',
-            Transaction.date >= month_start,
-            Transaction.date <= month_end
-        ).scalar() or 0
+        month = month_start.strftime('%Y-%m')
         
-        expense = db.session.query(db.func.sum(Transaction.amount)).filter(
-            Transaction.type == 'expense',
-            Transaction.date >= month_start,
-            Transaction.date <= month_end
-        ).scalar() or 0
+        income = totals.get((month, 'income'), (0, 0))[0] or 0
+        expense = totals.get((month, 'expense'), (0, 0))[0] or 0
         
         trends.append({
             'month': month_start.strftime('%Y-%m'),
@@ -3271,8 +5698,6 @@ def get_trends():
 # --- Достижения ---
 @app.route('/api/achievements', methods=['GET'])
 def get_achievements():
-    check_achievements()
-    
     achievements = Achievement.query.order_by(Achievement.unlocked.desc(), Achievement.points.desc()).all()
     return jsonify([{
         'id': a.id,
@@ -3285,57 +5710,150 @@ def get_achievements():
         'unlocked_at': a.unlocked_at.isoformat() if a.unlocked_at else None
     } for a in achievements])
 
-def check_achievements():
-    today = date.today()
-    first_day = today.replace(day=1)
-    
-    unlock_achievement('first_transaction', Transaction.query.count() >= 1)
-    unlock_achievement('century', Transaction.query.count() >= 100)
-    unlock_achievement('goal_achiever', Goal.query.filter_by(is_completed=True).count() >= 1)
-    
+# Правила проверяются не при чтении, а при записи: after_flush собирает события
+# по изменённым моделям и приращения счётчиков, before_commit проверяет только
+# затронутые правила и открывает достижения в той же транзакции.
+ACHIEVEMENT_EVENTS = {
+    Transaction: 'transaction',
+    Account: 'balance',
+    Goal: 'goal',
+    Credit: 'debt',
+    Mortgage: 'debt',
+    CreditCard: 'debt',
+    Investment: 'investment',
+    Category: 'budget',
+}
+
+def _achievement_month_totals(context):
+    """Суммы текущего месяца по категориям — без кэша, с учётом незакоммиченных изменений"""
+    if 'month_totals' not in context:
+        first_day = date.today().replace(day=1)
+        context['month_totals'] = {
+            group: total for group, (total, _) in rollup_totals(('category_id', 'type'), first_day).items()
+        }
+    return context['month_totals']
+
+def _rule_saver_100k(context):
     total_savings = db.session.query(db.func.sum(Account.balance)).filter(
         Account.account_type.in_(['debit', 'savings'])
     ).scalar() or 0
-    unlock_achievement('saver_100k', total_savings >= 100000)
-    
-    monthly_income = db.session.query(db.func.sum(Transaction.amount)).filter(
-        Transaction.type == 'income',
-        Transaction.date >= first_day
-    ).scalar() or 0
-    monthly_expense = db.session.query(db.func.sum(Transaction.amount)).filter(
-        Transaction.type == 'expense',
-        Transaction.date >= first_day
-    ).scalar() or 0
-    unlock_achievement('profitable_month', monthly_income > monthly_expense)
-    
-    total_debt = Credit.query.count() + Mortgage.query.count()
+    return total_savings >= 100000
+
+def _rule_profitable_month(context):
+    month_totals = _achievement_month_totals(context)
+    monthly_income = sum(total for (_, type_), total in month_totals.items() if type_ == 'income')
+    monthly_expense = sum(total for (_, type_), total in month_totals.items() if type_ == 'expense')
+    return monthly_income > monthly_expense
+
+def _rule_debt_free(context):
+    if Credit.query.first() is not None or Mortgage.query.first() is not None:
+        return False
     total_card_debt = db.session.query(db.func.sum(CreditCard.current_debt)).scalar() or 0
-    unlock_achievement('debt_free', total_debt == 0 and total_card_debt == 0)
-    
-    unlock_achievement('investor', Investment.query.count() >= 1)
-    
-    over_budget = False
+    return total_card_debt == 0
+
+def _rule_budget_master(context):
     categories = Category.query.filter(Category.budget_limit > 0, Category.type == 'expense').all()
-    for cat in categories:
-        spent = db.session.query(db.func.sum(Transaction.amount)).filter(
-            Transaction.category_id == cat.id,
-            Transaction.date >= first_day,
-            Transaction.type == 'expense'
-        ).scalar() or 0
-        if spent > cat.budget_limit:
-            over_budget = True
-            break
-    unlock_achievement('budget_master', not over_budget and len(categories) > 0)
+    month_totals = _achievement_month_totals(context)
+    over_budget = any((month_totals.get((cat.id, 'expense')) or 0) > cat.budget_limit for cat in categories)
+    return not over_budget and len(categories) > 0
 
-def unlock_achievement(code, condition):
-    if not condition:
-        return
-    
-    achievement = Achievement.query.filter_by(code=code).first()
-    if achievement and not achievement.unlocked:
-        achievement.unlocked = True
-        achievement.unlocked_at = datetime.utcnow()
-        db.session.commit()
+# Код достижения -> (события, от которых зависит правило, проверка)
+ACHIEVEMENT_RULES = {
+    'first_transaction': ({'transaction'}, lambda context: context['counters'].get('transactions_created', 0) >= 1),
+    'century': ({'transaction'}, lambda context: context['counters'].get('transactions_created', 0) >= 100),
+    'goal_achiever': ({'goal'}, lambda context: context['counters'].get('goals_completed', 0) >= 1),
+    'saver_100k': ({'transaction', 'balance'}, _rule_saver_100k),
+    'profitable_month': ({'transaction'}, _rule_profitable_month),
+    'debt_free': ({'debt', 'balance'}, _rule_debt_free),
+    'investor': ({'investment'}, lambda context: context['counters'].get('investments_added', 0) >= 1),
+    'budget_master': ({'transaction', 'budget'}, _rule_budget_master),
+}
+ALL_ACHIEVEMENT_EVENTS = set(ACHIEVEMENT_EVENTS.values())
+
+def note_achievement_events(*events, **counters):
+    """Отмечает события и приращения счётчиков, не видные по ORM-объектам (массовые запросы)"""
+    db.session.info.setdefault('achievement_events', set()).update(events)
+    if counters:
+        pending = db.session.info.setdefault('achievement_counters', {})
+        for key, delta in counters.items():
+            pending[key] = pending.get(key, 0) + delta
+
+def apply_achievement_events(events, counters=None):
+    """
+    Прибавляет приращения к счётчикам и открывает заблокированные достижения,
+    правила которых зависят от случившихся событий. Не коммитит.
+    """
+    for key, delta in (counters or {}).items():
+        updated = AchievementState.query.filter_by(key=key).update(
+            {'value': AchievementState.value + delta}, synchronize_session=False
+        )
+        if not updated:
+            db.session.add(AchievementState(key=key, value=delta))
+    
+    locked = [
+        a for a in Achievement.query.filter_by(unlocked=False).all()
+        if a.code in ACHIEVEMENT_RULES and events & ACHIEVEMENT_RULES[a.code][0]
+    ]
+    if not locked:
+        return []
+    
+    context = {'counters': dict(db.session.query(AchievementState.key, AchievementState.value).all())}
+    unlocked = []
+    for achievement in locked:
+        if ACHIEVEMENT_RULES[achievement.code][1](context):
+            achievement.unlocked = True
+            achievement.unlocked_at = datetime.utcnow()
+            unlocked.append(achievement.code)
+    return unlocked
+
+def rebuild_achievement_state():
+    """Пересчитывает счётчики достижений по текущим данным и проверяет все правила"""
+    AchievementState.query.delete()
+    db.session.add_all([
+        AchievementState(key='transactions_created', value=sum(
+            db.session.execute(db.select(db.func.count()).select_from(source)).scalar()
+            for source in transaction_sources()
+        )),
+        AchievementState(key='goals_completed', value=Goal.query.filter_by(is_completed=True).count()),
+        AchievementState(key='investments_added', value=Investment.query.count()),
+    ])
+    db.session.flush()
+    apply_achievement_events(ALL_ACHIEVEMENT_EVENTS)
+    db.session.commit()
+
+@db.event.listens_for(db.session, 'after_flush')
+def _collect_achievement_events(session, flush_context):
+    events = set()
+    counters = {}
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        event = ACHIEVEMENT_EVENTS.get(type(obj))
+        if event:
+            events.add(event)
+    
+    for obj in session.new:
+        if isinstance(obj, Transaction):
+            counters['transactions_created'] = counters.get('transactions_created', 0) + 1
+        elif isinstance(obj, Investment):
+            counters['investments_added'] = counters.get('investments_added', 0) + 1
+    
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Goal) and True in db.inspect(obj).attrs.is_completed.history.added:
+            counters['goals_completed'] = counters.get('goals_completed', 0) + 1
+    
+    if events:
+        session.info.setdefault('achievement_events', set()).update(events)
+    if counters:
+        pending = session.info.setdefault('achievement_counters', {})
+        for key, delta in counters.items():
+            pending[key] = pending.get(key, 0) + delta
+
+@db.event.listens_for(db.session, 'before_commit')
+def _apply_achievement_events_before_commit(session):
+    session.flush()
+    events = session.info.pop('achievement_events', None)
+    counters = session.info.pop('achievement_counters', None)
+    if events or counters:
+        apply_achievement_events(events or set(), counters)
 
 # ============ АВТОМАТИЧЕСКАЯ МИГРАЦИЯ ============
 def auto_migrate():
@@ -3349,34 +5867,22 @@ def auto_migrate():
     inspector = inspect(db.engine)
     tables = inspector.get_table_names()
     
-    # Словарь: таблица -> список (колонка, тип SQL, значение по умолчанию)
+    # Словарь: таблица -> колонки, добавленные в модели после первого выпуска.
+    # Тип и значение по умолчанию берутся из модели и компилируются под диалект.
     model_columns = {
-        'transaction': [
-            ('is_business_expense', 'BOOLEAN', '0'),
-        ],
+        'transaction': ['is_business_expense', 'import_hash'],
         'account': [
-            ('is_business', 'BOOLEAN', '0'),
-            ('tax_rate', 'FLOAT', '0'),
-            ('linked_tax_account_id', 'INTEGER', 'NULL'),
-            ('is_investment', 'BOOLEAN', '0'),
-            ('broker_name', 'VARCHAR(100)', "''"),
-            ('is_tax_reserve', 'BOOLEAN', '0'),
-        ],
-        'credit': [
-            ('start_date', 'DATE', 'NULL'),
-            ('extra_payments_total', 'FLOAT', '0'),
-        ],
-        'mortgage': [
-            ('extra_payments_total', 'FLOAT', '0'),
-        ],
-        'investment': [
-            ('dividends_received', 'FLOAT', '0'),
-        ],
-        'credit_payment': [
-            ('months_reduced', 'INTEGER', '0'),
-            ('is_manual', 'BOOLEAN', '0'),  # ← ДОБАВЛЕНО!
+            'is_business', 'tax_rate', 'linked_tax_account_id',
+            'is_investment', 'broker_name', 'is_tax_reserve',
         ],
+        'credit': ['start_date', 'extra_payments_total'],
+        'mortgage': ['extra_payments_total'],
+        'investment': ['dividends_received'],
+        'credit_payment': ['months_reduced', 'is_manual'],
+        'import_job': ['heartbeat_at'],
     }
+    dialect = db.engine.dialect
+    quote = dialect.identifier_preparer.quote
     
     migrations_done = 0
     
@@ -3387,16 +5893,19 @@ def auto_migrate():
         
         existing_columns = [col['name'] for col in inspector.get_columns(table_name)]
         
-        for column_name, column_type, default_value in columns:
+        for column_name in columns:
             if column_name not in existing_columns:
                 print(f"  🔧 Добавляю {table_name}.{column_name}...")
+                column = db.metadata.tables[table_name].c[column_name]
+                sql = (f'ALTER TABLE {quote(table_name)} ADD COLUMN {quote(column_name)} '
+                       f'{column.type.compile(dialect=dialect)}')
+                if column.default is not None and column.default.is_scalar and column.default.arg is not None:
+                    default_value = db.literal(column.default.arg, column.type).compile(
+                        dialect=dialect, compile_kwargs={'literal_binds': True}
+                    )
+                    sql += f' DEFAULT {default_value}'
                 try:
                     with db.engine.connect() as conn:
-                        if default_value == 'NULL':
-                            sql = f'ALTER TABLE "{table_name}" ADD COLUMN {column_name} {column_type}'
-                        else:
-                            sql = f'ALTER TABLE "{table_name}" ADD COLUMN {column_name} {column_type} DEFAULT {default_value}'
-                        
                         conn.execute(text(sql))
                         conn.commit()
                     print(f"  ✅ {table_name}.{column_name} добавлено!")
@@ -3404,8 +5913,41 @@ def auto_migrate():
                 except Exception as e:
                     print(f"  ❌ Ошибка при добавлении {table_name}.{column_name}: {e}")
     
-    if migrations_done > 0:
-        print(f"✅ Миграция завершена! Добавлено колонок: {migrations_done}")
+    # Индексы из моделей, которых нет в уже существующих таблицах
+    indexes_done = 0
+    
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        
+        existing_indexes = {ix['name'] for ix in inspector.get_indexes(table.name)}
+        
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                print(f"  🔧 Создаю индекс {index.name}...")
+                try:
+                    index.create(bind=db.engine)
+                    print(f"  ✅ {index.name} создан!")
+                    indexes_done += 1
+                except Exception as e:
+                    print(f"  ❌ Ошибка при создании индекса {index.name}: {e}")
+    
+    if indexes_done > 0:
+        # Обновляем статистику, чтобы планировщик начал использовать новые индексы
+        with db.engine.connect() as conn:
+            conn.execute(text('ANALYZE'))
+            conn.commit()
+    
+    # Проверяем, что все объявленные индексы на месте
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing_indexes = {ix['name'] for ix in inspector.get_indexes(table.name)}
+        missing = [index.name for index in table.indexes if index.name not in existing_indexes]
+        if missing:
+            print(f"  ⚠️  В таблице {table.name} нет индексов: {', '.join(missing)}")
+    
+    if migrations_done > 0 or indexes_done > 0:
+        print(f"✅ Миграция завершена! Добавлено колонок: {migrations_done}, индексов: {indexes_done}")
     else:
         print("✅ База данных актуальна, миграция не требуется")
 
@@ -3446,6 +5988,10 @@ def init_default_data():
             db.session.add(Category(name=name, type=type_, icon=icon, color=color, budget_limit=budget))
         print("  ✅ Категории созданы!")
     
+    if ImportProfile.query.count() == 0:
+        for profile in DEFAULT_IMPORT_PROFILES:
+            db.session.add(ImportProfile(**profile))
+    
     if Achievement.query.count() == 0:
         print("🏆 Создаю достижения...")
         achievements = [
@@ -3465,14 +6011,281 @@ def init_default_data():
     
     db.session.commit()
 
+# ============ МИГРАЦИИ ============
+# Схема меняется только упорядоченными миграциями: номер записывается в
+# schema_version, каждая применяется один раз. Мигрирует один процесс под
+# блокировкой; остальные воркеры сверяют номер версии и сразу начинают работу.
+# Новая таблица, колонка или индекс — новая функция с @migration(следующий номер).
+MIGRATIONS = []
+MIGRATION_LOCK_KEY = 7_305_002
 
-# ============ ИНИЦИАЛИЗАЦИЯ ПРИ СТАРТЕ ============
-with app.app_context():
+def migration(version, name):
+    def register(func):
+        MIGRATIONS.append((version, name, func))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return func
+    return register
+
+@migration(1, 'Схема по моделям и колонки старых версий')
+def _migration_baseline():
+    # Для новой базы create_all создаёт всё сразу; для базы старой версии
+    # auto_migrate дописывает колонки и индексы в существующие таблицы
     db.create_all()
     auto_migrate()
+
+@migration(2, 'Данные по умолчанию')
+def _migration_default_data():
     init_default_data()
-    print("🚀 База данных готова к работе!")
+
+@migration(3, 'Производные таблицы: итоги, последние цены, журнал, достижения')
+def _migration_derived_tables():
+    if MonthlyRollup.query.first() is None and Transaction.query.first() is not None:
+        print("📊 Заполняю помесячные итоги...")
+        rebuild_monthly_rollup()
+    if ProductLatestPrice.query.first() is None and ProductPrice.query.first() is not None:
+        print("🏷️ Заполняю последние цены товаров...")
+        rebuild_product_latest_prices()
+    has_journal_sources = any(model.query.first() is not None for model in (Account, CreditPayment, InvestmentTransaction))
+    if JournalLine.query.first() is None and has_journal_sources:
+        print("📒 Строю журнал проводок...")
+        rebuild_journal()
+    if AchievementState.query.first() is None:
+        print("🏆 Заполняю счётчики достижений...")
+        rebuild_achievement_state()
+
+@migration(4, 'Архив транзакций закрытых лет')
+def _migration_transaction_archive():
+    ArchivedYear.__table__.create(db.engine, checkfirst=True)
+    if archive_available():
+        ensure_archive_table()
+
+@migration(5, 'Отметка активности задач импорта')
+def _migration_import_job_heartbeat():
+    auto_migrate()
+
+def latest_migration_version():
+    return MIGRATIONS[-1][0]
+
+def current_schema_version():
+    """Номер последней применённой миграции; 0 для базы без schema_version"""
+    with db.engine.connect() as connection:
+        try:
+            return connection.execute(db.select(db.func.max(SchemaVersion.version))).scalar() or 0
+        except DBAPIError:
+            return 0
+
+@contextmanager
+def migration_lock(blocking=True):
+    """
+    Межпроцессная блокировка миграций: flock на файле рядом с базой SQLite или
+    advisory-блокировка PostgreSQL. Отдаёт True, если блокировка получена
+    (при blocking=False занятая блокировка отдаёт False).
+    """
+    database_file = sqlite_database_file()
+    if database_file:
+        with open(database_file + '.migrate.lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    elif dialect_name() == 'postgresql':
+        with db.engine.connect() as connection:
+            if blocking:
+                connection.execute(db.select(db.func.pg_advisory_lock(MIGRATION_LOCK_KEY)))
+                acquired = True
+            else:
+                acquired = connection.execute(db.select(db.func.pg_try_advisory_lock(MIGRATION_LOCK_KEY))).scalar()
+            connection.commit()
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    connection.execute(db.select(db.func.pg_advisory_unlock(MIGRATION_LOCK_KEY)))
+                    connection.commit()
+    else:
+        yield True
+
+# Колонки таблиц читаются инспектором один раз за процесс (при --preload — в мастере
+# до fork), а не в каждом запросе. Сбрасывается после миграций и восстановления снимка.
+_schema_columns = None
+
+def schema_columns():
+    """Словарь таблица → множество колонок текущей базы"""
+    global _schema_columns
+    if _schema_columns is None:
+        inspector = db.inspect(db.engine)
+        _schema_columns = {
+            table: {column['name'] for column in inspector.get_columns(table)}
+            for table in inspector.get_table_names()
+        }
+    return _schema_columns
+
+def schema_has_column(table, column):
+    return column in schema_columns().get(table, ())
+
+def reset_schema_columns():
+    global _schema_columns
+    _schema_columns = None
+
+def run_migrations():
+    """Применяет недостающие миграции по порядку; возвращает число применённых"""
+    applied = 0
+    current = current_schema_version()
+    for version, name, func in MIGRATIONS:
+        if version <= current:
+            continue
+        print(f"🔄 Миграция {version}: {name}")
+        func()
+        # create_all мог только что создать schema_version
+        db.session.add(SchemaVersion(version=version, name=name))
+        db.session.commit()
+        applied += 1
+    if applied:
+        reset_schema_columns()
+    return applied
+
+def prepare_database():
+    """
+    Подготовка базы при старте процесса. Если версия схемы актуальна, это один
+    SELECT. Иначе процесс ждёт блокировку, и мигрирует тот, кто взял её первым;
+    остальные после ожидания видят актуальную версию и ничего не делают.
+    Контрольные точки балансов дописывает и брошенные задачи импорта закрывает
+    только процесс, взявший блокировку.
+    """
+    if current_schema_version() < latest_migration_version():
+        with migration_lock():
+            run_migrations()
+    
+    with migration_lock(blocking=False) as acquired:
+        if acquired and checkpoint_balances():
+            db.session.commit()
+        # Задачи импорта, брошенные остановившимся процессом
+        if acquired and fail_stale_import_jobs():
+            db.session.commit()
+    
+    schema_columns()
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Применяет недостающие миграции схемы"""
+    with migration_lock():
+        applied = run_migrations()
+    print(f"✅ Применено миграций: {applied}, версия схемы: {current_schema_version()}")
+
+@app.cli.command('rebuild-rollup')
+def rebuild_rollup_command():
+    """Пересчитывает помесячные итоги транзакций"""
+    rebuild_monthly_rollup()
+    print(f"✅ Помесячные итоги пересчитаны: {MonthlyRollup.query.count()} строк")
+
+@app.cli.command('rebuild-latest-prices')
+def rebuild_latest_prices_command():
+    """Пересчитывает последние цены товаров по магазинам"""
+    rebuild_product_latest_prices()
+    print(f"✅ Последние цены пересчитаны: {ProductLatestPrice.query.count()} строк")
+
+@app.cli.command('rebuild-journal')
+def rebuild_journal_command():
+    """Пересобирает журнал проводок и контрольные точки балансов"""
+    rebuild_journal()
+    print(f"✅ Журнал пересобран: {JournalLine.query.count()} строк, "
+          f"{BalanceCheckpoint.query.count()} контрольных точек")
+
+@app.cli.command('checkpoint-balances')
+def checkpoint_balances_command():
+    """Дописывает контрольные точки балансов по концам прошедших месяцев"""
+    created = checkpoint_balances()
+    db.session.commit()
+    print(f"✅ Контрольных точек добавлено: {created}")
+
+@app.cli.command('rebuild-balances')
+def rebuild_balances_command():
+    """Пересчитывает балансы счетов по журналу"""
+    drift = rebuild_account_balances()
+    for account_id, (old, new) in drift.items():
+        print(f"  ⚠️ Счёт {account_id}: {old} → {new}")
+    print(f"✅ Балансы пересчитаны, исправлено счетов: {len(drift)}")
+
+@app.cli.command('rebuild-achievements')
+def rebuild_achievements_command():
+    """Пересчитывает счётчики достижений и проверяет все правила"""
+    rebuild_achievement_state()
+    print(f"✅ Достижения пересчитаны: открыто {Achievement.query.filter_by(unlocked=True).count()}")
+
+@app.cli.command('backup')
+def backup_command():
+    """Делает сжатый снимок базы и удаляет снимки сверх BACKUP_KEEP"""
+    backup = create_backup()
+    print(f"✅ Снимок {backup['name']} ({backup['size']} байт), хранится последних: {BACKUP_KEEP}")
+
+@app.cli.command('list-backups')
+def list_backups_command():
+    """Список снимков базы"""
+    for backup in list_backups():
+        print(f"  {backup['name']}  {backup['size']} байт")
+
+@app.cli.command('restore')
+@click.argument('name')
+def restore_command(name):
+    """Восстанавливает базу из снимка NAME (текущая база сохраняется снимком)"""
+    try:
+        safety = restore_backup(name)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(f"✅ База восстановлена из {name}, прежнее состояние: {safety['name']}")
+
+@app.cli.command('archive-year')
+@click.argument('year', type=int)
+def archive_year_command(year):
+    """Переносит транзакции по конец года YEAR в архив (итоги и балансы сохраняются)"""
+    try:
+        moved = archive_year(year)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for archived, rows in sorted(moved.items()):
+        print(f"  {archived}: {rows} транзакций")
+    print(f"✅ В архиве все транзакции по {year} год, граница: {archive_boundary().isoformat()}")
+
+
+# ============ ИНИЦИАЛИЗАЦИЯ ПРИ СТАРТЕ ============
+# Импорт модуля не трогает базу. Точка входа — фабрика create_app(): gunicorn
+# "app:create_app()" с --preload готовит базу один раз в мастере, и воркеры
+# стартуют сразу с готовой схемой. Если приложение запущено как app:app,
+# подготовка выполняется перед первым запросом процесса.
+_database_prepared = False
+_prepare_lock = threading.Lock()
+
+def ensure_database_prepared():
+    global _database_prepared
+    if _database_prepared:
+        return
+    with _prepare_lock:
+        if not _database_prepared:
+            with app.app_context():
+                prepare_database()
+            _database_prepared = True
+            print("🚀 База данных готова к работе!")
+
+def create_app():
+    """Фабрика приложения: готовит базу и отдаёт app"""
+    ensure_database_prepared()
+    # Соединения, открытые при подготовке, не должны достаться воркерам после fork
+    with app.app_context():
+        db.engine.dispose()
+    if _read_engine is not None:
+        _read_engine.dispose()
+    return app
+
+@app.before_request
+def _prepare_database_before_first_request():
+    ensure_database_prepared()
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,132 @@
+# backend/bench_backup.py
+"""
+Замер снимков базы: время create_backup и restore_backup, размер снимка и
+задержка записи, пока идёт постраничное копирование.
+
+    python bench_backup.py                             # копия базы из DATABASE_URL
+    python bench_backup.py --rounds 5 --pages 1024 --pause 0
+    python bench_backup.py --writes-per-second 0       # без фоновой записи
+
+Бенч работает на копии базы во временном каталоге: рабочая база и BACKUP_DIR
+не трогаются. Параметры копирования передаются приложению через те же
+переменные окружения (BACKUP_PAGES_PER_STEP, BACKUP_STEP_PAUSE).
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def database_path():
+    url = os.environ.get('DATABASE_URL', 'sqlite:////app/data/budget.db')
+    if not url.startswith('sqlite:///') or ':memory:' in url:
+        raise SystemExit('Снимки есть только у файла SQLite: DATABASE_URL=sqlite:///...')
+    return url[len('sqlite:///'):]
+
+
+def copy_database(source, target):
+    """Согласованная копия через backup API (вместе с содержимым WAL)"""
+    source_connection = sqlite3.connect(source)
+    target_connection = sqlite3.connect(target)
+    try:
+        source_connection.backup(target_connection)
+    finally:
+        target_connection.close()
+        source_connection.close()
+
+
+def writer(path, rate, stop, latencies):
+    """Пишущие транзакции с частотой rate в секунду, пока не выставлен stop"""
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        while not stop.is_set():
+            started = time.perf_counter()
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('UPDATE account SET balance = balance WHERE id = (SELECT min(id) FROM account)')
+            connection.execute('COMMIT')
+            latencies.append(time.perf_counter() - started)
+            time.sleep(1 / rate)
+    finally:
+        connection.close()
+
+
+def percentile(values, p):
+    if len(values) < 2:
+        return values[0] if values else 0
+    return statistics.quantiles(values, n=100, method='inclusive')[p - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--pages', type=int, default=int(os.environ.get('BACKUP_PAGES_PER_STEP', 256)))
+    parser.add_argument('--pause', type=float, default=float(os.environ.get('BACKUP_STEP_PAUSE', 0.005)))
+    parser.add_argument('--writes-per-second', type=float, default=20)
+    parser.add_argument('--no-restore', dest='restore', action='store_false', default=True)
+    args = parser.parse_args()
+
+    source = database_path()
+    workdir = tempfile.mkdtemp(prefix='bench-backup-')
+    try:
+        path = os.path.join(workdir, 'budget.db')
+        copy_database(source, path)
+        archive = os.path.splitext(source)[0] + '-archive.db'
+        if os.path.exists(archive):
+            copy_database(archive, os.path.join(workdir, 'budget-archive.db'))
+
+        # Приложение читает настройки при импорте
+        os.environ['DATABASE_URL'] = 'sqlite:///' + path
+        os.environ['BACKUP_DIR'] = os.path.join(workdir, 'backups')
+        os.environ['BACKUP_KEEP'] = str(args.rounds * 2 + 2)
+        os.environ['BACKUP_PAGES_PER_STEP'] = str(args.pages)
+        os.environ['BACKUP_STEP_PAUSE'] = str(args.pause)
+        sys.path.insert(0, BACKEND_DIR)
+        import app as budget
+        budget.create_app()
+
+        backups, restores, sizes, latencies = [], [], [], []
+        with budget.app.app_context():
+            for _ in range(args.rounds):
+                stop = threading.Event()
+                thread = None
+                if args.writes_per_second > 0:
+                    thread = threading.Thread(target=writer, args=(path, args.writes_per_second, stop, latencies))
+                    thread.start()
+                started = time.perf_counter()
+                try:
+                    backup = budget.create_backup()
+                finally:
+                    backups.append(time.perf_counter() - started)
+                    stop.set()
+                    if thread is not None:
+                        thread.join()
+                sizes.append(backup['size'])
+
+                if args.restore:
+                    started = time.perf_counter()
+                    budget.restore_backup(backup['name'])
+                    restores.append(time.perf_counter() - started)
+
+        print(f'{os.path.getsize(path) / 1024 / 1024:.1f} MB database, pages={args.pages} '
+              f'pause={args.pause}s rounds={args.rounds}')
+        print(f'  create_backup:       {statistics.median(backups) * 1000:8.0f} ms')
+        print(f'  snapshot size:       {statistics.median(sizes) / 1024 / 1024:8.1f} MB')
+        if restores:
+            print(f'  restore_backup:      {statistics.median(restores) * 1000:8.0f} ms (включая снимок текущей базы)')
+        if latencies:
+            print(f'  write during backup: p50 {percentile(latencies, 50) * 1000:.1f} ms, '
+                  f'p99 {percentile(latencies, 99) * 1000:.1f} ms, max {max(latencies) * 1000:.1f} ms '
+                  f'({len(latencies)} записей)')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
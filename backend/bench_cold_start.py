@@ -0,0 +1,85 @@
+# backend/bench_cold_start.py
+"""
+Замер холодного старта воркера: время от запуска gunicorn до первого ответа.
+
+    python bench_cold_start.py                       # app:create_app() с --preload
+    python bench_cold_start.py --app app:app --no-preload
+    python bench_cold_start.py --rounds 5 --url /api/dashboard
+
+База берётся из DATABASE_URL, как у самого приложения. Печатает время импорта
+модуля, время до первого ответа /api/health и до первого ответа --url.
+"""
+import argparse
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+import urllib.error
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_time():
+    started = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import app'], cwd=BACKEND_DIR, check=True,
+                   stdout=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+
+def wait_for(url, deadline):
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                response.read()
+                return True
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.01)
+    return False
+
+
+def cold_start(args):
+    command = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{args.port}',
+               '--workers', str(args.workers), '--threads', '4', args.app]
+    if args.preload:
+        command.insert(3, '--preload')
+    started = time.perf_counter()
+    server = subprocess.Popen(command, cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = started + args.timeout
+        base = f'http://127.0.0.1:{args.port}'
+        if not wait_for(base + '/api/health', deadline):
+            raise RuntimeError('сервер не ответил за отведённое время')
+        health = time.perf_counter() - started
+        wait_for(base + args.url, deadline)
+        first = time.perf_counter() - started
+        return health, first
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--app', default='app:create_app()')
+    parser.add_argument('--preload', dest='preload', action='store_true', default=True)
+    parser.add_argument('--no-preload', dest='preload', action='store_false')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--url', default='/api/dashboard')
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    imports = [import_time() for _ in range(args.rounds)]
+    starts = [cold_start(args) for _ in range(args.rounds)]
+    print(f'{args.app} preload={args.preload} workers={args.workers} rounds={args.rounds}')
+    print(f'  import app:          {statistics.median(imports) * 1000:8.0f} ms')
+    print(f'  first /api/health:   {statistics.median(s[0] for s in starts) * 1000:8.0f} ms')
+    print(f'  first {args.url}: {statistics.median(s[1] for s in starts) * 1000:8.0f} ms')
+
+
+if __name__ == '__main__':
+    main()
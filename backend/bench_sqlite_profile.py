@@ -0,0 +1,153 @@
+# backend/bench_sqlite_profile.py
+"""
+Сравнение профилей PRAGMA SQLite: задержка чтения и записи через приложение.
+
+    python bench_sqlite_profile.py                           # копия базы из DATABASE_URL
+    python bench_sqlite_profile.py --profiles default tuned
+    python bench_sqlite_profile.py --reads 50 --writes 500 --url /api/dashboard
+
+Каждый профиль запускается в отдельном процессе на своей копии базы: PRAGMA
+читаются из переменных окружения SQLITE_* при импорте app, а запись меняет
+файл. Профиль tuned — значения SQLITE_PRAGMAS по умолчанию, default — то, что
+SQLite выставляет сам, без PRAGMA из приложения.
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PROFILES = {
+    'default': {
+        'SQLITE_JOURNAL_MODE': 'delete',
+        'SQLITE_SYNCHRONOUS': 'full',
+        'SQLITE_MMAP_SIZE': '0',
+        'SQLITE_CACHE_SIZE': '-2000',
+        'SQLITE_TEMP_STORE': 'default',
+        'SQLITE_FOREIGN_KEYS': 'off',
+    },
+    'tuned': {},
+    'tuned-no-fk': {'SQLITE_FOREIGN_KEYS': 'off'},
+}
+
+DEFAULT_URLS = ['/api/dashboard', '/api/transactions', '/api/stats/by-category?type=expense']
+
+
+def database_path():
+    url = os.environ.get('DATABASE_URL', 'sqlite:////app/data/budget.db')
+    if not url.startswith('sqlite:///') or ':memory:' in url:
+        raise SystemExit('Профили PRAGMA есть только у файла SQLite: DATABASE_URL=sqlite:///...')
+    return url[len('sqlite:///'):]
+
+
+def copy_database(source, target):
+    """Согласованная копия через backup API (вместе с содержимым WAL)"""
+    source_connection = sqlite3.connect(source)
+    target_connection = sqlite3.connect(target)
+    try:
+        source_connection.backup(target_connection)
+    finally:
+        target_connection.close()
+        source_connection.close()
+
+
+def percentile(values, p):
+    if len(values) < 2:
+        return values[0] if values else 0
+    return statistics.quantiles(values, n=100, method='inclusive')[p - 1]
+
+
+def run_profile(args):
+    """Процесс одного профиля: окружение уже выставлено родителем, печатает JSON с замерами"""
+    sys.path.insert(0, BACKEND_DIR)
+    import app as budget
+    budget.create_app()
+    client = budget.app.test_client()
+
+    with budget.app.app_context():
+        account_id = budget.Account.query.filter_by(account_type='debit').first().id
+        category_id = budget.Category.query.filter_by(type='expense').first().id
+        budget.db.session.remove()
+
+    reads = {}
+    for url in args.url:
+        client.get(url)  # прогрев: кэш страниц и ленивые кэши приложения
+        timings = []
+        for _ in range(args.reads):
+            started = time.perf_counter()
+            response = client.get(url)
+            timings.append(time.perf_counter() - started)
+            assert response.status_code == 200, (url, response.status_code)
+        reads[url] = timings
+
+    writes = []
+    for i in range(args.writes):
+        started = time.perf_counter()
+        response = client.post('/api/transactions', json={
+            'type': 'expense', 'amount': 1 + i % 100, 'account_id': account_id, 'category_id': category_id,
+            'description': 'bench'
+        })
+        writes.append(time.perf_counter() - started)
+        assert response.status_code == 201, response.get_data(as_text=True)
+
+    with budget.app.app_context():
+        journal_mode = budget.db.session.execute(budget.db.text('PRAGMA journal_mode')).scalar()
+    print(json.dumps({'reads': reads, 'writes': writes, 'journal_mode': journal_mode}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--profiles', nargs='+', choices=sorted(PROFILES), default=list(PROFILES))
+    parser.add_argument('--reads', type=int, default=20)
+    parser.add_argument('--writes', type=int, default=200)
+    parser.add_argument('--url', action='append')
+    parser.add_argument('--run-profile', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.url = args.url or DEFAULT_URLS
+
+    if args.run_profile:
+        run_profile(args)
+        return
+
+    source = database_path()
+    archive = os.path.splitext(source)[0] + '-archive.db'
+    print(f'{os.path.getsize(source) / 1024 / 1024:.1f} MB database, reads={args.reads} per url, '
+          f'writes={args.writes}')
+    for name in args.profiles:
+        workdir = tempfile.mkdtemp(prefix='bench-pragma-')
+        try:
+            path = os.path.join(workdir, 'budget.db')
+            copy_database(source, path)
+            if os.path.exists(archive):
+                copy_database(archive, os.path.join(workdir, 'budget-archive.db'))
+            env = dict(os.environ, DATABASE_URL='sqlite:///' + path, BACKUP_DIR=os.path.join(workdir, 'backups'))
+            env.update(PROFILES[name])
+            command = [sys.executable, os.path.abspath(__file__), '--run-profile', name,
+                       '--reads', str(args.reads), '--writes', str(args.writes)]
+            for url in args.url:
+                command += ['--url', url]
+            output = subprocess.run(command, cwd=BACKEND_DIR, env=env, check=True,
+                                    capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        print(f'{name} (journal_mode={result["journal_mode"]})')
+        for url, timings in result['reads'].items():
+            print(f'  {"GET " + url:44} p50 {percentile(timings, 50) * 1000:7.1f} ms, '
+                  f'p99 {percentile(timings, 99) * 1000:7.1f} ms')
+        writes = result['writes']
+        if writes:
+            print(f'  {"POST /api/transactions":44} p50 {percentile(writes, 50) * 1000:7.1f} ms, '
+                  f'p99 {percentile(writes, 99) * 1000:7.1f} ms ({len(writes) / sum(writes):.0f}/s)')
+
+
+if __name__ == '__main__':
+    main()
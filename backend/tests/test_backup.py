@@ -0,0 +1,56 @@
+# backend/tests/test_backup.py
+"""
+Снимки базы: архив закрытых лет снимается вместе с основной базой и
+восстанавливается с ней, поэтому перенесённые в архив годы не теряются.
+"""
+import os
+from datetime import date
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def sqlite_file(budget):
+    with budget.app.app_context():
+        if budget.sqlite_database_file() is None:
+            pytest.skip('Снимки есть только у файла SQLite')
+
+
+def transaction_amounts(client):
+    page = client.get('/api/transactions?start_date=2000-01-01&per_page=100').get_json()
+    return sorted(t['amount'] for t in page['transactions'])
+
+
+def test_backup_keeps_archived_years(budget, client, post):
+    account = post('/api/accounts', {'name': 'Дебет', 'account_type': 'debit'})['id']
+    archived_year = date.today().year - budget.ARCHIVE_MIN_YEARS_BACK
+    for amount, day in ((100, f'{archived_year - 1}-05-01'), (200, f'{archived_year}-06-01'),
+                        (300, date.today().isoformat())):
+        post('/api/transactions', {'type': 'income', 'amount': amount, 'account_id': account, 'date': day})
+    post('/api/archive', {'year': archived_year})
+    assert transaction_amounts(client) == [100, 200, 300]
+
+    backup = post('/api/backups')
+    assert backup['has_archive']
+    assert os.path.exists(os.path.join(budget.BACKUP_DIR, budget.backup_archive_name(backup['name'])))
+
+    # Архив потерян (другой том, случайное удаление) — снимок возвращает его
+    with budget.app.app_context():
+        budget.db.session.execute(budget.archived_transactions.delete())
+        budget.db.session.commit()
+    assert transaction_amounts(client) == [300]
+
+    post(f"/api/backups/{backup['name']}/restore")
+    assert transaction_amounts(client) == [100, 200, 300]
+    with budget.app.app_context():
+        assert budget.db.session.get(budget.Account, account).balance == 600
+
+
+def test_prune_removes_archive_with_its_snapshot(budget, post):
+    account = post('/api/accounts', {'name': 'Дебет', 'account_type': 'debit'})['id']
+    post('/api/transactions', {'type': 'income', 'amount': 10, 'account_id': account, 'date': '2001-01-01'})
+    post('/api/archive', {'year': 2001})
+    with budget.app.app_context():
+        assert budget.create_backup()['has_archive']
+        budget.prune_backups(keep=0)
+    assert not [name for name in os.listdir(budget.BACKUP_DIR) if name.startswith('budget-')]
@@ -0,0 +1,71 @@
+# backend/tests/test_batch.py
+"""
+POST /api/transactions/batch: id в ответе соответствуют строкам пакета по
+порядку, в том числе автоматические переводы налога, и с очередью записи.
+Долг карты после пакета тот же, что после тех же строк по одной, а ошибки в
+строке (в том числе в тегах) возвращаются по индексу строки.
+"""
+import pytest
+
+
+@pytest.mark.parametrize('write_queue', [False, True])
+def test_batch_ids_follow_row_order(budget, client, post, monkeypatch, write_queue):
+    monkeypatch.setattr(budget, 'WRITE_QUEUE_ENABLED', write_queue)
+    tax = post('/api/accounts', {'name': 'Налоги', 'account_type': 'tax_reserve'})['id']
+    business = post('/api/accounts', {'name': 'ИП', 'account_type': 'debit', 'is_business': True,
+                                      'tax_rate': 6, 'linked_tax_account_id': tax})['id']
+    debit = post('/api/accounts', {'name': 'Дебет', 'account_type': 'debit'})['id']
+
+    rows = []
+    for i in range(120):
+        if i % 3 == 0:
+            rows.append({'type': 'income', 'amount': 1000 + i, 'account_id': business, 'description': f'Строка {i}'})
+        else:
+            rows.append({'type': 'expense', 'amount': 10 + i, 'account_id': debit, 'description': f'Строка {i}'})
+    created = post('/api/transactions/batch', {'transactions': rows})
+    assert created['created'] == len(rows) + len(rows[::3])
+
+    with budget.app.app_context():
+        for result, row in zip(created['results'], rows):
+            transaction = budget.db.session.get(budget.Transaction, result['id'])
+            assert (transaction.description, transaction.amount) == (row['description'], row['amount'])
+            if row['type'] == 'income':
+                tax_transfer = budget.db.session.get(budget.Transaction, result['tax_transfer_id'])
+                assert tax_transfer.is_tax_transfer
+                assert tax_transfer.to_account_id == tax
+                assert tax_transfer.amount == pytest.approx(row['amount'] * 0.06)
+            else:
+                assert 'tax_transfer_id' not in result
+
+
+def card_debt(budget, account_id):
+    with budget.app.app_context():
+        return budget.CreditCard.query.filter_by(account_id=account_id).one().current_debt
+
+
+def test_card_debt_is_clamped_row_by_row(budget, client, post):
+    debit = post('/api/accounts', {'name': 'Дебет', 'account_type': 'debit', 'balance': 10000})['id']
+    cards = [post('/api/accounts', {'name': f'Кредитка {i}', 'account_type': 'credit_card',
+                                    'credit_limit': 50000, 'current_debt': 0})['id'] for i in range(2)]
+
+    def rows(card):
+        return [
+            {'type': 'transfer', 'amount': 500, 'account_id': debit, 'to_account_id': card},
+            {'type': 'expense', 'amount': 1000, 'account_id': card},
+        ]
+
+    post('/api/transactions/batch', {'transactions': rows(cards[0])})
+    for row in rows(cards[1]):
+        post('/api/transactions', row)
+    assert card_debt(budget, cards[0]) == card_debt(budget, cards[1]) == 1000
+
+
+@pytest.mark.parametrize('tags', [5, [1, 2], 'еда'])
+def test_bad_tags_are_reported_per_row(client, post, tags):
+    debit = post('/api/accounts', {'name': 'Дебет', 'account_type': 'debit'})['id']
+    response = client.post('/api/transactions/batch', json={'transactions': [
+        {'type': 'expense', 'amount': 10, 'account_id': debit, 'tags': ['еда']},
+        {'type': 'expense', 'amount': 10, 'account_id': debit, 'tags': tags},
+    ]})
+    assert response.status_code == 400
+    assert [r['index'] for r in response.get_json()['results']] == [1]
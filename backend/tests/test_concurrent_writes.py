@@ -0,0 +1,131 @@
+# backend/tests/test_concurrent_writes.py
+"""
+Параллельная запись из нескольких потоков: каждый маршрут берёт блокировку
+записи до первого запроса, поэтому атомарные проводки не теряются, а балансы,
+журнал и помесячные итоги сходятся с пересчётом с нуля.
+"""
+import random
+import threading
+from datetime import date, timedelta
+
+import pytest
+
+THREADS = 8
+OPERATIONS = 30
+
+
+def run_writer(budget, seed, account_ids, category_ids, effects, errors):
+    """Случайные создания, правки и удаления транзакций; effects — ожидаемые изменения балансов"""
+    rnd = random.Random(seed)
+    client = budget.app.test_client()
+    own = {}
+    try:
+        for _ in range(OPERATIONS):
+            action = rnd.random()
+            if action < 0.6 or not own:
+                source, target = rnd.sample(account_ids, 2)
+                body = {
+                    'type': rnd.choice(['expense', 'income', 'transfer']),
+                    'amount': rnd.randint(1, 500),
+                    'account_id': source,
+                    'date': (date.today() - timedelta(days=rnd.randint(0, 90))).isoformat()
+                }
+                if body['type'] == 'transfer':
+                    body['to_account_id'] = target
+                else:
+                    body['category_id'] = rnd.choice(category_ids)
+                response = client.post('/api/transactions', json=body)
+                assert response.status_code == 201, response.get_data(as_text=True)
+                own[response.get_json()['id']] = body
+                apply_effect(effects, body, 1)
+            elif action < 0.8:
+                id_, body = rnd.choice(list(own.items()))
+                new_amount = rnd.randint(1, 500)
+                response = client.put(f'/api/transactions/{id_}', json={'amount': new_amount})
+                assert response.status_code == 200, response.get_data(as_text=True)
+                apply_effect(effects, body, -1)
+                body['amount'] = new_amount
+                apply_effect(effects, body, 1)
+            else:
+                id_ = rnd.choice(list(own))
+                response = client.delete(f'/api/transactions/{id_}')
+                assert response.status_code == 200, response.get_data(as_text=True)
+                apply_effect(effects, own.pop(id_), -1)
+            if rnd.random() < 0.1:
+                store = client.post('/api/stores', json={'name': f'Магазин {seed}-{rnd.random()}'})
+                assert store.status_code == 201, store.get_data(as_text=True)
+                assert client.delete(f"/api/stores/{store.get_json()['id']}").status_code == 200
+    except BaseException as e:  # поток не должен проглатывать падение
+        errors.append(e)
+
+
+def apply_effect(effects, body, sign):
+    amount = body['amount'] * sign
+    if body['type'] == 'income':
+        effects.append((body['account_id'], amount))
+    elif body['type'] == 'expense':
+        effects.append((body['account_id'], -amount))
+    else:
+        effects.append((body['account_id'], -amount))
+        effects.append((body['to_account_id'], amount))
+
+
+def test_parallel_writers_keep_balances_journal_and_rollup_consistent(budget, client, post):
+    if budget.app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite:///:memory:'):
+        pytest.skip('Потокам нужна общая база в файле')
+    account_ids = [
+        post('/api/accounts', {'name': f'Счёт {i}', 'account_type': 'debit', 'balance': 10000})['id']
+        for i in range(3)
+    ]
+    category_ids = [c['id'] for c in client.get('/api/categories').get_json() if c['type'] == 'expense']
+
+    effects = []
+    errors = []
+    threads = [
+        threading.Thread(target=run_writer, args=(budget, seed, account_ids, category_ids, effects, errors))
+        for seed in range(THREADS)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+
+    expected = {id_: 10000 for id_ in account_ids}
+    for account_id, delta in effects:
+        expected[account_id] += delta
+
+    with budget.app.app_context():
+        Account, JournalLine, MonthlyRollup = budget.Account, budget.JournalLine, budget.MonthlyRollup
+        session = budget.db.session
+        balances = {a.id: a.balance for a in Account.query.filter(Account.id.in_(account_ids))}
+        assert balances == pytest.approx(expected)
+
+        journal = dict(session.query(JournalLine.ref_id, budget.db.func.sum(JournalLine.amount)).filter(
+            JournalLine.ledger == 'account', JournalLine.ref_id.in_(account_ids)
+        ).group_by(JournalLine.ref_id).all())
+        assert journal == pytest.approx(expected)
+
+        def rollup_rows():
+            return sorted(
+                (r.month, r.type, r.category_id, r.store_id, r.account_id, r.is_business_expense, round(r.total, 2), r.count)
+                for r in MonthlyRollup.query.all() if r.count
+            )
+        incremental = rollup_rows()
+        budget.rebuild_monthly_rollup()
+        assert incremental == rollup_rows()
+
+
+def test_lock_for_write_refuses_an_already_open_transaction(budget):
+    with budget.app.app_context():
+        session = budget.db.session
+        session.execute(budget.db.select(budget.Account.id)).all()
+        with pytest.raises(RuntimeError):
+            budget.lock_for_write()
+        session.rollback()
+
+        budget.lock_for_write()
+        budget.lock_for_write()  # повторный вызов под уже взятой блокировкой
+        assert session.info.get('write_locked')
+        session.commit()
+        assert not session.info.get('write_locked')
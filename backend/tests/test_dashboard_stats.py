@@ -0,0 +1,194 @@
+# backend/tests/test_dashboard_stats.py
+"""
+Дашборд и статистика считаются из помесячных итогов и одного GROUP BY по
+переводам. Тесты сверяют их с эталоном — прямым пересчётом по строкам
+transaction с теми же корзинами, что у прежней реализации (отдельный запрос
+на каждую сумму за каждый период).
+"""
+import random
+from datetime import date, timedelta
+
+from dateutil.relativedelta import relativedelta
+
+TRANSFER_DESCRIPTIONS = ['Погашение кредита', 'кредит за авто', 'ипотека', 'Платёж по ипотеке', 'Перевод', '']
+
+
+def seed(post, client, count=400):
+    rnd = random.Random(7)
+    tax = post('/api/accounts', {'name': 'Налоги', 'account_type': 'tax_reserve'})['id']
+    debit = post('/api/accounts', {'name': 'Дебет', 'account_type': 'debit', 'balance': 500000})['id']
+    savings = post('/api/accounts', {'name': 'Копилка', 'account_type': 'savings'})['id']
+    business = post('/api/accounts', {'name': 'ИП', 'account_type': 'debit', 'is_business': True,
+                                      'tax_rate': 6, 'linked_tax_account_id': tax})['id']
+    card = post('/api/accounts', {'name': 'Кредитка', 'account_type': 'credit_card',
+                                  'credit_limit': 300000, 'current_debt': 10000})['id']
+
+    categories = client.get('/api/categories').get_json()
+    expense_categories = [c['id'] for c in categories if c['type'] == 'expense']
+    income_categories = [c['id'] for c in categories if c['type'] == 'income']
+    stores = [post('/api/stores', {'name': f'Магазин {i}'})['id'] for i in range(4)]
+
+    today = date.today()
+    for _ in range(count):
+        body = {'date': (today - timedelta(days=rnd.randint(0, 420))).isoformat()}
+        kind = rnd.random()
+        if kind < 0.2:
+            body.update(type='income', amount=rnd.randint(1000, 90000), account_id=rnd.choice([debit, business]),
+                        category_id=rnd.choice(income_categories))
+        elif kind < 0.75:
+            body.update(type='expense', amount=rnd.randint(10, 9000), account_id=rnd.choice([debit, business, card]),
+                        category_id=rnd.choice(expense_categories), store_id=rnd.choice(stores + [None]),
+                        is_business_expense=rnd.random() < 0.25)
+        elif kind < 0.85:
+            body.update(type='transfer', amount=rnd.randint(100, 20000), account_id=debit, to_account_id=card,
+                        description=rnd.choice(TRANSFER_DESCRIPTIONS))
+        elif kind < 0.95:
+            source, target = rnd.sample([debit, savings, card], 2)
+            body.update(type='transfer', amount=rnd.randint(100, 20000), account_id=source, to_account_id=target,
+                        description=rnd.choice(TRANSFER_DESCRIPTIONS))
+        else:
+            body.update(type='transfer', amount=rnd.randint(100, 5000), account_id=business, to_account_id=tax,
+                        is_tax_transfer=True, description='Налог на кредит')
+        post('/api/transactions', body)
+    return [card]
+
+
+def load_transactions(budget):
+    with budget.app.app_context():
+        return [SimpleRow(t) for t in budget.Transaction.query.all()]
+
+
+class SimpleRow:
+    def __init__(self, transaction):
+        self.type = transaction.type
+        self.amount = transaction.amount
+        self.date = transaction.date
+        self.description = (transaction.description or '').lower()
+        self.account_id = transaction.account_id
+        self.to_account_id = transaction.to_account_id
+        self.category_id = transaction.category_id
+        self.store_id = transaction.store_id
+        self.is_tax_transfer = bool(transaction.is_tax_transfer)
+        self.is_business_expense = bool(transaction.is_business_expense)
+
+
+def reference_buckets(rows, credit_card_ids, start, end=None):
+    """Корзины прежнего дашборда за период [start, end] (end=None — без верхней границы)"""
+    period = [r for r in rows if r.date >= start and (end is None or r.date <= end)]
+    transfers = [r for r in period if r.type == 'transfer' and not r.is_tax_transfer]
+    total = lambda items: sum(r.amount for r in items)
+    return {
+        'income': total(r for r in period if r.type == 'income'),
+        'expense': total(r for r in period if r.type == 'expense'),
+        'expense_business': total(r for r in period if r.type == 'expense' and r.is_business_expense),
+        'credit_card_payments': total(
+            r for r in transfers
+            if r.account_id not in credit_card_ids and r.to_account_id in credit_card_ids
+        ),
+        # ~to_account_id.in_(...) в SQL отбрасывает и NULL
+        'credit_payments': total(
+            r for r in transfers
+            if r.to_account_id is not None and r.to_account_id not in credit_card_ids and 'кредит' in r.description
+        ),
+        'mortgage_payments': total(r for r in transfers if 'ипотек' in r.description),
+    }
+
+
+def debt_payments(buckets):
+    return buckets['credit_card_payments'] + buckets['credit_payments'] + buckets['mortgage_payments']
+
+
+def test_dashboard_matches_per_bucket_reference(budget, client, post):
+    credit_card_ids = seed(post, client)
+    rows = load_transactions(budget)
+    today = date.today()
+    first_day_month = today.replace(day=1)
+    last_month_start = (first_day_month - timedelta(days=1)).replace(day=1)
+
+    dashboard = client.get('/api/dashboard').get_json()
+
+    month = reference_buckets(rows, credit_card_ids, first_day_month)
+    monthly = dashboard['monthly']
+    assert monthly['income'] == month['income']
+    assert monthly['expense_business'] == month['expense_business']
+    assert monthly['expense_personal'] == month['expense'] - month['expense_business']
+    assert monthly['credit_card_payments'] == month['credit_card_payments']
+    assert monthly['credit_payments'] == month['credit_payments']
+    assert monthly['mortgage_payments'] == month['mortgage_payments']
+    assert monthly['expense'] == month['expense'] + debt_payments(month)
+
+    last = reference_buckets(rows, credit_card_ids, last_month_start, first_day_month - timedelta(days=1))
+    last_expense = last['expense'] + debt_payments(last)
+    expected_change = round((monthly['expense'] - last_expense) / last_expense * 100, 1) if last_expense > 0 else 0
+    assert monthly['expense_change'] == expected_change
+    expected_income_change = (
+        round((month['income'] - last['income']) / last['income'] * 100, 1) if last['income'] > 0 else 0
+    )
+    assert monthly['income_change'] == expected_income_change
+
+    year = reference_buckets(rows, credit_card_ids, today.replace(month=1, day=1))
+    assert dashboard['yearly']['income'] == year['income']
+    assert dashboard['yearly']['expense'] == year['expense']
+
+    trends = dashboard['trends']
+    assert len(trends) == 6
+    for i, trend in zip(range(5, -1, -1), trends):
+        month_start = (today - relativedelta(months=i)).replace(day=1)
+        month_end = month_start + relativedelta(months=1) - timedelta(days=1)
+        expected = reference_buckets(rows, credit_card_ids, month_start, month_end)
+        assert trend['month'] == month_start.strftime('%Y-%m')
+        assert trend['income'] == expected['income']
+        assert trend['expense_direct'] == expected['expense']
+        assert trend['expense_business'] == expected['expense_business']
+        assert trend['expense_personal'] == expected['expense'] - expected['expense_business']
+        assert trend['debt_payments'] == debt_payments(expected)
+        assert trend['expense'] == expected['expense'] + debt_payments(expected)
+
+    with budget.app.app_context():
+        limits = {
+            c.id: c.budget_limit
+            for c in budget.Category.query.filter(budget.Category.budget_limit > 0, budget.Category.type == 'expense')
+        }
+    spent = {}
+    for r in rows:
+        if r.type == 'expense' and r.date >= first_day_month:
+            spent[r.category_id] = spent.get(r.category_id, 0) + r.amount
+    expected_over = {id: spent[id] for id, limit in limits.items() if spent.get(id, 0) > limit}
+    assert {c['id']: c['spent'] for c in dashboard['over_budget_categories']} == expected_over
+
+
+def test_stats_match_grouped_reference(budget, client, post):
+    seed(post, client)
+    rows = load_transactions(budget)
+    today = date.today()
+    start = (today - timedelta(days=200)).isoformat()
+    end = (today - timedelta(days=30)).isoformat()
+    in_period = [r for r in rows if start <= r.date.isoformat() <= end]
+
+    for type_ in ('expense', 'income'):
+        expected = {}
+        for r in in_period:
+            if r.type == type_ and r.category_id is not None:
+                expected[r.category_id] = expected.get(r.category_id, 0) + r.amount
+        stats = client.get(f'/api/stats/by-category?type={type_}&start_date={start}&end_date={end}').get_json()
+        assert {s['id']: s['total'] for s in stats} == expected
+        assert [s['total'] for s in stats] == sorted(expected.values(), reverse=True)
+
+    expected_stores = {}
+    for r in in_period:
+        if r.type == 'expense' and r.store_id is not None:
+            total, count = expected_stores.get(r.store_id, (0, 0))
+            expected_stores[r.store_id] = (total + r.amount, count + 1)
+    stats = client.get(f'/api/stats/by-store?start_date={start}&end_date={end}').get_json()
+    assert {s['id']: (s['total'], s['count']) for s in stats} == expected_stores
+
+    trends = client.get('/api/stats/trends?months=12').get_json()
+    assert len(trends) == 12
+    for i, trend in zip(range(11, -1, -1), trends):
+        month_start = (today - relativedelta(months=i)).replace(day=1)
+        month_end = month_start + relativedelta(months=1) - timedelta(days=1)
+        period = [r for r in rows if month_start <= r.date <= month_end]
+        income = sum(r.amount for r in period if r.type == 'income')
+        expense = sum(r.amount for r in period if r.type == 'expense')
+        assert (trend['month'], trend['income'], trend['expense']) == (month_start.strftime('%Y-%m'), income, expense)
+        assert trend['month_name'] == month_start.strftime('%b %Y')
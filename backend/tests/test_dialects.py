@@ -0,0 +1,108 @@
+# backend/tests/test_dialects.py
+"""
+Помощники диалектов (date_bucket, text_contains, upsert_insert), блокировка записи
+и ALTER из auto_migrate. На SQLite и на PostgreSQL (TEST_DATABASE_URL) проверяется
+одно и то же поведение, а не текст SQL.
+"""
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def account(post):
+    return post('/api/accounts', {'name': 'Дебет', 'account_type': 'debit', 'balance': 1000})['id']
+
+
+def test_date_bucket_keys(budget, post, account):
+    for day in ('2025-12-31', '2026-01-01', '2026-01-15', '2026-02-28'):
+        post('/api/transactions', {'type': 'income', 'amount': 10, 'account_id': account, 'date': day})
+
+    with budget.app.app_context():
+        Transaction = budget.Transaction
+        for interval, expected in (
+            ('month', {'2025-12': 1, '2026-01': 2, '2026-02': 1}),
+            ('day', {'2025-12-31': 1, '2026-01-01': 1, '2026-01-15': 1, '2026-02-28': 1}),
+        ):
+            bucket = budget.date_bucket(Transaction.date, interval)
+            rows = budget.db.session.query(bucket, budget.db.func.count()).group_by(bucket).all()
+            assert dict(rows) == expected
+
+
+def test_text_contains_folds_cyrillic_case(budget, client, post, account):
+    for description in ('Кафе ПУШКИН', 'кафе у дома', 'Coffee SHOP', 'Зарплата'):
+        post('/api/transactions', {'type': 'expense', 'amount': 10, 'account_id': account,
+                                   'description': description})
+
+    def search(value):
+        return sorted(t['description'] for t in client.get(f'/api/transactions?search={value}').get_json()['transactions'])
+
+    assert search('пушкин') == ['Кафе ПУШКИН']
+    assert search('КАФЕ') == ['Кафе ПУШКИН', 'кафе у дома']
+    assert search('shop') == ['Coffee SHOP']
+
+
+def test_upsert_insert_adds_to_existing_row(budget):
+    with budget.app.app_context():
+        key = {'month': '2026-03', 'type': 'expense', 'category_id': 1, 'store_id': 0,
+               'account_id': 0, 'is_business_expense': False}
+        budget.rollup_apply(key, 100, 1)
+        budget.rollup_apply(key, 50, 1)
+        budget.db.session.commit()
+        row = budget.MonthlyRollup.query.filter_by(month='2026-03').one()
+        assert (row.total, row.count) == (150, 2)
+
+
+def test_lock_for_write_blocks_other_writers(budget, dialect):
+    with budget.app.app_context():
+        session = budget.db.session
+        budget.lock_for_write()
+        if dialect == 'postgresql':
+            held = session.execute(budget.db.text(
+                "SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid()"
+            )).scalar()
+            assert held == 1
+            with budget.db.engine.connect() as other:
+                taken = other.execute(budget.db.select(
+                    budget.db.func.pg_try_advisory_xact_lock(budget.WRITE_LOCK_KEY)
+                )).scalar()
+                assert taken is False
+                other.rollback()
+        else:
+            other = sqlite3.connect(budget.sqlite_database_file(), timeout=0)
+            try:
+                with pytest.raises(sqlite3.OperationalError, match='locked'):
+                    other.execute('BEGIN IMMEDIATE')
+            finally:
+                other.close()
+        session.commit()
+
+
+def dispose_engines(budget):
+    """Закрывает соединения пулов: auto_migrate работает при старте, на свежих соединениях"""
+    budget.db.engine.dispose()
+    if budget.read_engine() is not None:
+        budget.read_engine().dispose()
+
+
+def test_auto_migrate_adds_dropped_columns_with_defaults(budget, post, account):
+    investment = post('/api/investments', {'account_id': account, 'ticker': 'gazp', 'name': 'Газпром',
+                                           'quantity': 1, 'avg_buy_price': 150})['id']
+    with budget.app.app_context():
+        quote = budget.db.engine.dialect.identifier_preparer.quote
+        dispose_engines(budget)
+        with budget.db.engine.begin() as connection:
+            connection.exec_driver_sql('ALTER TABLE investment DROP COLUMN dividends_received')
+            connection.exec_driver_sql(f'ALTER TABLE {quote("account")} DROP COLUMN is_business')
+
+        budget.auto_migrate()
+        dispose_engines(budget)
+
+        with budget.db.engine.connect() as connection:
+            assert connection.execute(budget.db.text(
+                'SELECT dividends_received FROM investment WHERE id = :id'
+            ), {'id': investment}).scalar() == 0
+            assert not connection.execute(budget.db.text(
+                f'SELECT is_business FROM {quote("account")} WHERE id = :id'
+            ), {'id': account}).scalar()
+        assert budget.db.session.get(budget.Account, account).is_business is False
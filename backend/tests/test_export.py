@@ -0,0 +1,49 @@
+# backend/tests/test_export.py
+"""
+Выгрузки CSV/NDJSON: заголовок CSV есть всегда, даже без строк, и совпадает
+с полями записей NDJSON.
+"""
+import csv
+import io
+import json
+from datetime import date
+
+import pytest
+
+EXPORTS = ['transactions', 'credit-payments', 'investment-transactions', 'prices']
+
+
+def read_csv(response):
+    assert response.status_code == 200
+    text = response.get_data(as_text=True)
+    assert text.startswith('\ufeff')
+    return list(csv.reader(io.StringIO(text[1:]), delimiter=';'))
+
+
+@pytest.mark.parametrize('name', EXPORTS)
+def test_empty_csv_export_has_header(budget, client, name):
+    rows = read_csv(client.get(f'/api/export/{name}?format=csv'))
+    assert len(rows) == 1
+    assert 'id' in rows[0]
+
+
+@pytest.mark.parametrize('name', EXPORTS)
+def test_csv_header_matches_ndjson_fields(budget, client, post, name):
+    account = post('/api/accounts', {'name': 'Дебет', 'account_type': 'debit'})['id']
+    post('/api/transactions', {'type': 'expense', 'amount': 100, 'account_id': account, 'description': 'Кафе; чай'})
+    credit = post('/api/credits', {'name': 'Авто', 'original_amount': 100000, 'interest_rate': 12,
+                                   'term_months': 24, 'start_date': date.today().isoformat()})['id']
+    post(f'/api/credits/{credit}/pay', {'amount': 5000})
+    broker = post('/api/accounts', {'name': 'Брокер', 'account_type': 'investment'})['id']
+    investment = post('/api/investments', {'account_id': broker, 'ticker': 'SBER', 'name': 'Сбер',
+                                           'quantity': 1, 'avg_buy_price': 100, 'current_price': 100})['id']
+    post(f'/api/investments/{investment}/buy', {'quantity': 2, 'price': 120})
+    store = post('/api/stores', {'name': 'Магазин'})['id']
+    product = post('/api/products', {'name': 'Хлеб'})['id']
+    post(f'/api/products/{product}/prices', {'store_id': store, 'price': 50})
+
+    rows = read_csv(client.get(f'/api/export/{name}?format=csv'))
+    records = [json.loads(line) for line in client.get(f'/api/export/{name}?format=ndjson').get_data(as_text=True).splitlines()]
+    assert records
+    assert len(rows) == len(records) + 1
+    assert rows[0] == list(records[0])
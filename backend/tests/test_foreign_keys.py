@@ -0,0 +1,110 @@
+# backend/tests/test_foreign_keys.py
+"""
+Внешние ключи SQLite включены (SQLITE_PRAGMAS['foreign_keys']), поэтому удаление
+счёта, кредитной карты или категории обязано убрать или отвязать все строки,
+которые на них ссылаются, иначе DELETE падает с IntegrityError.
+"""
+from datetime import date
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def foreign_keys_on(budget):
+    if not budget.app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        return
+    with budget.app.app_context():
+        assert budget.db.session.execute(budget.db.text('PRAGMA foreign_keys')).scalar() == 1
+        budget.db.session.rollback()
+
+
+def assert_no_dangling_references(budget):
+    if not budget.app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        return
+    with budget.app.app_context():
+        assert budget.db.session.execute(budget.db.text('PRAGMA foreign_key_check')).all() == []
+        budget.db.session.rollback()
+
+
+def linked_account(budget, client, post, account_type='debit'):
+    """Счёт, на который ссылаются все таблицы с внешним ключом на account"""
+    expense = next(c['id'] for c in client.get('/api/categories').get_json() if c['type'] == 'expense')
+    income = next(c['id'] for c in client.get('/api/categories').get_json() if c['type'] == 'income')
+    other = post('/api/accounts', {'name': 'Другой', 'account_type': 'debit', 'balance': 10000})['id']
+    tax = post('/api/accounts', {'name': 'Налоги', 'account_type': 'tax_reserve'})['id']
+    body = {'name': 'Связанный', 'account_type': account_type, 'balance': 50000,
+            'is_business': True, 'tax_rate': 6, 'linked_tax_account_id': tax}
+    if account_type == 'credit_card':
+        body.update(credit_limit=100000, current_debt=0)
+    account = post('/api/accounts', body)['id']
+
+    post('/api/transactions', {'type': 'income', 'amount': 1000, 'account_id': account, 'category_id': income})
+    post('/api/transactions', {'type': 'expense', 'amount': 100, 'account_id': account, 'category_id': expense})
+    post('/api/transactions', {'type': 'transfer', 'amount': 300, 'account_id': other, 'to_account_id': account})
+    post('/api/transactions', {'type': 'transfer', 'amount': 200, 'account_id': account, 'to_account_id': other})
+
+    investment = post('/api/investments', {'account_id': account, 'ticker': 'sber', 'name': 'Сбербанк',
+                                           'quantity': 10, 'avg_buy_price': 250})['id']
+    post(f'/api/investments/{investment}/buy', {'quantity': 5, 'price': 260})
+    post(f'/api/investments/{investment}/dividend', {'amount': 120})
+    post('/api/goals', {'name': 'Отпуск', 'target_amount': 100000, 'linked_account_id': account})
+
+    with budget.app.app_context():
+        profile = budget.ImportProfile(name='Банк', file_format='csv', date_column='Дата', amount_column='Сумма')
+        budget.db.session.add(profile)
+        budget.db.session.flush()
+        budget.db.session.add(budget.ImportJob(account_id=account, profile_id=profile.id, status='done'))
+        assert budget.TaxReserve.query.filter_by(business_account_id=account).count() == 1
+        budget.db.session.commit()
+    return account, other
+
+
+def test_delete_fully_linked_account(budget, client, post):
+    account, other = linked_account(budget, client, post)
+    response = client.delete(f'/api/accounts/{account}')
+    assert response.status_code == 200, response.get_data(as_text=True)
+
+    with budget.app.app_context():
+        assert budget.db.session.get(budget.Account, account) is None
+        assert budget.Investment.query.count() == 0
+        assert budget.InvestmentTransaction.query.count() == 0
+        assert budget.ImportJob.query.count() == 0
+        assert budget.TaxReserve.query.count() == 0
+        assert budget.Goal.query.one().linked_account_id is None
+        assert budget.db.session.get(budget.Account, other).balance == 10000 - 300 + 200
+    assert_no_dangling_references(budget)
+
+
+def test_delete_linked_credit_card(budget, client, post):
+    account, other = linked_account(budget, client, post, account_type='credit_card')
+    card = next(c['id'] for c in client.get('/api/credit-cards').get_json() if c['account_id'] == account)
+    response = client.delete(f'/api/credit-cards/{card}')
+    assert response.status_code == 200, response.get_data(as_text=True)
+
+    with budget.app.app_context():
+        assert budget.db.session.get(budget.Account, account) is None
+        assert budget.CreditCard.query.count() == 0
+        assert budget.Goal.query.one().linked_account_id is None
+    assert_no_dangling_references(budget)
+
+
+def test_delete_category_with_children_and_budgets(budget, client, post):
+    parent = post('/api/categories', {'name': 'Родитель', 'type': 'expense'})['id']
+    with budget.app.app_context():
+        child = budget.Category(name='Дочерняя', type='expense', parent_id=parent)
+        budget.db.session.add(child)
+        today = date.today()
+        budget.db.session.add(budget.Budget(year=today.year, month=today.month, category_id=parent, planned_amount=5000))
+        budget.db.session.commit()
+        child = child.id
+    account = post('/api/accounts', {'name': 'Дебет', 'account_type': 'debit'})['id']
+    post('/api/transactions', {'type': 'expense', 'amount': 100, 'account_id': account, 'category_id': parent})
+
+    response = client.delete(f'/api/categories/{parent}')
+    assert response.status_code == 200, response.get_data(as_text=True)
+
+    with budget.app.app_context():
+        assert budget.db.session.get(budget.Category, child).parent_id is None
+        assert budget.Budget.query.filter_by(category_id=parent).count() == 0
+        assert budget.Transaction.query.one().category_id is None
+    assert_no_dangling_references(budget)
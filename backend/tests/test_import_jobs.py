@@ -0,0 +1,147 @@
+# backend/tests/test_import_jobs.py
+"""
+Фоновый импорт выписок: задача проходит все пачки, каждая пачка пишется
+под своей блокировкой записи. Удаление счёта или профиля удаляет их
+завершённые задачи, незавершённая задача блокирует удаление ответом 400,
+пока не станет брошенной. Задача всегда завершается, а файл выписки удаляется.
+"""
+import io
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+STATEMENT = 'Дата;Сумма;Описание\n01.03.2026;-150,50;Кафе\n02.03.2026;1000;Зарплата\n'
+
+
+@pytest.fixture
+def account_and_profile(post):
+    account = post('/api/accounts', {'name': 'Импорт', 'account_type': 'debit'})['id']
+    profile = post('/api/import/profiles', {
+        'name': 'Тестовый банк', 'file_format': 'csv', 'encoding': 'utf-8', 'delimiter': ';',
+        'date_column': 'Дата', 'date_format': '%d.%m.%Y', 'amount_column': 'Сумма',
+        'description_column': 'Описание'
+    })['id']
+    return account, profile
+
+
+def run_import(client, account, profile):
+    response = client.post('/api/import', data={
+        'file': (io.BytesIO(STATEMENT.encode()), 'statement.csv'),
+        'account_id': str(account),
+        'profile_id': str(profile)
+    }, content_type='multipart/form-data')
+    assert response.status_code == 202, response.get_data(as_text=True)
+    job_id = response.get_json()['job_id']
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        job = client.get(f'/api/import/jobs/{job_id}').get_json()
+        if job['status'] not in ('queued', 'running'):
+            assert job['status'] == 'done', job
+            return job_id
+        time.sleep(0.05)
+    raise AssertionError('импорт не завершился')
+
+
+def test_import_commits_every_chunk_under_write_lock(budget, client, account_and_profile, monkeypatch):
+    monkeypatch.setattr(budget, 'IMPORT_CHUNK_SIZE', 1)
+    account, profile = account_and_profile
+    job = client.get(f'/api/import/jobs/{run_import(client, account, profile)}').get_json()
+    assert (job['rows_read'], job['rows_imported']) == (2, 2)
+    with budget.app.app_context():
+        assert budget.db.session.get(budget.Account, account).balance == 849.5
+
+
+def job_count(budget):
+    with budget.app.app_context():
+        return budget.ImportJob.query.count()
+
+
+def set_job_status(budget, job_id, status):
+    with budget.app.app_context():
+        budget.ImportJob.query.filter_by(id=job_id).update({'status': status})
+        budget.db.session.commit()
+
+
+def test_delete_profile_removes_finished_jobs(budget, client, account_and_profile):
+    account, profile = account_and_profile
+    run_import(client, account, profile)
+    assert client.delete(f'/api/import/profiles/{profile}').status_code == 200
+    assert job_count(budget) == 0
+
+
+def test_delete_account_removes_finished_jobs(budget, client, account_and_profile):
+    account, profile = account_and_profile
+    run_import(client, account, profile)
+    assert client.delete(f'/api/accounts/{account}').status_code == 200
+    assert job_count(budget) == 0
+
+
+def test_running_job_blocks_deletes(budget, client, account_and_profile):
+    account, profile = account_and_profile
+    job_id = run_import(client, account, profile)
+    set_job_status(budget, job_id, 'running')
+
+    assert client.delete(f'/api/import/profiles/{profile}').status_code == 400
+    assert client.delete(f'/api/accounts/{account}').status_code == 400
+    assert job_count(budget) == 1
+
+    set_job_status(budget, job_id, 'failed')
+    assert client.delete(f'/api/accounts/{account}').status_code == 200
+    assert client.delete(f'/api/import/profiles/{profile}').status_code == 200
+    assert job_count(budget) == 0
+
+
+def test_stale_job_no_longer_blocks_deletes(budget, client, account_and_profile):
+    account, profile = account_and_profile
+    job_id = run_import(client, account, profile)
+    set_job_status(budget, job_id, 'running')
+    with budget.app.app_context():
+        budget.ImportJob.query.filter_by(id=job_id).update({
+            'heartbeat_at': datetime.utcnow() - budget.IMPORT_STALE_AFTER - timedelta(minutes=1)
+        })
+        budget.db.session.commit()
+
+    assert client.delete(f'/api/import/profiles/{profile}').status_code == 200
+    assert client.delete(f'/api/accounts/{account}').status_code == 200
+    assert job_count(budget) == 0
+
+
+def test_failure_before_parsing_fails_the_job_and_removes_the_file(budget, client, account_and_profile, monkeypatch):
+    account, profile = account_and_profile
+    with budget.app.app_context():
+        job = budget.ImportJob(account_id=account, profile_id=profile, filename='statement.csv')
+        budget.db.session.add(job)
+        budget.db.session.commit()
+        job_id = job.id
+    fd, path = tempfile.mkstemp(suffix='.statement')
+    os.close(fd)
+    monkeypatch.setattr(budget, 'IMPORT_PROFILE_FIELDS', budget.IMPORT_PROFILE_FIELDS + ('missing',))
+
+    budget.run_import_job(job_id, path)
+
+    job = client.get(f'/api/import/jobs/{job_id}').get_json()
+    assert job['status'] == 'failed' and job['finished_at']
+    assert not os.path.exists(path)
+
+
+def test_rejected_upload_removes_the_file(budget, client, account_and_profile, monkeypatch):
+    account, profile = account_and_profile
+    paths = []
+    mkstemp = tempfile.mkstemp
+
+    def recording_mkstemp(*args, **kwargs):
+        fd, path = mkstemp(*args, **kwargs)
+        paths.append(path)
+        return fd, path
+
+    monkeypatch.setattr(tempfile, 'mkstemp', recording_mkstemp)
+    response = client.post('/api/import', data={
+        'file': (io.BytesIO(STATEMENT.encode()), 'statement.csv'),
+        'account_id': str(account + 1000),
+        'profile_id': str(profile)
+    }, content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert paths and not any(os.path.exists(path) for path in paths)
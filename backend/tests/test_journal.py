@@ -0,0 +1,68 @@
+# backend/tests/test_journal.py
+"""
+Пересборка журнала проводок: потоковая запись пачками даёт те же строки,
+что вели маршруты, а первое построение сводит журнал с текущими балансами.
+"""
+import random
+from datetime import date, timedelta
+
+
+def seed(client, post):
+    rnd = random.Random(11)
+    accounts = [post('/api/accounts', {'name': f'Счёт {i}', 'account_type': 'debit', 'balance': 5000})['id']
+                for i in range(3)]
+    card = post('/api/accounts', {'name': 'Кредитка', 'account_type': 'credit_card',
+                                  'credit_limit': 50000, 'current_debt': 2000})['id']
+    categories = [c['id'] for c in client.get('/api/categories').get_json() if c['type'] == 'expense']
+    for _ in range(60):
+        source, target = rnd.sample(accounts + [card], 2)
+        body = {'type': rnd.choice(['expense', 'income', 'transfer']), 'amount': rnd.randint(1, 900),
+                'account_id': source, 'date': (date.today() - timedelta(days=rnd.randint(0, 120))).isoformat()}
+        if body['type'] == 'transfer':
+            body['to_account_id'] = target
+        else:
+            body['category_id'] = rnd.choice(categories)
+        post('/api/transactions', body)
+    credit = post('/api/credits', {'name': 'Авто', 'original_amount': 100000, 'interest_rate': 12,
+                                   'term_months': 24, 'start_date': date.today().isoformat()})['id']
+    post(f'/api/credits/{credit}/pay', {'amount': 5000})
+    broker = post('/api/accounts', {'name': 'Брокер', 'account_type': 'investment'})['id']
+    investment = post('/api/investments', {'account_id': broker, 'ticker': 'SBER', 'name': 'Сбер',
+                                           'quantity': 1, 'avg_buy_price': 100, 'current_price': 100})['id']
+    post(f'/api/investments/{investment}/buy', {'quantity': 2, 'price': 120})
+    post(f'/api/investments/{investment}/dividend', {'amount': 15})
+
+
+def journal_snapshot(budget):
+    lines = sorted(
+        (line.source, line.source_id, line.date, line.ledger, line.ref_id, round(line.amount, 2))
+        for line in budget.JournalLine.query.all()
+    )
+    checkpoints = sorted(
+        (point.account_id, point.date, round(point.balance, 2)) for point in budget.BalanceCheckpoint.query.all()
+    )
+    return lines, checkpoints
+
+
+def test_rebuild_in_small_chunks_reproduces_incremental_journal(budget, client, post, monkeypatch):
+    seed(client, post)
+    monkeypatch.setattr(budget, 'JOURNAL_REBUILD_CHUNK_SIZE', 7)
+    with budget.app.app_context():
+        budget.checkpoint_balances()
+        budget.db.session.commit()
+        before = journal_snapshot(budget)
+        budget.rebuild_journal()
+        assert journal_snapshot(budget) == before
+
+
+def test_first_build_reconciles_journal_with_balances(budget, client, post, monkeypatch):
+    seed(client, post)
+    monkeypatch.setattr(budget, 'JOURNAL_REBUILD_CHUNK_SIZE', 5)
+    with budget.app.app_context():
+        budget.JournalLine.query.delete()
+        budget.BalanceCheckpoint.query.delete()
+        budget.db.session.commit()
+
+        budget.rebuild_journal()
+        for account in budget.Account.query.all():
+            assert round(budget.account_balance_at(account.id), 2) == round(account.balance, 2), account.name
@@ -0,0 +1,70 @@
+# backend/tests/test_query_counts.py
+"""
+Число SQL-запросов списков и дашборда не должно расти вместе с числом строк:
+связанные данные грузятся пачками, а не запросом на каждую строку (N+1).
+"""
+import random
+from datetime import date, timedelta
+
+import pytest
+
+# Маршрут → сколько запросов ему разрешено (считая BEGIN) при любом числе строк
+QUERY_LIMITS = {
+    '/api/transactions': 6,
+    '/api/transactions?after=': 4,
+    '/api/accounts': 6,
+    '/api/dashboard': 14,
+}
+
+
+def add_rows(client, post, rnd, scale):
+    """Счета всех типов со связанными картами, инвестициями и кредитами плюс транзакции"""
+    tax = post('/api/accounts', {'name': f'Налоги {scale}', 'account_type': 'tax_reserve'})['id']
+    accounts = [tax]
+    for i in range(scale):
+        accounts.append(post('/api/accounts', {'name': f'Дебет {scale}-{i}', 'account_type': 'debit', 'balance': 10000})['id'])
+        accounts.append(post('/api/accounts', {'name': f'ИП {scale}-{i}', 'account_type': 'debit', 'is_business': True,
+                                               'tax_rate': 6, 'linked_tax_account_id': tax})['id'])
+        accounts.append(post('/api/accounts', {'name': f'Кредитка {scale}-{i}', 'account_type': 'credit_card',
+                                               'credit_limit': 50000, 'current_debt': 1000})['id'])
+        broker = post('/api/accounts', {'name': f'Брокер {scale}-{i}', 'account_type': 'investment'})['id']
+        post('/api/investments', {'account_id': broker, 'ticker': f'T{scale}{i}', 'name': 'Бумага',
+                                  'quantity': 1, 'avg_buy_price': 100, 'current_price': 110})
+        post('/api/credits', {'name': f'Кредит {scale}-{i}', 'original_amount': 100000, 'interest_rate': 10,
+                              'term_months': 12, 'start_date': date.today().isoformat()})
+        post('/api/goals', {'name': f'Цель {scale}-{i}', 'target_amount': 1000})
+
+    categories = [c['id'] for c in client.get('/api/categories').get_json() if c['type'] == 'expense']
+    stores = [post('/api/stores', {'name': f'Магазин {scale}-{i}'})['id'] for i in range(scale)]
+    today = date.today()
+    post('/api/transactions/batch', {'transactions': [{
+        'type': 'expense',
+        'amount': rnd.randint(1, 1000),
+        'account_id': rnd.choice(accounts[1:]),
+        'category_id': rnd.choice(categories),
+        'store_id': rnd.choice(stores),
+        'date': (today - timedelta(days=rnd.randint(0, 200))).isoformat()
+    } for _ in range(scale * 40)]})
+
+
+def count_queries(client, sql_log, url):
+    # Первый запрос после записи заново наполняет кэши процесса (итоги категорий
+    # за месяц), считается второй
+    for _ in range(2):
+        sql_log.clear()
+        response = client.get(url)
+        assert response.status_code == 200, response.get_data(as_text=True)
+    return len(sql_log)
+
+
+@pytest.mark.parametrize('url', sorted(QUERY_LIMITS))
+def test_query_count_does_not_grow_with_rows(client, post, sql_log, url):
+    rnd = random.Random(5)
+    add_rows(client, post, rnd, 2)
+    small = count_queries(client, sql_log, url)
+
+    add_rows(client, post, rnd, 10)
+    large = count_queries(client, sql_log, url)
+
+    assert small <= QUERY_LIMITS[url]
+    assert large == small
@@ -0,0 +1,117 @@
+# backend/tests/test_query_plans.py
+"""
+Планы запросов ленты, курсорных страниц и выписки: каждый запрос к transaction
+и journal_line должен искать по одному из индексов ix_*, а не читать таблицу
+целиком и не сортировать результат во временном B-дереве.
+"""
+import random
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+INDEXED_TABLES = ('transaction', 'journal_line')
+
+
+@pytest.fixture
+def seeded(budget, client, post):
+    if budget.app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0] != 'sqlite':
+        pytest.skip('EXPLAIN QUERY PLAN есть только у SQLite')
+    rnd = random.Random(3)
+    first = post('/api/accounts', {'name': 'Первый', 'account_type': 'debit', 'balance': 1000})['id']
+    second = post('/api/accounts', {'name': 'Второй', 'account_type': 'debit'})['id']
+    categories = [c['id'] for c in client.get('/api/categories').get_json() if c['type'] == 'expense']
+    today = date.today()
+    post('/api/transactions/batch', {'transactions': [{
+        'type': rnd.choice(['expense', 'income']),
+        'amount': rnd.randint(1, 1000),
+        'account_id': rnd.choice([first, second]),
+        'category_id': rnd.choice(categories),
+        'date': (today - timedelta(days=rnd.randint(0, 300))).isoformat()
+    } for _ in range(300)]})
+    return SimpleNamespace(account_id=first, category_id=categories[0], today=today)
+
+
+def plans_for(budget, sql_log, table):
+    """Строки EXPLAIN QUERY PLAN для запросов из sql_log, читающих table"""
+    plans = []
+    with budget.app.app_context():
+        with budget.db.engine.connect() as connection:
+            for statement, parameters in sql_log:
+                if not statement.lstrip().upper().startswith('SELECT') or f'FROM {quoted(table)}' not in statement:
+                    continue
+                rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, tuple(parameters)).all()
+                plans.append((statement, [row[3] for row in rows]))
+    assert plans, f'нет запросов к {table}'
+    return plans
+
+
+def quoted(table):
+    return '"transaction"' if table == 'transaction' else table
+
+
+def assert_searches_index(plans, table):
+    for statement, details in plans:
+        table_steps = [d for d in details if d.split(' ')[1:2] == [table]]
+        assert table_steps, (statement, details)
+        for step in table_steps:
+            assert step.startswith('SEARCH '), (statement, details)
+            assert ' USING INDEX ix_' in step or ' USING COVERING INDEX ix_' in step or 'PRIMARY KEY' in step, (statement, details)
+        assert not any('TEMP B-TREE' in d for d in details), (statement, details)
+
+
+def get(client, url):
+    response = client.get(url)
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return response.get_json()
+
+
+def test_feed_cursor_page_searches_date_index(budget, client, seeded, sql_log):
+    first_page = get(client, '/api/transactions?after=&per_page=20')
+    sql_log.clear()
+    get(client, '/api/transactions?per_page=20&after=' + first_page['next_cursor'])
+    plans = plans_for(budget, sql_log, 'transaction')
+    assert_searches_index(plans, 'transaction')
+    assert all(any('ix_transaction_date_id' in d for d in details) for _, details in plans)
+
+
+def test_feed_date_range_searches_date_index(budget, client, seeded, sql_log):
+    start = (seeded.today - timedelta(days=60)).isoformat()
+    end = (seeded.today - timedelta(days=30)).isoformat()
+    get(client, f'/api/transactions?start_date={start}&end_date={end}&per_page=20')
+    plans = plans_for(budget, sql_log, 'transaction')
+    assert_searches_index(plans, 'transaction')
+    assert all(any('ix_transaction_date_id' in d for d in details) for _, details in plans)
+
+
+def test_feed_first_page_walks_date_index_without_sort(budget, client, seeded, sql_log):
+    # Первая страница без фильтров — обход индекса (date, id) в порядке ORDER BY
+    # до LIMIT: без временной сортировки и без чтения таблицы мимо индекса
+    get(client, '/api/transactions?after=&per_page=20')
+    for statement, details in plans_for(budget, sql_log, 'transaction'):
+        assert 'SCAN transaction USING INDEX ix_transaction_date_id' in details, (statement, details)
+        assert not any('TEMP B-TREE' in d for d in details), (statement, details)
+
+
+def test_feed_filters_use_their_indexes(budget, client, seeded, sql_log):
+    get(client, f'/api/transactions?account_id={seeded.account_id}&per_page=20')
+    account_plans = plans_for(budget, sql_log, 'transaction')
+    for statement, details in account_plans:
+        assert any('ix_transaction_account_date_id' in d for d in details), (statement, details)
+        assert any('ix_transaction_to_account_date_id' in d for d in details), (statement, details)
+        assert not any(d.startswith('SCAN transaction') for d in details), (statement, details)
+
+    sql_log.clear()
+    get(client, f'/api/transactions?category_id={seeded.category_id}&per_page=20')
+    for statement, details in plans_for(budget, sql_log, 'transaction'):
+        assert any('ix_transaction_category_type_date' in d for d in details), (statement, details)
+        assert not any(d.startswith('SCAN transaction') for d in details), (statement, details)
+
+
+def test_statement_searches_journal_index(budget, client, seeded, sql_log):
+    first_page = get(client, f'/api/accounts/{seeded.account_id}/statement?per_page=20')
+    assert first_page.get('next_cursor')
+    get(client, f'/api/accounts/{seeded.account_id}/statement?per_page=20&after=' + first_page['next_cursor'])
+    plans = plans_for(budget, sql_log, 'journal_line')
+    assert_searches_index(plans, 'journal_line')
+    assert all(any('ix_journal_line_ledger_ref_date' in d for d in details) for _, details in plans)
@@ -0,0 +1,44 @@
+# backend/tests/test_write_queue.py
+"""
+Маршруты в очереди записи (WRITE_QUEUE_ENABLED): commit() обработчика закрывает
+только SAVEPOINT, но ответ всё равно строится по данным после массовых UPDATE,
+а удаления с блокировкой записи выполняются потоком-писателем.
+"""
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def write_queue(budget, monkeypatch):
+    monkeypatch.setattr(budget, 'WRITE_QUEUE_ENABLED', True)
+
+
+def test_pay_credit_card_returns_debt_after_payment(client, post):
+    debit = post('/api/accounts', {'name': 'Дебет', 'account_type': 'debit', 'balance': 20000})['id']
+    account = post('/api/accounts', {'name': 'Кредитка', 'account_type': 'credit_card',
+                                     'credit_limit': 50000, 'current_debt': 10000})['id']
+    card = next(c for c in client.get('/api/credit-cards').get_json() if c['account_id'] == account)
+
+    paid = post(f"/api/credit-cards/{card['id']}/pay", {'amount': 4000, 'from_account_id': debit})
+    assert (paid['new_debt'], paid['available_limit']) == (6000, 44000)
+    card = next(c for c in client.get('/api/credit-cards').get_json() if c['account_id'] == account)
+    assert card['current_debt'] == 6000
+
+
+def test_locked_deletes_run_in_the_writer(budget, client, post):
+    account = post('/api/accounts', {'name': 'Кредитка', 'account_type': 'credit_card', 'credit_limit': 1000})['id']
+    card = next(c['id'] for c in client.get('/api/credit-cards').get_json() if c['account_id'] == account)
+    category = post('/api/categories', {'name': 'Разное', 'type': 'expense'})['id']
+    store = post('/api/stores', {'name': 'Магазин'})['id']
+    profile = post('/api/import/profiles', {'name': 'Банк', 'file_format': 'csv'})['id']
+    post('/api/transactions', {'type': 'expense', 'amount': 100, 'account_id': account,
+                               'category_id': category, 'store_id': store})
+
+    for url in (f'/api/credit-cards/{card}', f'/api/categories/{category}',
+                f'/api/stores/{store}', f'/api/import/profiles/{profile}'):
+        response = client.delete(url)
+        assert response.status_code == 200, (url, response.get_data(as_text=True))
+    assert client.delete(f'/api/stores/{store}').status_code == 404
+
+    with budget.app.app_context():
+        assert budget.Transaction.query.count() == 0
+        assert budget.MonthlyRollup.query.filter(budget.MonthlyRollup.count > 0).count() == 0
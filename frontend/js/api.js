@@ -85,7 +85,7 @@ const API = {
     
     // Кредиты
     credits: {
-        getAll: () => api('/credits'),
+        getAll: () => api('/credits?include=payments'),
         create: (data) => api('/credits', 'POST', data),
         update: (id, data) => api(`/credits/${id}`, 'PUT', data),
         pay: (id, data) => api(`/credits/${id}/pay`, 'POST', data),
@@ -1802,9 +1802,7 @@ function renderInvestments() {
                                             Показать
                                         </button>
                                     </div>
-                                    <div class="investment-transactions" id="investment-trans-${inv.id}" style="display: none;">
-                                        ${renderInvestmentTransactions(inv.transactions || [])}
-                                    </div>
+                                    <div class="investment-transactions" id="investment-trans-${inv.id}" style="display: none;"></div>
                                 </div>
                             </div>
                         </div>
@@ -1861,11 +1859,22 @@ function toggleInvestmentDetails(id) {
     }
 }
 
-function toggleTransactionHistory(id) {
+async function toggleTransactionHistory(id) {
     const container = document.getElementById(`investment-trans-${id}`);
-    if (container) {
-        container.style.display = container.style.display === 'none' ? 'block' : 'none';
+    if (!container) return;
+    
+    if (container.style.display === 'none' && !container.dataset.loaded) {
+        // История подгружается при первом раскрытии, список позиций её не содержит
+        try {
+            const transactions = await API.investments.getTransactions(id);
+            container.innerHTML = renderInvestmentTransactions(transactions);
+            container.dataset.loaded = '1';
+        } catch (e) {
+            showToast('Ошибка загрузки истории операций', 'error');
+            return;
+        }
     }
+    container.style.display = container.style.display === 'none' ? 'block' : 'none';
 }
 
 // ==================== МАГАЗИНЫ И ТОВАРЫ ====================